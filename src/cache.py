@@ -0,0 +1,192 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import os
+import shutil
+
+from fingerprint import fingerprint
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    ''' Copy-on-write clone of src. Raises OSError if not supported. '''
+    if fcntl is None:
+        raise OSError("reflink not supported")
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+class ResultCache:
+    '''
+    Content-addressed cache of finished conversions.
+
+    Results are keyed by a fingerprint of the input, the ffmpeg arguments of
+    the output and the slice. A hit is materialized by reflink, hardlink or
+    copy, in that order of preference. The cache is bounded by size and the
+    least recently used results are evicted first.
+    '''
+
+    MAX_BYTES = 5 * (1 << 30)
+
+    def __init__(self, cache_dir=None, max_bytes=MAX_BYTES):
+        if cache_dir is None:
+            base = os.getenv("XDG_CACHE_HOME",
+                    os.path.join(os.path.expanduser("~"), ".cache"))
+            cache_dir = os.path.join(base, "simpleff", "results")
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = not os.getenv("SIMPLEFF_NO_CACHE")
+
+
+    def key(self, input_file, output_codec, slice_timestamps):
+        slice_ms = [None if ts is None else ts.to_ms()
+                for ts in slice_timestamps]
+
+        desc = json.dumps([
+            fingerprint(input_file),
+            # Normalize the output path out of the argument list
+            output_codec.output_args("OUTPUT"),
+            slice_ms,
+            ])
+
+        return hashlib.sha256(desc.encode()).hexdigest()
+
+
+    def _path(self, key, output_codec):
+        return os.path.join(self.cache_dir, key + "." + output_codec.ext)
+
+
+    def fetch(self, key, output_codec, output_file):
+        ''' Place a cached result at output_file. Returns True on a hit. '''
+        path = self._path(key, output_codec)
+        if not os.path.exists(path):
+            return False
+
+        # Never write through an existing file, it may be a hardlink
+        try:
+            os.remove(output_file)
+        except OSError:
+            pass
+
+        try:
+            reflink(path, output_file)
+        except OSError:
+            try:
+                os.link(path, output_file)
+            except OSError:
+                shutil.copyfile(path, output_file)
+
+        # Mark as recently used
+        os.utime(path)
+
+        return True
+
+
+    def store(self, key, output_codec, output_file):
+        path = self._path(key, output_codec)
+        temp = path + ".tmp"
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Not hardlinked, the output may be overwritten in place later
+        try:
+            reflink(output_file, temp)
+        except OSError:
+            shutil.copyfile(output_file, temp)
+
+        os.replace(temp, path)
+
+        self.evict()
+
+
+    def _analysis_path(self, key):
+        desc = json.dumps(key)
+        return os.path.join(self.cache_dir, "analysis",
+                hashlib.sha256(desc.encode()).hexdigest() + ".json")
+
+
+    def load_analysis(self, key):
+        '''
+        Stored result of an analysis pass (a loudness measurement...) under
+        key, a JSON-serializable list. None if there is none.
+        '''
+        if not self.enabled:
+            return None
+
+        try:
+            with open(self._analysis_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def store_analysis(self, key, result):
+        ''' Analysis results are tiny, they are kept until clear() '''
+        path = self._analysis_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temp = path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(result, f)
+
+        os.replace(temp, path)
+
+
+    def evict(self):
+        ''' Remove least recently used results until under max_bytes '''
+        entries = []
+        total = 0
+
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
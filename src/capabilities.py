@@ -0,0 +1,250 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+from subprocess import Popen, PIPE, DEVNULL
+
+from fingerprint import fingerprint
+from output_codecs import SegmentedOutputCodec
+
+
+# Entries of the -encoders, -muxers and -filters listings, not their legends
+# (" V..... = Video")
+ENCODER_LINE = re.compile(r"^\s*[VAS][F.][S.][X.][B.][D.]\s+([^\s=]\S*)")
+MUXER_LINE = re.compile(r"^\s*D?E[d.]?\s+([^\s=]\S*)\s")
+FILTER_LINE = re.compile(r"^\s*[T.][S.][C.]?\s+([^\s=]\S*)\s+\S*->\S*")
+
+# Muxers for extensions that aren't muxer names themselves
+MUXERS = {"mkv": "matroska", "m4a": "ipod", "ts": "mpegts"}
+
+
+def _codec_args(codec):
+    if isinstance(codec, SegmentedOutputCodec):
+        return codec.video_args + codec.audio_args
+
+    return codec.args
+
+
+def requirements(codec):
+    '''
+    (encoders, muxer, filters) an ffmpeg binary needs for codec. Filters
+    are only those SimpleFF adds itself.
+    '''
+    args = _codec_args(codec)
+    encoders = set(args[i + 1] for i, arg in enumerate(args[:-1])
+            if arg in ("-c", "-codec") or arg.startswith(("-c:", "-codec:")))
+    encoders.discard("copy")
+
+    filters = set()
+    if isinstance(codec, SegmentedOutputCodec):
+        muxer = codec.fmt
+        filters.update(["split", "scale"])
+    else:
+        muxer = MUXERS.get(codec.muxer, codec.muxer)
+    if codec.loudness:
+        filters.add("loudnorm")
+
+    return encoders, muxer, filters
+
+
+
+class Capabilities:
+    '''
+    What an ffmpeg binary can encode, mux and filter, and how fast.
+
+    The -encoders, -muxers and -filters listings are parsed once per binary
+    (identified by its version line and contents) and cached as JSON, along
+    with the results of benchmarks: short encodes of generated test input
+    with a codec's arguments. If the binary can't be queried, everything is
+    assumed to be supported.
+
+    A codec's alternatives are only used when the binary can't encode the
+    codec itself, unless prefer_speed (or $SIMPLEFF_PREFER_SPEED=1) asks
+    for the fastest of them.
+    '''
+
+    # Seconds of test input per benchmark
+    BENCH_SECS = 2
+    BENCH_INPUT = ["-f", "lavfi", "-i",
+            "testsrc2=size=1280x720:rate=30:duration=%d" % BENCH_SECS,
+            "-f", "lavfi", "-i", "sine=frequency=440:duration=%d" % BENCH_SECS]
+
+    def __init__(self, ffmpeg, cache_dir=None, prefer_speed=None):
+        if prefer_speed is None:
+            prefer_speed = os.getenv("SIMPLEFF_PREFER_SPEED") == "1"
+        self.prefer_speed = prefer_speed
+
+        if cache_dir is None:
+            base = os.getenv("XDG_CACHE_HOME",
+                    os.path.join(os.path.expanduser("~"), ".cache"))
+            cache_dir = os.path.join(base, "simpleff", "capabilities")
+
+        self.ffmpeg = ffmpeg
+        self.cache_dir = cache_dir
+
+        self.version = self._run(["-version"]).split("\n", 1)[0]
+        self.known = bool(self.version)
+
+        self.encoders = self.muxers = self.filters = frozenset()
+        # Codec name -> seconds its benchmark took, None if it failed
+        self.benchmarks = {}
+
+        self.path = None
+        if self.known:
+            key = hashlib.sha256((self.version + fingerprint(ffmpeg))
+                    .encode()).hexdigest()
+            self.path = os.path.join(cache_dir, key + ".json")
+            self._load() or self._discover()
+
+
+    def _run(self, args):
+        ''' stdout of ffmpeg with args, "" if it can't be run '''
+        try:
+            p = Popen([self.ffmpeg, "-hide_banner"] + args, stdin=DEVNULL,
+                    stdout=PIPE, stderr=DEVNULL, universal_newlines=True)
+        except OSError:
+            return ""
+
+        out, _ = p.communicate()
+        return out if p.returncode == 0 else ""
+
+
+    def _list(self, option, pattern):
+        names = set()
+        for line in self._run([option]).splitlines():
+            m = pattern.match(line)
+            if m:
+                # Muxers can have several names, "mov,mp4,m4a"
+                names.update(m.group(1).split(","))
+
+        return frozenset(names)
+
+
+    def _discover(self):
+        self.encoders = self._list("-encoders", ENCODER_LINE)
+        self.muxers = self._list("-muxers", MUXER_LINE)
+        self.filters = self._list("-filters", FILTER_LINE)
+
+        # A listing that parses to nothing means the format changed
+        self.known = bool(self.encoders and self.muxers)
+        self._save()
+
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        self.encoders = frozenset(data["encoders"])
+        self.muxers = frozenset(data["muxers"])
+        self.filters = frozenset(data["filters"])
+        self.benchmarks = data.get("benchmarks", {})
+        return True
+
+
+    def _save(self):
+        data = {
+            "version": self.version,
+            "encoders": sorted(self.encoders),
+            "muxers": sorted(self.muxers),
+            "filters": sorted(self.filters),
+            "benchmarks": self.benchmarks,
+            }
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp = self.path + ".tmp"
+            with open(temp, "w") as f:
+                json.dump(data, f)
+            os.replace(temp, self.path)
+        except OSError as e:
+            print("Could not cache capabilities:", e, file=sys.stderr)
+
+
+    def supports(self, codec):
+        if not self.known:
+            return True
+
+        encoders, muxer, filters = requirements(codec)
+
+        return encoders <= self.encoders and muxer in self.muxers and \
+                filters <= self.filters
+
+
+    def benchmark(self, codec):
+        '''
+        Seconds an encode of BENCH_SECS of test input with codec takes,
+        None if it fails. Measured once per binary.
+        '''
+        if codec.name in self.benchmarks:
+            return self.benchmarks[codec.name]
+
+        print("Benchmarking", codec.name, file=sys.stderr)
+
+        cmd = [self.ffmpeg, "-nostdin", "-v", "error"] + self.BENCH_INPUT + \
+                ["-map", "0:v", "-map", "1:a"] + _codec_args(codec) + \
+                ["-f", "null", "-"]
+
+        start = time.monotonic()
+        try:
+            p = Popen(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+            code = p.wait()
+        except OSError:
+            code = 1
+
+        secs = time.monotonic() - start if code == 0 else None
+
+        self.benchmarks[codec.name] = secs
+        if self.path:
+            self._save()
+
+        return secs
+
+
+    def choose(self, codec, measure=True):
+        '''
+        codec if this binary supports it, else the first of its alternatives
+        it does, or None if it supports none of them. With prefer_speed, the
+        fastest of them instead; measure=False only uses benchmarks already
+        done, so it returns at once.
+        '''
+        candidates = [c for c in [codec] + codec.alternatives
+                if self.supports(c)]
+
+        if len(candidates) <= 1 or not self.known or not self.prefer_speed:
+            return candidates[0] if candidates else None
+
+        timed = [(self.benchmark(c) if measure else self.benchmarks.get(c.name),
+            i, c) for i, c in enumerate(candidates)]
+        timed = [t for t in timed if t[0] is not None]
+        if not timed:
+            return candidates[0]
+
+        return min(timed, key=lambda t: t[:2])[2]
+
+
+    def codecs(self, available, measure=True):
+        ''' The usable profile for each of available, unsupported ones left out '''
+        chosen = [self.choose(codec, measure) for codec in available]
+        return [codec for codec in chosen if codec is not None]
@@ -0,0 +1,373 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import csv
+import os
+import re
+import shutil
+
+from threading import Lock, Thread
+
+from engine import Job, JobEngine
+from ff import FFTime
+from join import conform_codec, encodable
+from output_codecs import OutputCodec
+
+
+class Cut:
+    ''' The part of input_file between start and end (FFTimes) '''
+
+    def __init__(self, input_file, start, end, name=None):
+        if end.to_ms() <= start.to_ms():
+            raise ValueError("Cut ends before it starts: %s %s-%s"
+                    % (input_file, start, end))
+
+        self.input_file = input_file
+        self.start = start
+        self.end = end
+        self.name = name
+
+
+
+def read_csv(path, fps=None):
+    '''
+    Cuts from a CSV file with the columns input, start, end and optionally
+    an output name. A header row and lines starting with # are skipped.
+    Inputs are relative to the CSV file.
+    '''
+    base = os.path.dirname(os.path.abspath(path))
+    cuts = []
+
+    with open(path, newline="") as f:
+        for i, row in enumerate(csv.reader(f)):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+            if i == 0 and row[0].lower() == "input":
+                continue
+            if len(row) < 3:
+                raise ValueError("Line %d: expected input, start, end" % (i + 1))
+
+            try:
+                start, end = FFTime.parse(row[1], fps), FFTime.parse(row[2], fps)
+            except ValueError as e:
+                raise ValueError("Line %d: %s" % (i + 1, e))
+
+            name = row[3] if len(row) > 3 and row[3] else None
+            cuts.append(Cut(os.path.join(base, row[0]), start, end, name))
+
+    return cuts
+
+
+EDL_EVENT = re.compile(r"^(\d+)\s+(\S+)\s+(\S+)\s+(C|D|W\d+|K\S*)\s+(?:\d+\s+)?"
+        r"(\S+)\s+(\S+)\s+\S+\s+\S+\s*$")
+EDL_SOURCE = re.compile(r"^\*\s*(SOURCE FILE|FROM CLIP NAME|TO CLIP NAME)\s*:"
+        r"\s*(.+?)\s*$", re.IGNORECASE)
+
+# Black and auxiliary sources (color bars, slugs) rather than reels
+EDL_BLACK = "BL"
+EDL_AUX = "AX"
+
+
+def read_edl(path, fps=25):
+    '''
+    Cuts from a CMX 3600 EDL: the source in and out points of every event.
+    Sources are taken from "* SOURCE FILE:" or "* FROM CLIP NAME:" comments,
+    or the reel name, relative to the EDL file.
+
+    The lines of one event (its video and audio tracks, both sides of a
+    dissolve) make one cut, from its last line that isn't black or empty;
+    for a dissolve, that is the clip of "* TO CLIP NAME:". Events from auxiliary
+    (AX) reels are only kept if a comment names their source.
+    '''
+    base = os.path.dirname(os.path.abspath(path))
+    drop_frame = False
+    # Event number -> [[(reel, start, end)], {comment: source}]
+    events = {}
+    event = None
+
+    with open(path, errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+
+            if line.upper().startswith("FCM:"):
+                drop_frame = "NON" not in line.upper()
+                continue
+
+            m = EDL_EVENT.match(line)
+            if m:
+                number, reel, _, _, src_in, src_out = m.groups()
+                if drop_frame:
+                    # Drop-frame timecodes don't always use the ; separator
+                    src_in = src_in[:8] + ";" + src_in[9:]
+                    src_out = src_out[:8] + ";" + src_out[9:]
+
+                start, end = FFTime.parse(src_in, fps), FFTime.parse(src_out, fps)
+
+                # The outgoing side of a dissolve may have no length
+                event = events.setdefault(number, [[], {}])
+                if reel.upper() != EDL_BLACK and end.to_ms() > start.to_ms():
+                    event[0].append((reel, start, end))
+                continue
+
+            m = EDL_SOURCE.match(line)
+            if m and event is not None:
+                event[1].setdefault(m.group(1).upper(), m.group(2))
+
+    cuts = []
+    for number, (lines, sources) in events.items():
+        if not lines:
+            continue
+
+        reel, start, end = lines[-1]
+        source = sources.get("TO CLIP NAME") or sources.get("SOURCE FILE") \
+                or sources.get("FROM CLIP NAME")
+        if source is None:
+            if reel.upper() == EDL_AUX:
+                continue
+            source = reel
+        source = os.path.join(base, source)
+
+        base_name = os.path.splitext(os.path.basename(source))[0]
+        cuts.append(Cut(source, start, end, "%s-%s" % (base_name, number)))
+
+    return cuts
+
+
+def read_cutlist(path, fps=None):
+    if path.lower().endswith(".edl"):
+        return read_edl(path, fps or 25)
+
+    return read_csv(path, fps)
+
+
+def copy_codec(ext, start, length):
+    '''
+    Stream copy of a part of the input. The times are output options, so
+    one ffmpeg process can write many parts of the same input.
+    '''
+    return OutputCodec("Copy", ext,
+            "-ss %s -t %s -map 0:v:0? -map 0:a:0? -c copy "
+            "-avoid_negative_ts make_zero" % (start, length))
+
+
+
+class CutListJob:
+    '''
+    Extracts the cuts of a cut list into output_dir.
+
+    Without a codec every cut keeps the format of its source: cuts that
+    start on a keyframe are stream copied, others are smart cut (the
+    frames up to the next keyframe are re-encoded to match the source and
+    the rest is copied), and cuts without a keyframe are re-encoded. All
+    the copies from one source are written by a single ffmpeg process, so
+    each source is read once plus once per re-encoded part. With a codec
+    every cut is re-encoded.
+
+    The ffmpeg processes run as Jobs on a JobEngine, copies and encodes in
+    their own pools. Like FF.run, start() returns at once and reports
+    through msg_signal and finish_signal.
+    '''
+
+    # Seconds a cut may start before a keyframe and still be copied from it
+    TOLERANCE = 0.002
+
+    def __init__(self, ff, cuts, output_dir, codec=None, engine=None):
+        if not cuts:
+            raise ValueError("The cut list is empty")
+
+        self.ff = ff
+        self.cuts = cuts
+        self.output_dir = output_dir
+        self.codec = codec
+
+        self.own_engine = engine is None
+        self.engine = engine or JobEngine(ff)
+
+        self.work_dir = None
+        self.jobs = []
+        self.failed = []
+        self.lock = Lock()
+        self.cancelled = False
+
+
+    def output_file(self, index, cut):
+        if self.codec:
+            ext = self.codec.ext
+        else:
+            ext = os.path.splitext(cut.input_file)[1].lstrip(".") or "mkv"
+
+        name = cut.name or "%s-%03d" % (
+                os.path.splitext(os.path.basename(cut.input_file))[0], index + 1)
+        if not name.lower().endswith("." + ext):
+            name += "." + ext
+
+        return os.path.join(self.output_dir, name)
+
+
+    def _part_file(self, index, part, ext):
+        return os.path.join(self.work_dir, "cut-%05d-%s.%s" % (index, part, ext))
+
+
+    def plan(self):
+        '''
+        Jobs for all cuts, and [(output, [files])] of the smart cuts to join
+        once their parts are done
+        '''
+        by_source = {}
+        for i, cut in enumerate(self.cuts):
+            by_source.setdefault(cut.input_file, []).append((i, cut))
+
+        jobs, joins = [], []
+        for source, cuts in by_source.items():
+            if not os.path.isfile(source):
+                raise ValueError("No such input file: %s" % source)
+
+            if self.codec:
+                for i, cut in cuts:
+                    jobs.append(Job(source, [(self.output_file(i, cut), self.codec)],
+                        (cut.start, cut.end - cut.start)))
+                continue
+
+            keyframes = self.ff.get_keyframes(source)
+            params = self.ff.get_stream_params(source)
+            fallback = self.ff.codecs()[0]
+            if encodable(params):
+                encode_codec = conform_codec(params, params)
+            else:
+                encode_codec = fallback
+
+            copies = []
+            for i, cut in cuts:
+                output_file = self.output_file(i, cut)
+                ext = os.path.splitext(output_file)[1].lstrip(".")
+                start, end = cut.start.to_ms() / 1000, cut.end.to_ms() / 1000
+
+                k = bisect.bisect_left(keyframes, start - self.TOLERANCE)
+                keyframe = keyframes[k] if k < len(keyframes) else None
+
+                if keyframe is not None and keyframe - start <= self.TOLERANCE:
+                    copies.append((output_file, copy_codec(ext, cut.start,
+                        cut.end - cut.start)))
+
+                elif keyframe is not None and keyframe < end and \
+                        encode_codec is not fallback:
+                    head = self._part_file(i, "head", encode_codec.ext)
+                    tail = self._part_file(i, "tail", ext)
+                    split = FFTime(1000 * keyframe)
+
+                    jobs.append(Job(source, [(head, encode_codec)],
+                        (cut.start, split - cut.start)))
+                    copies.append((tail, copy_codec(ext, split, cut.end - split)))
+                    joins.append((output_file, [head, tail]))
+
+                else:
+                    jobs.append(Job(source, [(output_file, encode_codec)],
+                        (cut.start, cut.end - cut.start)))
+
+            if copies:
+                jobs.append(Job(source, copies))
+
+        return jobs, joins
+
+
+    def progress(self):
+        ''' Fraction of the work done, None before it starts '''
+        durations = [job.duration for job in self.jobs]
+        if not durations or None in durations:
+            return None
+
+        encoded = sum(min(job.encoded, job.duration) for job in self.jobs)
+        return encoded / max(1e-3, sum(durations))
+
+
+    def _run(self, msg_signal, finish_signal):
+        self.work_dir = self.ff.scratch.mkdtemp("cuts-")
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        try:
+            jobs, joins = self.plan()
+        except ValueError as e:
+            self.failed.append(e)
+            msg_signal.emit("%s\n" % e)
+            finish_signal.emit()
+            return
+
+        msg_signal.emit("%d cuts from %d sources in %d ffmpeg runs\n"
+                % (len(self.cuts), len(set(c.input_file for c in self.cuts)),
+                    len(jobs)))
+
+        self.jobs = jobs
+        remaining = [len(jobs)]
+
+        def on_finish(job):
+            if job.status != Job.DONE:
+                msg_signal.emit("Cutting %s failed\n" % job.input_file)
+                with self.lock:
+                    self.failed.append(job)
+
+            with self.lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+
+            if last:
+                self._finish(joins, msg_signal, finish_signal)
+
+        for job in jobs:
+            job.msg_signal.connect(lambda job, line: msg_signal.emit(line))
+            job.finish_signal.connect(on_finish)
+
+        if self.own_engine:
+            self.engine.start()
+
+        for job in jobs:
+            self.engine.submit(job)
+
+
+    def _finish(self, joins, msg_signal, finish_signal):
+        if self.own_engine:
+            self.engine.stop()
+
+        # Smart cuts: re-encoded head + copied tail
+        for output_file, parts in joins:
+            if self.cancelled:
+                break
+            if not all(os.path.exists(part) for part in parts):
+                continue
+
+            # The head has parameter sets of its own
+            if self.ff.concat(parts, output_file, msg_signal, annexb=True):
+                with self.lock:
+                    self.failed.append(output_file)
+
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        msg_signal.emit("\n%d cuts done, %d failed\n"
+                % (len(self.cuts), len(self.failed)) if self.failed
+                else "\nAll %d cuts done\n" % len(self.cuts))
+        finish_signal.emit()
+
+
+    def start(self, msg_signal, finish_signal):
+        Thread(target=lambda: self._run(msg_signal, finish_signal)).start()
+
+
+    def terminate(self):
+        self.cancelled = True
+        for job in self.jobs:
+            if job.status in (Job.QUEUED, Job.RUNNING, Job.PAUSED):
+                self.engine.cancel(job)
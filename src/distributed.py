@@ -0,0 +1,463 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Distributed segment encoding.
+
+The coordinator splits the input into keyframe-aligned segments and sends
+them to workers over TCP. Every message is a line of JSON, optionally
+followed by as many raw bytes as its "size" field says:
+
+    coordinator -> worker   {"secret": ..., "segment": i, "codec": {...},
+                             "start": s, "length": l, "input": path,
+                             "output": path}
+                            (shared storage, the worker reads and writes the
+                            paths itself, which must be under its root)
+                        or  {"secret": ..., "segment": i, "codec": {...},
+                             "size": n} + n bytes
+                            (streamed, the bytes are the segment, cut from the
+                            input with stream copy)
+
+    worker -> coordinator   {"ok": true} or {"ok": true, "size": n} + n bytes
+                            {"ok": false, "error": "..."} on failure
+
+Every request carries the secret shared by the coordinator and its workers
+($SIMPLEFF_SECRET). The codec is only named; workers look it up among their
+own formats, so a coordinator can't make them run arbitrary ffmpeg
+arguments. Headers for codecs normalizing loudness also carry "loudness",
+the measurement of the whole input, so every segment gets the same gain.
+
+Failed segments are retried on any worker; a worker that keeps failing is
+dropped. The encoded segments are joined with the concat demuxer.
+'''
+
+
+import hmac
+import json
+import os
+import queue
+import secrets
+import shutil
+import socket
+import socketserver
+import sys
+
+from subprocess import Popen, PIPE
+from threading import Lock, Semaphore, Thread
+
+from ff import FFTime
+from output_codecs import Loudness, SegmentedOutputCodec, find_codec
+from resumable import plan_chunks
+
+
+BUFSIZE = 1 << 20
+
+
+def send_msg(f, header, data_file=None):
+    if data_file:
+        header["size"] = os.path.getsize(data_file)
+
+    f.write((json.dumps(header) + "\n").encode("utf-8"))
+
+    if data_file:
+        with open(data_file, "rb") as data:
+            shutil.copyfileobj(data, f, BUFSIZE)
+
+    f.flush()
+
+
+def recv_msg(f, data_file=None, allowed=None):
+    '''
+    Read a message, storing its payload (if any) in data_file. Raises
+    PermissionError before reading the payload if allowed(header) is false.
+    '''
+    line = f.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+
+    header = json.loads(line.decode("utf-8"))
+    if not isinstance(header, dict):
+        raise ValueError("Not a message")
+    if allowed and not allowed(header):
+        raise PermissionError("Wrong secret")
+
+    size = header.get("size")
+    if size is not None:
+        with open(data_file, "wb") as data:
+            while size > 0:
+                chunk = f.read(min(size, BUFSIZE))
+                if not chunk:
+                    raise ConnectionError("Connection closed")
+                data.write(chunk)
+                size -= len(chunk)
+
+    return header
+
+
+def codec_to_dict(codec):
+    d = {"name": codec.name}
+    if codec.loudness:
+        d["loudness"] = codec.loudness.to_dict()
+
+    return d
+
+
+def codec_from_dict(d, codecs):
+    ''' The codec named in d, among codecs '''
+    codec = find_codec(str(d.get("name", "")), codecs)
+    if codec is None or codec.name != d["name"]:
+        raise ValueError("Unknown format: %s" % d.get("name"))
+
+    if d.get("loudness"):
+        target = {k: float(v) for k, v in d["loudness"].items()
+                if k in ("integrated", "true_peak", "lra")}
+        codec = codec.normalized(Loudness(**target))
+
+    return codec
+
+
+def measured_from_dict(d):
+    ''' Loudness measurement from a header, numbers only '''
+    if not d:
+        return {}
+
+    return {k: str(float(d[k])) for k in Loudness.MEASURED}
+
+
+def get_secret():
+    ''' The secret shared by a coordinator and its workers '''
+    return os.getenv("SIMPLEFF_SECRET") or ""
+
+
+def inside(path, root):
+    ''' Whether path is root or under it, after resolving links '''
+    path = os.path.realpath(path)
+    root = os.path.realpath(root)
+    return os.path.commonpath([path, root]) == root
+
+
+
+class Worker:
+    ''' Encodes segments for coordinators, a few at a time '''
+
+    def __init__(self, ff, address, parallel=1, secret=None, root=None):
+        self.ff = ff
+        host, _, port = address.rpartition(":")
+        self.address = (host.strip("[]") or "127.0.0.1", int(port))
+        self.slots = Semaphore(parallel)
+        self.server = None
+
+        # Checked on every request; one is generated if none is given
+        self.secret = secret or get_secret()
+        if not self.secret:
+            self.secret = secrets.token_urlsafe(24)
+            print("Secret:", self.secret, file=sys.stderr)
+
+        # Shared storage paths must be under root, without it only streamed
+        # segments are accepted
+        self.root = root
+
+
+    def allowed(self, header):
+        given = header.get("secret")
+        return isinstance(given, str) and hmac.compare_digest(
+                given.encode("utf-8"), self.secret.encode("utf-8"))
+
+
+    def encode(self, header, work_dir):
+        codec = codec_from_dict(header["codec"], self.ff.codecs())
+        if isinstance(codec, SegmentedOutputCodec):
+            raise ValueError("Segmented formats can't be distributed")
+
+        if "input" in header:
+            input_file = header["input"]
+            output_file = header["output"]
+            if not self.root:
+                raise ValueError("Shared storage is not enabled")
+            if not all(isinstance(p, str) and inside(p, self.root)
+                    for p in (input_file, output_file)):
+                raise ValueError("Paths must be under %s" % self.root)
+
+            slice_timestamps = (FFTime(1000 * float(header["start"])),
+                    FFTime(1000 * float(header["length"])))
+        else:
+            input_file = os.path.join(work_dir, "input.mkv")
+            output_file = os.path.join(work_dir, "output." + codec.ext)
+            slice_timestamps = (None, None)
+
+        # Segments are normalized with the loudness the coordinator
+        # measured for the whole input
+        cmd = self.ff.build_cmd(input_file, [(output_file, codec)],
+                slice_timestamps,
+                loudness=measured_from_dict(header.get("loudness")))
+
+        with self.slots:
+            p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+            _, err = p.communicate()
+
+        if p.returncode:
+            raise RuntimeError(err.decode("utf-8", "replace")[-500:])
+
+        return output_file
+
+
+    def handler(self):
+        worker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                work_dir = worker.ff.scratch.mkdtemp("worker-")
+                try:
+                    while True:
+                        try:
+                            header = recv_msg(self.rfile,
+                                    os.path.join(work_dir, "input.mkv"),
+                                    worker.allowed)
+                        except PermissionError as e:
+                            # Nothing more is read from this client
+                            send_msg(self.wfile, {"ok": False, "error": str(e)})
+                            return
+                        except (ConnectionError, ValueError):
+                            return
+
+                        print("Encoding segment", header.get("segment"))
+                        try:
+                            output_file = worker.encode(header, work_dir)
+                        except Exception as e:
+                            send_msg(self.wfile, {"ok": False, "error": str(e)})
+                            continue
+
+                        if "input" in header:
+                            send_msg(self.wfile, {"ok": True})
+                        else:
+                            send_msg(self.wfile, {"ok": True}, output_file)
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+
+        return Handler
+
+
+    def serve(self):
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(self.address, self.handler())
+        self.server.daemon_threads = True
+
+        print("Worker listening on %s:%d" % self.address)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+
+
+
+class Coordinator:
+    '''
+    Encodes one input across several workers and joins the result.
+
+    With shared=True, workers read the input and write their segments
+    through paths that are the same on every machine (shared storage).
+    Otherwise each segment is cut with stream copy and streamed to the
+    worker, and the encoded segment is streamed back.
+    '''
+
+    SEGMENT_SECS = 60
+    RETRIES = 3
+    # Consecutive failures after which a worker is dropped
+    WORKER_FAILURES = 3
+
+    def __init__(self, ff, input_file, output_file, codec, workers,
+            slice_timestamps=(None, None), shared=False,
+            segment_secs=SEGMENT_SECS, secret=None):
+        # Their playlists and segments can't be joined with concat
+        if isinstance(codec, SegmentedOutputCodec):
+            raise ValueError("%s can't be distributed" % codec.name)
+
+        self.ff = ff
+        self.input_file = os.path.abspath(input_file)
+        self.output_file = os.path.abspath(output_file)
+        self.codec = codec
+        self.workers = workers
+        self.slice_timestamps = slice_timestamps
+        self.shared = shared
+        self.segment_secs = segment_secs
+        self.secret = secret or get_secret()
+
+        # Workers need to see the segments in shared mode, otherwise they
+        # only pass through here
+        if shared:
+            self.work_dir = self.output_file + ".segments"
+        else:
+            self.work_dir = os.path.join(ff.scratch.run_dir,
+                    "segments-" + os.path.basename(self.output_file))
+        self.lock = Lock()
+        self.inflight = 0
+
+        # Measured once, for every segment
+        self.loudness = None
+
+
+    def _segment_file(self, segment, partial=False):
+        # Keep the extension, ffmpeg picks the container from it
+        name = "segment-%05d%s.%s" % (segment, ".part" if partial else "",
+                self.codec.ext)
+        return os.path.join(self.work_dir, name)
+
+
+    def _cut(self, segment, start, length):
+        ''' Stream copy of one segment of the input, to send to a worker '''
+        path = os.path.join(self.work_dir, "source-%05d.mkv" % segment)
+
+        cmd = [self.ff.ffmpeg.name, "-v", "error", "-y", "-ss", str(start),
+                "-i", self.input_file, "-t", str(length),
+                "-map", "0", "-c", "copy", "-f", "matroska", path]
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        _, err = p.communicate()
+        if p.returncode:
+            raise RuntimeError(err.decode("utf-8", "replace"))
+
+        return path
+
+
+    def _send(self, conn, segment, start, end):
+        header = {"secret": self.secret, "segment": segment,
+                "codec": codec_to_dict(self.codec)}
+        if self.loudness:
+            header["loudness"] = self.loudness
+
+        # Only complete segments get their final name
+        partial = self._segment_file(segment, partial=True)
+
+        if self.shared:
+            header.update({"input": self.input_file, "output": partial,
+                "start": start, "length": end - start})
+            send_msg(conn, header)
+            reply = recv_msg(conn)
+        else:
+            source = self._cut(segment, start, end - start)
+            try:
+                send_msg(conn, header, source)
+                reply = recv_msg(conn, partial)
+            finally:
+                os.remove(source)
+
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error"))
+
+        os.replace(partial, self._segment_file(segment))
+
+
+    def _work(self, address, segments, todo, attempts, msg_signal):
+        host, _, port = address.rpartition(":")
+        failures = 0
+        conn = None
+
+        while failures < self.WORKER_FAILURES:
+            try:
+                segment = todo.get(timeout=0.5)
+            except queue.Empty:
+                # A segment in flight elsewhere may still fail and come back
+                with self.lock:
+                    if self.inflight == 0 and todo.empty():
+                        break
+                continue
+
+            with self.lock:
+                self.inflight += 1
+
+            start, end = segments[segment]
+            try:
+                if conn is None:
+                    sock = socket.create_connection((host, int(port)))
+                    conn = sock.makefile("rwb")
+
+                self._send(conn, segment, start, end)
+                failures = 0
+                msg_signal.emit("Segment %d done on %s\n" % (segment + 1, address))
+            except Exception as e:
+                failures += 1
+                msg_signal.emit("Segment %d failed on %s: %s\n"
+                        % (segment + 1, address, e))
+
+                # Start over with a new connection
+                if conn:
+                    conn.close()
+                conn = None
+
+                with self.lock:
+                    attempts[segment] += 1
+                    if attempts[segment] < self.RETRIES:
+                        # Reassign to whichever worker is free next
+                        todo.put(segment)
+
+            with self.lock:
+                self.inflight -= 1
+
+        if failures >= self.WORKER_FAILURES:
+            msg_signal.emit("Dropping worker %s\n" % address)
+
+        if conn:
+            conn.close()
+
+
+    def run(self, msg_signal):
+        ''' Returns True if every segment was encoded and joined '''
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(self.work_dir)
+
+        try:
+            segments = plan_chunks(self.ff, self.input_file,
+                    self.slice_timestamps, self.segment_secs)
+        except ValueError as e:
+            msg_signal.emit("%s\n" % e)
+            return False
+
+        if self.codec.loudness:
+            msg_signal.emit("Measuring loudness\n")
+            self.loudness = self.ff.measure_loudness(self.input_file,
+                    self.slice_timestamps)
+        msg_signal.emit("%d segments on %d workers\n"
+                % (len(segments), len(self.workers)))
+
+        todo = queue.Queue()
+        for segment in range(len(segments)):
+            todo.put(segment)
+        attempts = [0] * len(segments)
+
+        threads = [Thread(target=self._work,
+            args=(address, segments, todo, attempts, msg_signal))
+            for address in self.workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        files = [self._segment_file(segment) for segment in range(len(segments))]
+        missing = [f for f in files if not os.path.exists(f)]
+        if missing:
+            msg_signal.emit("%d segments could not be encoded\n" % len(missing))
+            return False
+
+        # Segments come from separate encodes, possibly by different builds
+        if self.ff.concat(files, self.output_file, msg_signal, annexb=True):
+            return False
+
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        return True
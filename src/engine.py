@@ -0,0 +1,667 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import heapq
+import itertools
+import os
+import signal
+import sys
+import time
+
+from collections import deque
+from subprocess import Popen, PIPE, DEVNULL
+from threading import Condition, Thread
+
+from ff import FF, parse_progress
+from resources import ResourceProfile, available_cpus
+from tracing import span, traced
+from verify import JobFailure
+
+
+class Signal:
+    ''' Minimal stand-in for pyqtSignal, for use outside of Qt '''
+
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    @traced("Signal.emit", "signal")
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
+
+
+
+class Job:
+    ''' A conversion queued in a JobEngine '''
+
+    # Enums
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    CANCELLED = 4
+    PAUSED = 5
+
+    # As the service and the queue show them
+    STATUS_NAMES = {
+        QUEUED: "queued",
+        RUNNING: "running",
+        DONE: "done",
+        FAILED: "failed",
+        CANCELLED: "cancelled",
+        PAUSED: "paused",
+        }
+
+    # Kinds
+    IO = "io"
+    CPU = "cpu"
+
+    _ids = itertools.count(1)
+
+    # Priorities
+    LOW = -10
+    NORMAL = 0
+    HIGH = 10
+
+    def __init__(self, input_file, outputs, slice_timestamps=(None, None),
+            priority=NORMAL):
+        self.id = next(Job._ids)
+        self.input_file = input_file
+        self.outputs = outputs
+        self.slice_timestamps = slice_timestamps
+        self.priority = priority
+
+        if all(codec.is_stream_copy() for _, codec in outputs):
+            self.kind = Job.IO
+        else:
+            self.kind = Job.CPU
+
+        self.status = Job.QUEUED
+        self.process = None
+        self.duration = None
+        self.encoded = 0.0
+        self.speed = None
+        self.slot = None
+        self.metrics = None
+        self.estimator = None
+        self._pool_key = None
+
+        # Estimated bytes written, and the disk space set aside for them
+        self.size = 0
+        self.reservation = None
+        self.waiting_for_space = False
+
+        # Runs so far, and the JobFailure of the last one if it failed
+        self.attempts = 0
+        self.error = None
+
+        # Signals take (job, ...) so one slot can serve many jobs
+        self.msg_signal = Signal()
+        self.progress_signal = Signal()
+        self.finish_signal = Signal()
+
+
+    def pool_key(self):
+        ''' Jobs are limited per kind and per storage device '''
+        if self._pool_key is None:
+            try:
+                device = os.stat(self.input_file).st_dev
+            except OSError:
+                device = None
+
+            self._pool_key = (self.kind, device)
+
+        return self._pool_key
+
+
+    def progress(self):
+        ''' Fraction done, or None if the duration is unknown '''
+        if not self.duration:
+            return None
+
+        return min(1.0, self.encoded / self.duration)
+
+
+    def eta(self):
+        ''' Seconds left, or None if unknown '''
+        if not self.estimator:
+            return None
+
+        elapsed = self.metrics.wall_secs() if self.metrics else 0.0
+        return self.estimator.eta(self.encoded, self.speed, elapsed)
+
+
+    def suspend(self):
+        ''' Pause the ffmpeg process in place. Returns True on success. '''
+        if not self.process or not hasattr(signal, "SIGSTOP"):
+            return False
+
+        self.process.send_signal(signal.SIGSTOP)
+        return True
+
+
+    def resume(self):
+        if self.process and hasattr(signal, "SIGCONT"):
+            self.process.send_signal(signal.SIGCONT)
+
+
+    def terminate(self):
+        if self.process:
+            self.process.terminate()
+            # A stopped process only handles SIGTERM once continued
+            self.resume()
+
+
+
+class ConcurrencyController:
+    '''
+    Hill-climbing concurrency limit for one pool of jobs.
+
+    Every interval the aggregate throughput of the pool (encoded seconds per
+    wall second) is compared with the previous interval. The limit keeps
+    moving in the same direction while throughput improves and reverses
+    when it gets worse. A system load well above the number of CPUs always
+    steps the limit down.
+    '''
+
+    # Changes smaller than this are noise
+    TOLERANCE = 0.05
+
+    def __init__(self, limit=1, min_limit=1, max_limit=None):
+        ncpus = len(available_cpus())
+
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit or 2 * ncpus
+        self.ncpus = ncpus
+
+        self.direction = 1
+        self.last_throughput = None
+
+
+    def _overloaded(self):
+        try:
+            return os.getloadavg()[0] > 1.5 * self.ncpus
+        except (AttributeError, OSError):
+            # Not available on Windows
+            return False
+
+
+    def update(self, throughput):
+        if self._overloaded():
+            self.direction = -1
+        elif self.last_throughput is not None:
+            if throughput < self.last_throughput * (1 - self.TOLERANCE):
+                # The last step made things worse, go back
+                self.direction = -self.direction
+            elif throughput <= self.last_throughput * (1 + self.TOLERANCE):
+                # No difference, prefer fewer processes
+                self.direction = -1
+
+        self.limit = max(self.min_limit,
+                min(self.max_limit, self.limit + self.direction))
+        self.last_throughput = throughput
+
+        return self.limit
+
+
+
+class Pool:
+    '''
+    Jobs of one kind and device. Queued jobs are kept in a heap by
+    priority, then submission order, so scheduling only looks at the head
+    instead of sorting the whole queue.
+    '''
+
+    _seq = itertools.count()
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.controller = ConcurrencyController(
+                limit=len(available_cpus()) if kind == Job.IO else 1)
+
+        # [-priority, seq, job] entries; removed ones have job None
+        self.queue = []
+        self.entries = {}
+
+        self.running = []
+        self.paused = []
+        self.encoded = 0.0
+        self.sample_encoded = 0.0
+        self.sample_time = time.monotonic()
+
+
+    def throughput(self):
+        ''' Encoded seconds per wall second since the last call '''
+        now = time.monotonic()
+        elapsed = now - self.sample_time
+        throughput = (self.encoded - self.sample_encoded) / max(elapsed, 1e-6)
+
+        self.sample_encoded = self.encoded
+        self.sample_time = now
+
+        return throughput
+
+
+    def saturated(self, queued):
+        return queued and len(self.running) >= self.controller.limit
+
+
+    def push(self, job):
+        entry = [-job.priority, next(Pool._seq), job]
+        self.entries[job] = entry
+        heapq.heappush(self.queue, entry)
+
+
+    def remove(self, job):
+        ''' Take job out of the queue. Returns False if it wasn't queued. '''
+        entry = self.entries.pop(job, None)
+        if entry is None:
+            return False
+
+        entry[2] = None
+        return True
+
+
+    def peek(self):
+        ''' The queued job to run next, or None '''
+        while self.queue and self.queue[0][2] is None:
+            heapq.heappop(self.queue)
+
+        return self.queue[0][2] if self.queue else None
+
+
+    def pop(self):
+        job = self.peek()
+        heapq.heappop(self.queue)
+        del self.entries[job]
+        return job
+
+
+    def queued(self):
+        return list(self.entries)
+
+
+    def free_slot(self):
+        used = set(job.slot for job in self.running)
+        return next(i for i in itertools.count() if i not in used)
+
+
+
+class JobEngine:
+    '''
+    Runs queued jobs as parallel ffmpeg processes.
+
+    Jobs are grouped in pools by kind (IO-bound stream copies or CPU-bound
+    encodes) and by the storage device of their input, and each pool has its
+    own adaptive concurrency limit.
+
+    Higher priority jobs run first. When a pool is full, a queued job
+    preempts the lowest priority running job of its pool, which is paused
+    with SIGSTOP and continued with SIGCONT once there is room again.
+    Queued jobs also wait for disk space in priority order.
+
+    Outputs are verified with the FF's verifier, if it has one, before they
+    are moved into place. Jobs failing in a way that may not happen again
+    (killed, out of space, truncated or corrupt output) go back to the
+    queue up to RETRIES times.
+    '''
+
+    INTERVAL = 5.0
+    RETRIES = 2
+
+    def __init__(self, ff, interval=INTERVAL):
+        self.ff = ff
+        self.interval = interval
+
+        self.pools = {}
+        self.cond = Condition()
+        self.thread = None
+        self.stopped = False
+
+
+    def submit(self, job):
+        job.size = self.ff.estimate_size(job.input_file, job.outputs,
+                job.slice_timestamps)
+        # Stats the input, keep it out of the lock
+        job.pool_key()
+
+        with self.cond:
+            self._pool(job).push(job)
+            self.cond.notify()
+
+        return job
+
+
+    def cancel(self, job):
+        with self.cond:
+            if self._pool(job).remove(job):
+                job.status = Job.CANCELLED
+                job.finish_signal.emit(job)
+                return
+
+            job.status = Job.CANCELLED
+            job.terminate()
+
+
+    def start(self):
+        self.thread = Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        ''' Stop scheduling and terminate the running jobs '''
+        with self.cond:
+            self.stopped = True
+            for pool in self.pools.values():
+                for job in pool.running + pool.paused:
+                    job.status = Job.CANCELLED
+                    job.terminate()
+            self.cond.notify()
+
+
+    def _pool(self, job):
+        key = job.pool_key()
+        if key not in self.pools:
+            self.pools[key] = Pool(job.kind)
+
+        return self.pools[key]
+
+
+    def _loop(self):
+        last_tune = time.monotonic()
+
+        with self.cond:
+            while not self.stopped:
+                if time.monotonic() - last_tune >= self.interval:
+                    self._tune()
+                    last_tune = time.monotonic()
+
+                self._schedule()
+                self.cond.wait(self.interval)
+
+
+    def _tune(self):
+        for pool in self.pools.values():
+            throughput = pool.throughput()
+
+            # Only a saturated pool says anything about the best limit,
+            # otherwise throughput is bounded by the number of jobs
+            if pool.saturated(pool.peek() is not None):
+                limit = pool.controller.update(throughput)
+                print("pool %s: %.2fx with %d jobs, limit now %d"
+                        % (pool.kind, throughput, len(pool.running), limit),
+                        file=sys.stderr)
+
+
+    def _suspend(self, job, pool):
+        if not job.suspend():
+            return False
+
+        job.status = Job.PAUSED
+        pool.running.remove(job)
+        pool.paused.append(job)
+        job.progress_signal.emit(job)
+
+        return True
+
+
+    def _resume(self, job, pool):
+        job.resume()
+
+        job.status = Job.RUNNING
+        pool.paused.remove(job)
+        pool.running.append(job)
+        job.progress_signal.emit(job)
+
+
+    def _preempt(self, job, pool):
+        ''' Pause a lower priority job of pool to make room for job '''
+        victims = [j for j in pool.running
+                if j.priority < job.priority and j.process]
+        if not victims:
+            return False
+
+        # Lowest priority first, then the most recently started
+        victim = min(victims, key=lambda j: (j.priority, -j.id))
+        return self._suspend(victim, pool)
+
+
+    def _schedule(self):
+        for pool in self.pools.values():
+            # Continue paused jobs unless something more urgent is waiting
+            for job in sorted(pool.paused, key=lambda j: -j.priority):
+                waiting = pool.peek()
+                if len(pool.running) < pool.controller.limit and \
+                        (waiting is None or waiting.priority <= job.priority):
+                    self._resume(job, pool)
+
+            while True:
+                job = pool.peek()
+                if job is None:
+                    break
+
+                # Nothing queued after the head can preempt if it can't
+                full = len(pool.running) >= pool.controller.limit
+                if full and not any(j.priority < job.priority and j.process
+                        for j in pool.running):
+                    break
+
+                # Jobs wait for space in priority order
+                if not self._admit(job):
+                    break
+
+                if full and not self._preempt(job, pool):
+                    job.reservation.release()
+                    job.reservation = None
+                    break
+
+                pool.pop()
+                self._launch(job, pool)
+
+
+    def _admit(self, job):
+        ''' Set aside disk space for the outputs of job, if there is enough '''
+        job.reservation = self.ff.scratch.reserve(job.outputs[0][0], job.size)
+        if job.reservation:
+            job.waiting_for_space = False
+            return True
+
+        if not job.waiting_for_space:
+            job.waiting_for_space = True
+            job.msg_signal.emit(job, "Waiting for %d MB of free space\n"
+                    % (job.size >> 20))
+
+        return False
+
+
+    def set_priority(self, job, priority):
+        with self.cond:
+            pool = self._pool(job)
+            queued = pool.remove(job)
+            job.priority = priority
+            if queued:
+                pool.push(job)
+            self.cond.notify()
+
+
+    def _profile(self, job, pool):
+        if job.kind == Job.IO:
+            return ResourceProfile(nice=10,
+                    io_class=ResourceProfile.IO_BEST_EFFORT, io_level=7)
+
+        # Divide the CPUs between the running encodes
+        profiles = ResourceProfile.split(pool.controller.limit, pin=False)
+        return profiles[job.slot % len(profiles)]
+
+
+    def _launch(self, job, pool):
+        job.slot = pool.free_slot()
+        job.status = Job.RUNNING
+        pool.running.append(job)
+
+        Thread(target=lambda: self._run(job, pool), daemon=True).start()
+
+
+    def _encode(self, job, pool, temps):
+        ''' Run ffmpeg for job. Returns (exit code, last log lines). '''
+        job.estimator = self.ff.estimate(job.input_file, job.outputs,
+                job.slice_timestamps)
+        job.duration = job.estimator.total_secs
+
+        profile = self._profile(job, pool)
+        cmd = self.ff.build_cmd(job.input_file, temps,
+                job.slice_timestamps, profile)
+
+        with self.cond:
+            if job.status == Job.CANCELLED:
+                return None, []
+
+            with span("spawn", "process", binary="ffmpeg", job=job.id):
+                job.process = Popen(cmd, stdout=DEVNULL, stderr=PIPE,
+                        universal_newlines=True, **profile.popen_kwargs())
+            job.metrics = self.ff.telemetry.register(job.process.pid,
+                    job.input_file)
+
+        log = deque(maxlen=FF.LOG_LINES)
+        for line in iter(job.process.stderr.readline, ""):
+            log.append(line)
+            job.msg_signal.emit(job, line)
+
+            with span("parse stderr", "stderr"):
+                progress = parse_progress(line)
+            if progress:
+                encoded, speed = progress
+                if speed is not None:
+                    job.speed = speed
+                job.metrics.update_progress(encoded, speed)
+
+                with self.cond:
+                    pool.encoded += max(0.0, encoded - job.encoded)
+                job.encoded = encoded
+                job.progress_signal.emit(job)
+
+        job.process.stderr.close()
+
+        # Final sample while the exited process can still be inspected
+        job.metrics.sample()
+        self.ff.telemetry.unregister(job.metrics)
+
+        return job.process.wait(), log
+
+
+    def _kill(self, job):
+        process = job.process
+        if process and process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+    @traced("JobEngine._run")
+    def _run(self, job, pool):
+        temps = []
+        failure = None
+
+        try:
+            temps = self.ff.scratch.temp_outputs(job.outputs)
+            code, log = self._encode(job, pool, temps)
+            job.reservation.release()
+
+            if code is not None:
+                failure = self._check(job, temps, code, log)
+                if not failure:
+                    self.ff.record_job(job.input_file, job.outputs,
+                            job.slice_timestamps, job.metrics)
+        except Exception as e:
+            # Probing, building the command or spawning failed
+            failure = JobFailure(JobFailure.ERROR, "%s: %s"
+                    % (e.__class__.__name__, e))
+            self._kill(job)
+        finally:
+            # Whatever happened, the job gives back its slot and space
+            job.reservation.release()
+            self._finish(job, pool, temps, failure)
+
+
+    def _finish(self, job, pool, temps, failure):
+        if failure:
+            self.ff.scratch.discard(temps, job.outputs)
+            job.msg_signal.emit(job, "Failed, %s\n" % failure)
+
+        with self.cond:
+            retry = failure is not None and failure.retryable() and \
+                    job.status != Job.CANCELLED and not self.stopped and \
+                    job.attempts < self.RETRIES
+
+            if job in pool.running:
+                pool.running.remove(job)
+            elif job in pool.paused:
+                pool.paused.remove(job)
+            job.process = None
+            job.error = failure
+
+            if retry:
+                job.attempts += 1
+                job.status = Job.QUEUED
+                job.encoded = 0.0
+                pool.push(job)
+            elif job.status != Job.CANCELLED:
+                job.status = Job.FAILED if failure else Job.DONE
+
+            self.cond.notify()
+
+        if retry:
+            job.msg_signal.emit(job, "Retrying (%d/%d)\n"
+                    % (job.attempts, self.RETRIES))
+            job.progress_signal.emit(job)
+            return
+
+        job.finish_signal.emit(job)
+
+
+    @traced("JobEngine._check")
+    def _check(self, job, temps, code, log):
+        ''' The JobFailure of a finished run, None if its outputs are in place '''
+        if code:
+            return JobFailure.from_exit(code, log)
+
+        try:
+            if self.ff.verifier:
+                self.ff.verifier.verify_outputs(job.input_file, temps,
+                        job.outputs, job.slice_timestamps)
+        except JobFailure as e:
+            return e
+
+        try:
+            self.ff.scratch.commit(temps, job.outputs)
+        except OSError as e:
+            return JobFailure(JobFailure.ERROR,
+                    "could not move output into place: %s" % e)
+
+        return None
+
+
+    def jobs(self):
+        ''' Snapshot of the queued, running and paused jobs '''
+        with self.cond:
+            running = [job for pool in self.pools.values()
+                    for job in pool.running + pool.paused]
+            queued = [job for pool in self.pools.values()
+                    for job in pool.queued()]
+            return running + queued
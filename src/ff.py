@@ -14,20 +14,47 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
 import math
 import os
 import pkgutil
+import re
+import shutil
+import signal
 import stat
 import sys
 import tempfile
 
-from subprocess import Popen, PIPE, CalledProcessError
-from threading import Thread
+from collections import deque
+from subprocess import Popen, PIPE, DEVNULL, CalledProcessError
+from threading import Lock, Thread
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 import bin
+from cache import ResultCache
+from capabilities import Capabilities
+from fingerprint import fingerprint
+from history import Estimator, JobHistory, codec_key
+from loudness import LoudnessMeter
+from resources import ResourceProfile
+from scenes import SceneIndexer
+from scratch import ScratchSpace
+from telemetry import Telemetry
+from tracing import span, traced
+from trim import TrimDetector
+from verify import JobFailure, Verifier
+from output_codecs import AVAILABLE_CODECS, SegmentedOutputCodec, is_stream, \
+        stream_fd
 
 class FF:
 
+    # Lines of ffmpeg output kept for classifying failures
+    LOG_LINES = 50
+
     def __init__(self):
         # Setup binaries
 
@@ -38,15 +65,55 @@ class FF:
         if _os.startswith("linux"):
             _os = "linux" # change linux2, etc. to just linux
 
-        self.ffprobe = self._gen_ffbinary("ffprobe-" + _os)
-        self.ffmpeg = self._gen_ffbinary("ffmpeg-" + _os)
+        self.ffprobe, self.ffmpeg, self.capabilities = self._select_binaries(_os)
+        self._codecs = None
 
         self.process = None
         self.thread = None
+        # Analysis pass run() is waiting for, if any
+        self.analyzer = None
+        # Set by terminate(), run() starts no process once it is. Held
+        # while a process starts, so terminate() sees it.
+        self.stopped = False
+        self.lock = Lock()
+
+        # Intermediate files and unfinished outputs
+        self.scratch = ScratchSpace()
+
+        self.cache = ResultCache()
+
+        # Keep the GUI and the rest of the machine responsive during encodes
+        self.resources = ResourceProfile.background()
+
+        # Resource usage of the running process, sampled from /proc
+        self.telemetry = Telemetry()
+        self.metrics = None
+
+        # Finished jobs, for statistics and ETA prediction
+        try:
+            self.history = JobHistory()
+        except Exception as e:
+            print("Job history disabled:", e, file=sys.stderr)
+            self.history = None
+        self.estimator = None
+
+        # Probe results, by input fingerprint
+        self.probes = {}
+
+        # Outputs are checked before they are moved into place if set.
+        # $SIMPLEFF_VERIFY=decode also decodes samples of them.
+        verify = os.getenv("SIMPLEFF_VERIFY")
+        self.verifier = Verifier(self, decode=verify == "decode") \
+                if verify else None
+
+        # Why the last run() failed, None if it succeeded
+        self.error = None
 
 
     def _gen_ffbinary(self, ffname):
         bin_data = pkgutil.get_data("bin", ffname)
+        if bin_data is None:
+            return None
 
         temp = tempfile.NamedTemporaryFile(delete=False)
         temp.write(bin_data)
@@ -55,19 +122,119 @@ class FF:
         # chmod +x
         os.chmod(temp.name, os.stat(temp.name).st_mode | stat.S_IEXEC)
 
-        return temp
+        return Binary(temp.name, extracted=True)
 
 
-    def get_duration(self, filename):
-        p = Popen([
-            self.ffprobe.name,
-            "-v", "error", "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            filename
-            ],
-            stdout=PIPE, stderr=PIPE)
+    def _select_binaries(self, _os):
+        '''
+        (ffprobe, ffmpeg, Capabilities of ffmpeg): the bundled binaries, or
+        those on PATH if none are bundled. $SIMPLEFF_FFMPEG=system prefers
+        the ones on PATH, =auto takes them if they support every format the
+        bundled ones do and encode the default one faster.
+        '''
+        mode = os.getenv("SIMPLEFF_FFMPEG", "bundled")
 
-        (output, _) = p.communicate()
+        system = None
+        paths = [shutil.which("ffprobe"), shutil.which("ffmpeg")]
+        if all(paths):
+            system = [Binary(path) for path in paths]
+
+        bundled = None
+        if mode != "system" or system is None:
+            bundled = [self._gen_ffbinary("ffprobe-" + _os),
+                    self._gen_ffbinary("ffmpeg-" + _os)]
+            if not all(bundled):
+                bundled = None
+
+        if bundled is None and system is None:
+            raise OSError("No ffmpeg binaries bundled or on PATH")
+
+        if bundled is None or (mode == "system" and system):
+            return system + [Capabilities(system[1].name)]
+
+        bundled_caps = Capabilities(bundled[1].name)
+        if mode != "auto" or system is None:
+            return bundled + [bundled_caps]
+
+        system_caps = Capabilities(system[1].name)
+        default = AVAILABLE_CODECS[0]
+
+        if len(system_caps.codecs(AVAILABLE_CODECS)) >= \
+                len(bundled_caps.codecs(AVAILABLE_CODECS)) and \
+                system_caps.supports(default) and \
+                (not bundled_caps.supports(default) or
+                    (system_caps.benchmark(default) or float("inf")) <
+                    (bundled_caps.benchmark(default) or float("inf"))):
+            print("Using", system_caps.version, "from PATH", file=sys.stderr)
+            for binary in bundled:
+                self._try_rm(binary.name)
+            return system + [system_caps]
+
+        return bundled + [bundled_caps]
+
+
+    def codecs(self):
+        '''
+        The output profiles this ffmpeg can write: for every entry of
+        AVAILABLE_CODECS the encoder Capabilities.choose picks, unsupported
+        ones left out. Never benchmarks, see benchmark_codecs().
+        '''
+        if self._codecs is None:
+            self._codecs = self.capabilities.codecs(AVAILABLE_CODECS,
+                    measure=False)
+
+        return self._codecs
+
+
+    def benchmark_codecs(self):
+        '''
+        Run the benchmarks codecs() needs to pick the fastest encoders, if
+        that is asked for. They take a while the first time for an ffmpeg
+        build, so this is for a background thread. Returns True if the
+        choice changed.
+        '''
+        before = [codec.name for codec in self.codecs()]
+        self._codecs = self.capabilities.codecs(AVAILABLE_CODECS)
+
+        return [codec.name for codec in self._codecs] != before
+
+
+    def fingerprint(self, filename):
+        '''
+        Identity of the contents of filename, shared by probes and cached
+        outputs. Streams have none, reading them would consume them.
+        '''
+        if is_stream(filename):
+            raise OSError("Streams have no fingerprint: %s" % filename)
+
+        return fingerprint(filename)
+
+
+    @traced("FF.get_duration", "probe")
+    def get_duration(self, filename):
+        try:
+            key = ("duration", self.fingerprint(filename))
+        except OSError:
+            key = None
+
+        if key in self.probes:
+            return 0, self.probes[key]
+
+        # Probing a stream would consume it
+        if is_stream(filename):
+            return 1, None
+
+        with span("spawn", "process", binary="ffprobe"):
+            p = Popen([
+                self.ffprobe.name,
+                "-v", "error", "-show_entries", "format=duration",
+                "-of", "default=noprint_wrappers=1:nokey=1",
+                filename
+                ],
+                stdout=PIPE, stderr=PIPE)
+
+        with span("ffprobe", "probe", file=filename):
+            (output, _) = p.communicate()
         code = p.returncode
         result = None
 
@@ -76,6 +243,9 @@ class FF:
             try:
                 secs = float(output.decode("utf-8"))
                 result = FFTime(1000 * secs)
+
+                if key:
+                    self.probes[key] = result
             except ValueError:
                 # If no duration found, then probably is not valid file
                 code = 1
@@ -83,32 +253,447 @@ class FF:
         return code, result
 
 
+    def get_media_info(self, filename):
+        '''
+        Properties of the first video stream of filename: a dict with
+        width, height, fps and duration. Empty if filename can't be probed.
+        '''
+        try:
+            key = ("info", self.fingerprint(filename))
+        except OSError:
+            return {}
+
+        if key in self.probes:
+            return self.probes[key]
+
+        p = Popen([
+            self.ffprobe.name,
+            "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=width,height,avg_frame_rate:format=duration",
+            "-of", "json",
+            filename
+            ],
+            stdout=PIPE, stderr=PIPE)
+
+        (output, _) = p.communicate()
+        if p.returncode != 0:
+            return {}
+
+        try:
+            probe = json.loads(output.decode("utf-8"))
+        except ValueError:
+            return {}
+
+        info = {}
+        streams = probe.get("streams") or [{}]
+        info["width"] = streams[0].get("width")
+        info["height"] = streams[0].get("height")
+
+        try:
+            num, _, den = streams[0].get("avg_frame_rate", "").partition("/")
+            info["fps"] = float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            info["fps"] = None
+
+        try:
+            info["duration"] = float(probe["format"]["duration"])
+        except (KeyError, ValueError):
+            info["duration"] = None
+
+        self.probes[key] = info
+        return info
+
+
+    def get_stream_params(self, filename):
+        '''
+        Codec parameters of the first video and audio streams of filename:
+        {"video": {...}, "audio": {...}} with ffprobe's field names. A
+        missing stream type is None. Empty if filename can't be probed.
+        '''
+        try:
+            key = ("params", self.fingerprint(filename))
+        except OSError:
+            return {}
+
+        if key in self.probes:
+            return self.probes[key]
+
+        p = Popen([
+            self.ffprobe.name,
+            "-v", "error",
+            "-show_entries", "stream=codec_type,codec_name,profile,width,"
+                "height,pix_fmt,sample_aspect_ratio,r_frame_rate,sample_rate,"
+                "channels",
+            "-of", "json",
+            filename
+            ],
+            stdout=PIPE, stderr=PIPE)
+
+        (output, _) = p.communicate()
+        if p.returncode != 0:
+            return {}
+
+        try:
+            streams = json.loads(output.decode("utf-8")).get("streams") or []
+        except ValueError:
+            return {}
+
+        params = {"video": None, "audio": None}
+        for stream in streams:
+            codec_type = stream.pop("codec_type", None)
+            if codec_type in params and params[codec_type] is None:
+                params[codec_type] = stream
+
+        self.probes[key] = params
+        return params
+
+
+    def slice_secs(self, input_file, slice_timestamps):
+        ''' Length of the slice in seconds, or None if unknown '''
+        slice_start, slice_time = slice_timestamps
+        if slice_time:
+            return slice_time.to_ms() / 1000
+
+        code, duration = self.get_duration(input_file)
+        if code != 0:
+            return None
+
+        secs = duration.to_ms() / 1000
+        if slice_start:
+            secs -= slice_start.to_ms() / 1000
+
+        return secs
+
+
+    def estimate(self, input_file, outputs, slice_timestamps):
+        ''' Estimator for a job, primed with the speed of similar jobs '''
+        predicted = None
+        if self.history:
+            info = self.get_media_info(input_file)
+            predicted = self.history.average_speed(codec_key(outputs),
+                    info.get("height"))
+
+        return Estimator(self.slice_secs(input_file, slice_timestamps),
+                predicted)
+
+
+    def estimate_size(self, input_file, outputs, slice_timestamps):
+        '''
+        Rough upper bound of the bytes a job writes: the input's share for
+        the slice, for every output
+        '''
+        if is_stream(input_file):
+            return 0
+
+        try:
+            size = os.path.getsize(input_file)
+        except OSError:
+            return 0
+
+        code, duration = self.get_duration(input_file)
+        secs = self.slice_secs(input_file, slice_timestamps)
+        if code == 0 and secs is not None and duration.to_ms() > 0:
+            size = size * min(1.0, secs * 1000 / duration.to_ms())
+
+        return int(size) * len(outputs)
+
+
+    def record_job(self, input_file, outputs, slice_timestamps, metrics):
+        ''' Add a successful job to the history '''
+        if not self.history or not metrics:
+            return
+
+        try:
+            self.history.record(self.fingerprint(input_file), input_file,
+                    self.get_media_info(input_file), outputs,
+                    self.slice_secs(input_file, slice_timestamps) or 0.0,
+                    metrics.wall_secs(), metrics.speed)
+        except Exception as e:
+            print("Could not record job:", e, file=sys.stderr)
+
+
+    def get_keyframes(self, filename):
+        '''
+        Timestamps (in seconds) of the video keyframes of filename. Only
+        packet headers are read, nothing is decoded.
+        '''
+        if is_stream(filename):
+            return []
+
+        p = Popen([
+            self.ffprobe.name,
+            "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "packet=pts_time,flags",
+            "-of", "csv=print_section=0",
+            filename
+            ],
+            stdout=PIPE, stderr=PIPE, universal_newlines=True)
+
+        keyframes = []
+        for line in p.stdout:
+            fields = line.strip().split(",")
+            if len(fields) < 2 or "K" not in fields[1]:
+                continue
+
+            try:
+                keyframes.append(float(fields[0]))
+            except ValueError:
+                # Packets without a pts are reported as "N/A"
+                pass
+
+        p.stdout.close()
+        p.wait()
+
+        return sorted(keyframes)
+
+
+    def get_stream_types(self, filename):
+        ''' Types ("video", "audio", ...) of the streams of filename '''
+        try:
+            key = ("streams", self.fingerprint(filename))
+        except OSError:
+            return []
+
+        if key in self.probes:
+            return self.probes[key]
+
+        p = Popen([
+            self.ffprobe.name,
+            "-v", "error", "-show_entries", "stream=codec_type",
+            "-of", "csv=print_section=0",
+            filename
+            ],
+            stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        out, _ = p.communicate()
+
+        if p.returncode:
+            return []
+
+        self.probes[key] = [line.strip() for line in out.splitlines()
+                if line.strip()]
+        return self.probes[key]
+
+
+    def detect_trim(self, filename, on_start=None):
+        '''
+        Suggested (start, end) seconds of filename without its black and
+        silent lead-in and lead-out, or None. on_start is called with the
+        TrimDetector, which can be cancelled from another thread.
+
+        The loudness of the whole file is measured in the same pass, unless
+        it is already known.
+        '''
+        try:
+            key = ("trim", self.fingerprint(filename))
+        except OSError:
+            return None
+
+        if key in self.probes:
+            return self.probes[key]
+
+        loudness_key = self._loudness_key(filename, (None, None))
+        loudness = self._load_analysis(loudness_key) is None
+
+        types = self.get_stream_types(filename)
+        detector = TrimDetector(self, filename,
+                video="video" in types, audio="audio" in types,
+                loudness=loudness)
+        if on_start:
+            on_start(detector)
+
+        result = detector.run()
+        if result is not None:
+            self.probes[key] = result
+        if detector.measured_loudness:
+            self._store_analysis(loudness_key, detector.measured_loudness)
+
+        return result
+
+
+    def _loudness_key(self, filename, slice_timestamps):
+        slice_ms = tuple(None if ts is None else ts.to_ms()
+                for ts in slice_timestamps)
+
+        return ("loudness", self.fingerprint(filename), slice_ms)
+
+
+    def _load_analysis(self, key):
+        ''' Result of an analysis pass from this session or the cache '''
+        if key in self.probes:
+            return self.probes[key]
+
+        result = self.cache.load_analysis(list(key))
+        if result is not None:
+            self.probes[key] = result
+
+        return result
+
+
+    def _store_analysis(self, key, result):
+        self.probes[key] = result
+        try:
+            self.cache.store_analysis(list(key), result)
+        except OSError as e:
+            print("Could not store analysis:", e, file=sys.stderr)
+
+
+    def measure_loudness(self, filename, slice_timestamps=(None, None),
+            on_start=None):
+        '''
+        loudnorm measurement of the audio of a slice of filename, for
+        normalizing it (OutputCodec.loudness), or None. Measurements are
+        kept in the result cache, so every output format and later exports
+        of the same slice reuse them. on_start is called with the analyzer
+        (which has cancel()) before it runs.
+        '''
+        try:
+            key = self._loudness_key(filename, slice_timestamps)
+        except OSError:
+            # A stream can't be read twice
+            return None
+
+        measured = self._load_analysis(key)
+        if measured is not None:
+            return measured
+
+        if "audio" not in self.get_stream_types(filename):
+            return None
+
+        # Only the audio is decoded. Auto trim also measures the whole file,
+        # but decodes the video too.
+        meter = LoudnessMeter(self, filename, slice_timestamps)
+        if on_start:
+            on_start(meter)
+
+        measured = meter.run()
+        if measured is not None:
+            self._store_analysis(key, measured)
+
+        return measured
+
+
+    def index_scenes(self, filename, on_start=None, on_progress=None):
+        '''
+        Sorted array of the scene cuts (in seconds) of filename, or None.
+        on_start is called with the SceneIndexer, whose cuts() can be read
+        and which can be cancelled from other threads; on_progress(indexer)
+        is called as the index grows.
+        '''
+        try:
+            key = ("scenes", self.fingerprint(filename))
+        except OSError:
+            return None
+
+        if key in self.probes:
+            return self.probes[key]
+
+        indexer = SceneIndexer(self, filename)
+        if on_start:
+            on_start(indexer)
+
+        cuts = indexer.run(on_progress)
+        if cuts is not None:
+            self.probes[key] = cuts
+
+        return cuts
+
+
+    def open_raw(self, input_file, outputs, input_args=(), log=False):
+        '''
+        Start ffmpeg decoding input_file into raw streams, for analyzers.
+        outputs is a list of ffmpeg output argument lists (e.g. ["-map",
+        "0:v:0", "-f", "rawvideo"]), each of which gets its own pipe.
+        With log=True, filters reporting results in ffmpeg's log (loudnorm)
+        can be read from RawProcess.log. Returns a RawProcess.
+        '''
+        level = ["-v", "info", "-nostats", "-hide_banner"] if log else \
+                ["-v", "error"]
+        cmd = [self.ffmpeg.name, "-nostdin"] + level + \
+                list(input_args) + ["-i", input_file]
+
+        return RawProcess(cmd, outputs, log)
+
+
     # Adapted from http://stackoverflow.com/a/4417735
-    def _execute_gen(self, process):
+    def _execute_gen(self, process, metrics=None):
         for stderr_line in iter(process.stderr.readline, ""):
+            if metrics:
+                with span("parse stderr", "stderr"):
+                    progress = parse_progress(stderr_line)
+                    if progress:
+                        metrics.update_progress(*progress)
+
             yield stderr_line
 
         process.stderr.close()
+
+        if metrics:
+            # Until it is reaped, an exited process still reports its
+            # final CPU time
+            metrics.sample()
+            self.telemetry.unregister(metrics)
+
         return_code = process.wait()
 
         if return_code:
             raise CalledProcessError(return_code, "")
 
 
-    def _execute(self, process, msg_signal, finish_signal):
+    def _execute(self, process, msg_signal, finish_signal, on_success=None,
+            metrics=None, on_failure=None):
+        '''
+        Forward the output of process to msg_signal, then call on_success,
+        which may raise JobFailure, or on_failure. The failure is reported
+        and kept in self.error.
+        '''
+        log = deque(maxlen=self.LOG_LINES)
+        self.error = None
+
         try:
-            for line in self._execute_gen(process):
-                msg_signal.emit(line)
-        except CalledProcessError:
-            # Can either result when ffmpeg fails for some reason(?)
-            #   OR when process terminated. Should differentiate?
-            pass
+            with span("encode", "process", pid=process.pid):
+                for line in self._execute_gen(process, metrics):
+                    log.append(line)
+                    with span("emit", "signal"):
+                        msg_signal.emit(line)
+
+            if on_success:
+                with span("finish outputs"):
+                    on_success()
+        except CalledProcessError as e:
+            self.error = JobFailure.from_exit(e.returncode, log)
+        except JobFailure as e:
+            self.error = e
+
+        if self.error:
+            msg_signal.emit("\nFailed, %s\n" % self.error)
+            if on_failure:
+                on_failure()
+
+        # Nothing left to pause or stop
+        if self.process is process:
+            self.process = None
 
         finish_signal.emit()
 
 
-    def run(self, input_file, output_file, output_codecs, slice_timestamps, msg_signal, finish_signal):
-        print("run:", slice_timestamps)
+    def build_cmd(self, input_file, outputs, slice_timestamps, resources=None,
+            loudness=None):
+        '''
+        ffmpeg command line converting input_file into one or more outputs
+        with a single process, so the input is only demuxed and decoded once.
+
+        outputs is a list of (output_file, OutputCodec) pairs. Inputs and
+        outputs can also be streams: "-" or "pipe:" for stdin/stdout,
+        "fd:N" for another file descriptor, or a FIFO.
+
+        Outputs normalizing loudness use the loudness measurement given, or
+        measure the slice first (this blocks). An empty measurement falls
+        back to single pass normalization.
+        '''
+        resources = resources or self.resources
+
+        if loudness is None and any(codec.loudness for _, codec in outputs):
+            loudness = self.measure_loudness(input_file, slice_timestamps)
 
         slice_start, slice_time = [], []
         if slice_timestamps[0]:
@@ -116,22 +701,368 @@ class FF:
         if slice_timestamps[1]:
             slice_time = ["-t", str(slice_timestamps[1])]
 
+        input_fd = stream_fd(input_file, 0)
+        if input_fd is not None:
+            input_file = "pipe:%d" % input_fd
+
+        # Only let ffmpeg read stdin when it is the input
+        nostdin = [] if input_fd == 0 else ["-nostdin"]
+
+        # A stream can't be seeked, it has to be decoded up to the start
+        slice_input = slice_start
+        if is_stream(input_file):
+            slice_input = []
+            slice_time = slice_start + slice_time
+
+
+        cmd = [self.ffmpeg.name] + nostdin + resources.global_args() + \
+                slice_input + ["-y", "-i", input_file]
+
+        # Output options only apply to the output file that follows them,
+        # so the slice length must be repeated for every output
+        for output_file, output_codecs in outputs:
+            output_fd = stream_fd(output_file, 1)
+            if output_fd is not None:
+                output_file = "pipe:%d" % output_fd
+
+            # The ladder depends on the source size and streams
+            if isinstance(output_codecs, SegmentedOutputCodec) and \
+                    not is_stream(input_file):
+                output_codecs = output_codecs.for_source(
+                        self.get_stream_params(input_file))
+
+            cmd += slice_time + resources.output_args() + \
+                    output_codecs.output_args(output_file, loudness)
 
-        cmd = [self.ffmpeg.name] + \
-                slice_start + ["-y", "-i", input_file] + slice_time + \
-                output_codecs.args + [output_file]
+        return resources.wrap(cmd)
 
-        print(" ".join(cmd))
 
-        self.process = Popen(cmd, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    def stdio(self, input_file, outputs):
+        '''
+        Popen arguments connecting ffmpeg to the streams among input_file
+        and outputs. stdin and stdout are inherited when they are the
+        input or an output, so the pipes apply backpressure directly.
+        '''
+        kwargs = {"stdin": DEVNULL, "stdout": PIPE}
+        pass_fds = []
 
-        self.thread = Thread(target=lambda: self._execute(self.process, msg_signal, finish_signal))
+        input_fd = stream_fd(input_file, 0)
+        if input_fd == 0:
+            kwargs["stdin"] = None
+        elif input_fd is not None:
+            pass_fds.append(input_fd)
+
+        for output_file, _ in outputs:
+            output_fd = stream_fd(output_file, 1)
+            if output_fd == 1:
+                kwargs["stdout"] = None
+            elif output_fd is not None:
+                pass_fds.append(output_fd)
+
+        if pass_fds:
+            kwargs["pass_fds"] = pass_fds
+
+        return kwargs
+
+
+    def _fetch_cached(self, input_file, outputs, slice_timestamps, msg_signal):
+        '''
+        Satisfy outputs from the result cache where possible.
+
+        Returns the outputs that still need to be encoded and the cache keys
+        to store them under
+        '''
+        missing, keys = [], []
+
+        for output_file, output_codecs in outputs:
+            # Segmented outputs are many files, they are not cached
+            if isinstance(output_codecs, SegmentedOutputCodec):
+                missing.append((output_file, output_codecs))
+                keys.append(None)
+                continue
+
+            # The cache only saves work, a broken one never fails the job
+            key, hit = None, False
+            try:
+                key = self.cache.key(input_file, output_codecs, slice_timestamps)
+                hit = self.cache.fetch(key, output_codecs, output_file)
+            except OSError as e:
+                print("Could not read cache:", e, file=sys.stderr)
+                if key:
+                    # What fetch() may have copied so far
+                    self._try_rm(output_file)
+
+            if hit:
+                msg_signal.emit("Using cached result for %s\n" % output_file)
+            else:
+                missing.append((output_file, output_codecs))
+                keys.append(key)
+
+        return missing, keys
+
+
+    def _store_cached(self, outputs, keys):
+        for (output_file, output_codecs), key in zip(outputs, keys):
+            if not key:
+                continue
+
+            try:
+                self.cache.store(key, output_codecs, output_file)
+            except OSError as e:
+                print("Could not store in cache:", e, file=sys.stderr)
+
+
+    @traced("FF.run")
+    def run(self, input_file, outputs, slice_timestamps, msg_signal, finish_signal,
+            resources=None):
+        print("run:", slice_timestamps, file=sys.stderr)
+
+        self.error = None
+        with self.lock:
+            self.stopped = False
+
+        resources = resources or self.resources
+
+        streams = [f for f in [input_file] + [o for o, _ in outputs]
+                if is_stream(f)]
+
+        keys = None
+        if self.cache.enabled and not streams:
+            outputs, keys = self._fetch_cached(input_file, outputs,
+                    slice_timestamps, msg_signal)
+
+            if not outputs:
+                finish_signal.emit()
+                return
+
+        # Written under a temporary name and renamed when complete. The
+        # rename also replaces outputs hardlinked to the cache by an earlier
+        # hit instead of writing through them.
+        temps = self.scratch.temp_outputs(outputs)
+        for (temp, _), (output_file, _) in zip(temps, outputs):
+            if temp == output_file and not is_stream(output_file):
+                self._try_rm(output_file)
+
+        self.estimator = self.estimate(input_file, outputs, slice_timestamps)
+
+        def on_failure():
+            self.scratch.discard(temps, outputs)
+
+        def on_analyzer(analyzer):
+            with self.lock:
+                self.analyzer = analyzer
+                if self.stopped:
+                    analyzer.cancel()
+
+        @traced("FF.run job")
+        def start():
+            # Normalizing loudness takes a measuring pass first
+            loudness = None
+            if any(codec.loudness for _, codec in outputs):
+                msg_signal.emit("Measuring loudness\n")
+                with span("measure loudness", "probe"):
+                    loudness = self.measure_loudness(input_file,
+                            slice_timestamps, on_analyzer)
+
+            with span("build_cmd"):
+                cmd = self.build_cmd(input_file, temps, slice_timestamps,
+                        resources, loudness or {})
+
+            print(" ".join(cmd), file=sys.stderr)
+
+            # terminate() may have come before or during the measurement
+            with self.lock:
+                self.analyzer = None
+                stopped = self.stopped
+                if not stopped:
+                    with span("spawn", "process", binary="ffmpeg"):
+                        self.process = Popen(cmd, stderr=PIPE,
+                                universal_newlines=True,
+                                **self.stdio(input_file, outputs),
+                                **resources.popen_kwargs())
+
+            if stopped:
+                self.error = JobFailure(JobFailure.KILLED,
+                        "stopped before encoding started")
+                on_failure()
+                finish_signal.emit()
+                return
+
+            self.metrics = self.telemetry.register(self.process.pid, input_file)
+            metrics = self.metrics
+
+            def on_success():
+                if self.verifier:
+                    self.verifier.verify_outputs(input_file, temps, outputs,
+                            slice_timestamps)
+
+                try:
+                    self.scratch.commit(temps, outputs)
+                except OSError as e:
+                    raise JobFailure(JobFailure.ERROR,
+                            "could not move output into place: %s" % e)
+
+                self.record_job(input_file, outputs, slice_timestamps, metrics)
+                if keys:
+                    self._store_cached(outputs, keys)
+
+            self._execute(self.process, msg_signal, finish_signal, on_success,
+                    metrics, on_failure)
+
+        self.thread = Thread(target=start)
         self.thread.start()
 
 
+    def run_sync(self, cmd, msg_signal, resources=None, stdio=None):
+        '''
+        Run cmd in the calling thread, forwarding its output to msg_signal.
+        The process can still be stopped with terminate(). stdio is the
+        result of FF.stdio() if cmd reads or writes streams.
+
+        Returns the exit code
+        '''
+        resources = resources or self.resources
+        stdio = stdio or {"stdin": DEVNULL, "stdout": PIPE}
+
+        print(" ".join(cmd), file=sys.stderr)
+
+        with span("spawn", "process", binary="ffmpeg"):
+            process = Popen(cmd, stderr=PIPE, universal_newlines=True,
+                    **stdio, **resources.popen_kwargs())
+        self.process = process
+        self.metrics = self.telemetry.register(process.pid, cmd[-1])
+
+        try:
+            with span("encode", "process", pid=process.pid):
+                for line in self._execute_gen(process, self.metrics):
+                    with span("emit", "signal"):
+                        msg_signal.emit(line)
+        except CalledProcessError as e:
+            return e.returncode
+        finally:
+            if self.process is process:
+                self.process = None
+
+        return 0
+
+
+    def concat(self, files, output_file, msg_signal, resources=None,
+            annexb=False):
+        '''
+        Losslessly join files, which must share their codec parameters,
+        into output_file with the concat demuxer. Returns the exit code.
+
+        With annexb=True, H.264 and HEVC files are first remuxed to MPEG-TS
+        with their parameter sets in band. Files encoded separately (e.g.
+        re-encoded parts joined to stream copied ones) have different
+        extradata, and the concat demuxer would decode them all with that
+        of the first file.
+        '''
+        resources = resources or self.resources
+        work_dir = self.scratch.mkdtemp("concat-")
+
+        try:
+            args = []
+            if annexb:
+                files, args = self._annexb_parts(files, output_file, work_dir,
+                        msg_signal, resources)
+                if files is None:
+                    return 1
+
+            list_file = os.path.join(work_dir, "list.txt")
+            with open(list_file, "w") as f:
+                for filename in files:
+                    path = os.path.abspath(filename).replace("'", "'\\''")
+                    f.write("file '%s'\n" % path)
+
+            temp = self.scratch.temp_output(output_file)
+            cmd = resources.wrap([self.ffmpeg.name, "-y", "-f", "concat",
+                "-safe", "0", "-i", list_file, "-c", "copy"] + args + [temp])
+
+            try:
+                code = self.run_sync(cmd, msg_signal, resources)
+                if code == 0:
+                    os.replace(temp, output_file)
+                return code
+            finally:
+                self._try_rm(temp)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+    # Bitstream filters moving parameter sets in band, by ffprobe codec name
+    ANNEXB_FILTERS = {"h264": "h264_mp4toannexb", "hevc": "hevc_mp4toannexb"}
+
+    # Extensions of the MP4 family muxers (mp4, mov, ipod, 3gp), which store
+    # AAC without ADTS headers
+    ASC_EXTENSIONS = {".mp4", ".m4v", ".m4a", ".mov", ".3gp", ".3g2"}
+
+    def _annexb_parts(self, files, output_file, work_dir, msg_signal,
+            resources):
+        '''
+        (files to concat, extra output args) for concat(annexb=True): the
+        files as MPEG-TS in work_dir, or as they are if they aren't H.264 or
+        HEVC. (None, None) if remuxing fails.
+        '''
+        params = self.get_stream_params(files[0])
+        video, audio = params.get("video"), params.get("audio")
+        bsf = self.ANNEXB_FILTERS.get(video.get("codec_name")) if video else None
+        if not bsf:
+            return files, []
+
+        parts = []
+        for i, filename in enumerate(files):
+            part = os.path.join(work_dir, "part-%05d.ts" % i)
+            cmd = resources.wrap([self.ffmpeg.name, "-v", "error", "-y",
+                "-i", filename, "-map", "0:v:0", "-map", "0:a:0?",
+                "-c", "copy", "-bsf:v", bsf, "-f", "mpegts", part])
+            if self.run_sync(cmd, msg_signal, resources):
+                return None, None
+            parts.append(part)
+
+        # ADTS headers, which MPEG-TS adds, aren't allowed in MP4. Other
+        # muxers (e.g. back to MPEG-TS) keep them as they are
+        args = []
+        ext = os.path.splitext(output_file)[1].lower()
+        if audio and audio.get("codec_name") == "aac" and \
+                ext in self.ASC_EXTENSIONS:
+            args = ["-bsf:a", "aac_adtstoasc"]
+
+        return parts, args
+
+
+    def suspend(self):
+        '''
+        Pause the running process in place (SIGSTOP). Returns False if
+        there is nothing to pause or the platform can't.
+        '''
+        process = self.process
+        if not process or process.poll() is not None or \
+                not hasattr(signal, "SIGSTOP"):
+            return False
+
+        process.send_signal(signal.SIGSTOP)
+        return True
+
+
+    def resume(self):
+        process = self.process
+        if process and process.poll() is None and hasattr(signal, "SIGCONT"):
+            process.send_signal(signal.SIGCONT)
+
+
     def terminate(self):
+        with self.lock:
+            self.stopped = True
+            analyzer = self.analyzer
+
+        if analyzer:
+            analyzer.cancel()
+
         if self.process:
             self.process.terminate()
+            # A stopped process only handles SIGTERM once continued
+            self.resume()
             self.process = None
 
 
@@ -144,10 +1075,240 @@ class FF:
 
     def cleanup(self):
         ''' Delete temporary files '''
-        print("Cleaning up")
+        print("Cleaning up", file=sys.stderr)
 
-        self._try_rm(self.ffprobe.name)
-        self._try_rm(self.ffmpeg.name)
+        for binary in (self.ffprobe, self.ffmpeg):
+            # Never the ones from PATH
+            if binary.extracted:
+                self._try_rm(binary.name)
+        self.scratch.close()
+
+
+
+class Binary:
+    ''' An ffmpeg executable, extracted ones are deleted by FF.cleanup() '''
+
+    def __init__(self, name, extracted=False):
+        self.name = name
+        self.extracted = extracted
+
+
+
+PROGRESS_TIME = re.compile(r"time=\s*(-?)(\d+):(\d+):(\d+(?:\.\d+)?)")
+PROGRESS_SPEED = re.compile(r"speed=\s*(\d+(?:\.\d+)?)x")
+
+def parse_progress(line):
+    '''
+    Parse an ffmpeg progress line ("frame=... time=00:01:02.34 ... speed=2.1x")
+
+    Returns (encoded seconds, speed), or None if line is not a progress line.
+    speed is None until ffmpeg reports it.
+    '''
+    match = PROGRESS_TIME.search(line)
+    if not match:
+        return None
+
+    sign, hours, mins, secs = match.groups()
+    encoded = 3600 * int(hours) + 60 * int(mins) + float(secs)
+    if sign:
+        encoded = 0.0
+
+    match = PROGRESS_SPEED.search(line)
+    speed = float(match.group(1)) if match else None
+
+    return encoded, speed
+
+
+
+def read_full(f, view):
+    ''' readinto() until view is full or the stream ends. Returns the bytes read. '''
+    total = 0
+    while total < len(view):
+        n = f.readinto(view[total:])
+        if not n:
+            break
+        total += n
+
+    return total
+
+
+
+class RawProcess:
+    '''
+    An ffmpeg process writing raw outputs to pipes: the first to stdout,
+    the others to extra pipes.
+
+    ffmpeg only runs as fast as its pipes are read, so a slow reader
+    throttles decoding instead of buffering frames in memory. Every pipe
+    must be read (from its own thread if there are several) or closed.
+    '''
+
+    # Lines of log kept, enough for a loudnorm report
+    LOG_LINES = 200
+
+    def __init__(self, cmd, outputs, log=False):
+        cmd = list(cmd)
+        read_fds, write_fds = [], []
+
+        for i, args in enumerate(outputs):
+            if i == 0:
+                cmd += list(args) + ["pipe:1"]
+            else:
+                r, w = os.pipe()
+                read_fds.append(r)
+                write_fds.append(w)
+                cmd += list(args) + ["pipe:%d" % w]
+
+        self.stopped = False
+        # Set by close(), None if stopped early
+        self.returncode = None
+        try:
+            self.process = Popen(cmd, stdin=DEVNULL, stdout=PIPE,
+                    stderr=PIPE if log else DEVNULL, pass_fds=write_fds)
+        except OSError:
+            for fd in read_fds:
+                os.close(fd)
+            raise
+        finally:
+            for fd in write_fds:
+                os.close(fd)
+
+        self.streams = [self.process.stdout] + \
+                [open(fd, "rb", buffering=0) for fd in read_fds]
+
+        # Drained as it comes, a full stderr pipe would block ffmpeg
+        self.log = deque(maxlen=self.LOG_LINES)
+        self.log_thread = None
+        if log:
+            self.log_thread = Thread(target=self._read_log, daemon=True)
+            self.log_thread.start()
+
+
+    def _read_log(self):
+        for line in iter(self.process.stderr.readline, b""):
+            self.log.append(line.decode("utf-8", "replace"))
+        self.process.stderr.close()
+
+
+    def reader(self, i, frame_bytes, rate, shape=None, dtype=None, **kwargs):
+        ''' FrameReader for output i '''
+        return FrameReader(self.streams[i], frame_bytes, rate, shape, dtype,
+                **kwargs)
+
+
+    def stop(self):
+        ''' Terminate ffmpeg early, readers then see the end of their streams '''
+        self.stopped = True
+        if self.process.poll() is None:
+            self.process.terminate()
+
+
+    def close(self):
+        ''' Returns the exit code, or None if stopped early '''
+        for stream in self.streams:
+            stream.close()
+
+        code = self.process.wait()
+        if self.log_thread:
+            self.log_thread.join()
+        self.returncode = None if self.stopped else code
+        return self.returncode
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        if args[0] is not None:
+            self.stop()
+        self.close()
+
+
+
+class FrameBlock:
+    '''
+    Consecutive frames from a FrameReader. data (a memoryview) and array
+    (a NumPy view, if a dtype was given) point into the reader's ring and
+    are overwritten once it wraps around.
+    '''
+
+    __slots__ = ("index", "count", "rate", "data", "array")
+
+    def __init__(self, index, count, rate, data, array):
+        self.index = index
+        self.count = count
+        self.rate = rate
+        self.data = data
+        self.array = array
+
+
+    def time(self, i=0):
+        ''' Timestamp in seconds of frame i of the block '''
+        return (self.index + i) / self.rate
+
+
+    def timestamps(self):
+        return (self.index + np.arange(self.count)) / self.rate
+
+
+
+class FrameReader:
+    '''
+    Reads fixed size frames (rawvideo frames or windows of PCM samples)
+    from a pipe with readinto() into a ring of preallocated buffers, block
+    frames at a time. Nothing is allocated per frame: iterating yields
+    FrameBlocks that view the ring, so the last ring - 1 blocks stay valid.
+
+    rate is in frames per second and gives the timestamps. With a NumPy
+    dtype, blocks also expose their frames as an array of shape
+    (count,) + shape.
+    '''
+
+    BLOCK = 64
+    RING = 2
+
+    def __init__(self, f, frame_bytes, rate, shape=None, dtype=None,
+            block=BLOCK, ring=RING):
+        self.f = f
+        self.frame_bytes = frame_bytes
+        self.rate = rate
+        self.block = block
+
+        self.ring = []
+        for _ in range(ring):
+            buf = bytearray(frame_bytes * block)
+            array = None
+            if dtype is not None:
+                array = np.frombuffer(buf, dtype=dtype).reshape(
+                        (block,) + tuple(shape or (-1,)))
+            self.ring.append((memoryview(buf), array))
+
+        # Frames read so far
+        self.index = 0
+        self.stopped = False
+
+
+    def __iter__(self):
+        slot = 0
+        while not self.stopped:
+            view, array = self.ring[slot]
+
+            count = read_full(self.f, view) // self.frame_bytes
+            if count == 0:
+                break
+
+            yield FrameBlock(self.index, count, self.rate,
+                    view[:count * self.frame_bytes],
+                    array[:count] if array is not None else None)
+
+            self.index += count
+            slot = (slot + 1) % len(self.ring)
+
+
+    def stop(self):
+        ''' Stop iterating after the current block '''
+        self.stopped = True
 
 
 
@@ -218,3 +1379,59 @@ class FFTime:
     def to_ms(self):
         return self.milliseconds
 
+
+    def parse(text, fps=None):
+        '''
+        Parse a time: seconds ("83.5"), "MM:SS(.mmm)", "HH:MM:SS(.mmm)" or
+        an SMPTE timecode "HH:MM:SS:FF" at fps frames per second. A ";"
+        before the frames means NTSC drop-frame ("HH:MM:SS;FF" at 29.97).
+
+        Raises ValueError if text is none of these.
+        '''
+        text = text.strip()
+        if FFTime.isfloat(text):
+            if not math.isfinite(float(text)) or float(text) < 0:
+                raise ValueError("Not a time: %s" % text)
+            return FFTime(1000 * float(text))
+
+        drop_frame = ";" in text
+        parts = text.replace(";", ":").split(":")
+
+        try:
+            if len(parts) == 4:
+                hours, mins, secs, frames = [int(p) for p in parts]
+            elif len(parts) in (2, 3):
+                hours, mins, frames = 0, 0, None
+                if len(parts) == 3:
+                    hours = int(parts[0])
+                mins, secs = int(parts[-2]), float(parts[-1])
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError("Not a time: %s" % text)
+
+        if mins >= 60 or secs >= 60 or min(hours, mins, secs) < 0 or \
+                (frames is not None and frames < 0):
+            raise ValueError("Not a time: %s" % text)
+
+        if frames is None:
+            return FFTime(1000 * (3600 * hours + 60 * mins + secs))
+
+        if drop_frame:
+            # Frame numbers 0 and 1 are skipped every minute except every
+            # tenth, so the timecode keeps up with 30000/1001 fps
+            if frames >= 30 or (secs == 0 and frames < 2 and mins % 10):
+                raise ValueError("Not a drop-frame timecode: %s" % text)
+
+            total_mins = 60 * hours + mins
+            count = (60 * total_mins + secs) * 30 + frames
+            count -= 2 * (total_mins - total_mins // 10)
+            return FFTime(count * 1001 / 30)
+
+        if not fps:
+            raise ValueError("Timecode %s needs a frame rate" % text)
+        if frames >= math.ceil(fps):
+            raise ValueError("Not a time: %s" % text)
+
+        return FFTime(1000 * (3600 * hours + 60 * mins + secs + frames / fps))
+
@@ -0,0 +1,101 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import mmap
+import os
+
+from collections import OrderedDict
+from threading import Lock
+
+
+SAMPLES = 16
+BLOCK_SIZE = 1 << 16
+
+# Least recently used digests are forgotten past MEMO_SIZE
+MEMO_SIZE = 4096
+_memo = OrderedDict()
+_memo_lock = Lock()
+
+
+def _sampled_digest(f, size, samples, block_size):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(b"sampled:%d:%d:%d:" % (size, samples, block_size))
+
+    if size <= (samples + 2) * block_size:
+        # Small enough to just hash everything
+        h.update(f.read())
+        return h.hexdigest()
+
+    # Head, tail and evenly spaced blocks in between
+    stride = (size - block_size) // (samples + 1)
+    offsets = [0] + [stride * i for i in range(1, samples + 1)] + \
+            [size - block_size]
+
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for offset in offsets:
+            h.update(mm[offset:offset + block_size])
+
+    return h.hexdigest()
+
+
+def _full_digest(f, size):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(b"full:%d:" % size)
+
+    buf = bytearray(1 << 20)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        h.update(view[:n])
+
+    return h.hexdigest()
+
+
+def fingerprint(filename, full=False, samples=SAMPLES, block_size=BLOCK_SIZE):
+    '''
+    Hex digest identifying the contents of filename.
+
+    By default only the size, head, tail and evenly spaced sample blocks are
+    hashed, so multi-GB files are identified without reading them fully. With
+    full=True every byte is hashed, for verification.
+
+    Results are memoized by (dev, inode, size, mtime_ns), for the last
+    MEMO_SIZE files.
+    '''
+    st = os.stat(filename)
+    memo_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+            full, samples, block_size)
+
+    with _memo_lock:
+        if memo_key in _memo:
+            _memo.move_to_end(memo_key)
+            return _memo[memo_key]
+
+    with open(filename, "rb") as f:
+        if full:
+            digest = _full_digest(f, st.st_size)
+        else:
+            digest = _sampled_digest(f, st.st_size, samples, block_size)
+
+    with _memo_lock:
+        _memo[memo_key] = digest
+        if len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+
+    return digest
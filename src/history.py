@@ -0,0 +1,169 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import sqlite3
+import time
+
+from threading import Lock
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    finished REAL,
+    fingerprint TEXT,
+    input TEXT,
+    width INTEGER,
+    height INTEGER,
+    fps REAL,
+    duration REAL,
+    codec TEXT,
+    args TEXT,
+    slice_secs REAL,
+    wall_secs REAL,
+    speed REAL,
+    output_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_codec_height ON jobs (codec, height);
+'''
+
+
+def codec_key(outputs):
+    ''' Jobs with the same output codecs are comparable '''
+    return " + ".join(codec.name for _, codec in outputs)
+
+
+class JobHistory:
+    '''
+    SQLite store of finished jobs, used for throughput statistics and to
+    predict how long a new job will take.
+    '''
+
+    def __init__(self, path=None):
+        if path is None:
+            base = os.getenv("XDG_DATA_HOME",
+                    os.path.join(os.path.expanduser("~"), ".local", "share"))
+            path = os.path.join(base, "simpleff", "history.sqlite")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+
+    def record(self, fingerprint, input_file, info, outputs, slice_secs,
+            wall_secs, speed):
+        output_size = 0
+        for output_file, _ in outputs:
+            try:
+                output_size += os.path.getsize(output_file)
+            except OSError:
+                pass
+
+        # Fall back to the average speed over the whole job
+        if not speed and wall_secs > 0:
+            speed = slice_secs / wall_secs
+
+        row = (time.time(), fingerprint, input_file,
+                info.get("width"), info.get("height"), info.get("fps"),
+                info.get("duration"), codec_key(outputs),
+                json.dumps([codec.args for _, codec in outputs]),
+                slice_secs, wall_secs, speed, output_size)
+
+        with self.lock, self.db:
+            self.db.execute('''INSERT INTO jobs (finished, fingerprint, input,
+                    width, height, fps, duration, codec, args, slice_secs,
+                    wall_secs, speed, output_size)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', row)
+
+
+    def average_speed(self, codec, height=None):
+        '''
+        Average encode speed (x realtime) of earlier jobs with the same
+        codecs, preferring jobs with the same resolution
+        '''
+        with self.lock:
+            if height:
+                (speed,) = self.db.execute('''SELECT AVG(speed) FROM jobs
+                        WHERE codec = ? AND height = ? AND speed > 0''',
+                        (codec, height)).fetchone()
+                if speed:
+                    return speed
+
+            (speed,) = self.db.execute('''SELECT AVG(speed) FROM jobs
+                    WHERE codec = ? AND speed > 0''', (codec,)).fetchone()
+
+        return speed
+
+
+    STATS_KEYS = ("codec", "height", "jobs", "speed", "fps", "encoded_secs")
+
+    def stats(self):
+        '''
+        Aggregate throughput per codec and resolution, as dicts with
+        STATS_KEYS: jobs, average speed, average encode fps and total
+        encoded seconds
+        '''
+        with self.lock:
+            rows = self.db.execute('''SELECT codec, height, COUNT(*),
+                    AVG(speed), AVG(speed * fps), SUM(slice_secs)
+                    FROM jobs GROUP BY codec, height
+                    ORDER BY codec, height''').fetchall()
+
+        return [dict(zip(self.STATS_KEYS, row)) for row in rows]
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+
+class Estimator:
+    '''
+    ETA of a job. Before the job has run for a while, the speed predicted
+    from the history is trusted; it is then gradually replaced by the speed
+    ffmpeg reports.
+    '''
+
+    # Seconds of wall time after which only the measured speed counts
+    WARMUP = 30.0
+
+    def __init__(self, total_secs, predicted_speed=None):
+        self.total_secs = total_secs
+        self.predicted_speed = predicted_speed
+
+
+    def speed(self, measured_speed, elapsed):
+        if not measured_speed:
+            return self.predicted_speed
+        if not self.predicted_speed:
+            return measured_speed
+
+        weight = min(1.0, elapsed / self.WARMUP)
+        return weight * measured_speed + (1 - weight) * self.predicted_speed
+
+
+    def eta(self, encoded=0.0, measured_speed=None, elapsed=0.0):
+        ''' Seconds left, or None if there is nothing to go on '''
+        speed = self.speed(measured_speed, elapsed)
+        if not speed or self.total_secs is None:
+            return None
+
+        return max(0.0, self.total_secs - encoded) / speed
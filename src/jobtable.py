@@ -0,0 +1,355 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+from array import array
+from threading import Lock
+
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt, QTimer
+
+from engine import Job
+from ff import FFTime
+from tracing import traced
+
+
+class JobTableModel(QAbstractTableModel):
+    '''
+    The jobs of a JobEngine as table rows, for tens of thousands of jobs.
+
+    Jobs are only referenced, never copied: cells are formatted from the
+    Job when the view asks for them, which it only does for visible rows.
+    The order of the rows is an array of indices into the job list, so
+    sorting and filtering only rearrange integers. Rows are sorted when the
+    sort or filter changes, not while progress comes in; jobs added or
+    matching the filter later go to the end.
+
+    Jobs are added and report progress from other threads. That only marks
+    them in a set; once per frame a timer adds at most MAX_INSERTS new jobs
+    and turns at most MAX_UPDATES changed ones into a few dataChanged
+    ranges.
+    '''
+
+    # Columns
+    ID = 0
+    INPUT = 1
+    FORMATS = 2
+    STATUS = 3
+    PROGRESS = 4
+    SPEED = 5
+    ETA = 6
+    ATTEMPTS = 7
+
+    HEADERS = ["#", "Input", "Formats", "Status", "Progress", "Speed", "ETA",
+            "Attempts"]
+
+    FRAME_MS = 16
+    MAX_INSERTS = 2000
+    MAX_UPDATES = 500
+    # More separate ranges than this are sent as one
+    MAX_RANGES = 16
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        # Every job added, and job index -> row (-1 if filtered out)
+        self.jobs = []
+        self.index_of = {}
+        self.positions = array("l")
+        # Row -> job index
+        self.rows = array("l")
+
+        self.sort_column = None
+        self.sort_order = Qt.AscendingOrder
+        self.text_filter = ""
+        self.status_filter = None
+
+        # Filled from other threads, emptied by flush()
+        self.lock = Lock()
+        self.pending = []
+        self.dirty = set()
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(self.FRAME_MS)
+
+
+    def add_job(self, job):
+        ''' Show job. Can be called from any thread. '''
+        job.progress_signal.connect(self.mark_dirty)
+        job.finish_signal.connect(self.mark_dirty)
+
+        with self.lock:
+            self.pending.append(job)
+
+
+    def mark_dirty(self, job, *args):
+        with self.lock:
+            self.dirty.add(job.id)
+
+
+    def job_at(self, row):
+        return self.jobs[self.rows[row]]
+
+
+    def total(self):
+        return len(self.jobs)
+
+
+    ## Qt model interface
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+
+        return None
+
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+
+        job = self.jobs[self.rows[index.row()]]
+        column = index.column()
+
+        if role == Qt.DisplayRole:
+            return self._text(job, column)
+
+        if role == Qt.ToolTipRole:
+            if column == self.INPUT:
+                return job.input_file
+            if column == self.ATTEMPTS and job.error:
+                return str(job.error)
+
+        if role == Qt.TextAlignmentRole and column not in (self.INPUT,
+                self.FORMATS, self.STATUS):
+            return Qt.AlignRight | Qt.AlignVCenter
+
+        return None
+
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self._relayout(self._sorted(self._filtered(range(len(self.jobs)))))
+
+
+    ## Filtering and sorting
+
+    def set_filter(self, text=None, statuses=None):
+        '''
+        Show only jobs with text in their input path and, if statuses isn't
+        None, one of statuses
+        '''
+        self.text_filter = (text or "").lower()
+        self.status_filter = set(statuses) if statuses is not None else None
+        self._relayout(self._sorted(self._filtered(range(len(self.jobs)))))
+
+
+    def _accepts(self, job):
+        if self.status_filter is not None and \
+                job.status not in self.status_filter:
+            return False
+
+        return self.text_filter in job.input_file.lower()
+
+
+    def _filtered(self, indices):
+        if not self.text_filter and self.status_filter is None:
+            return array("l", indices)
+
+        jobs = self.jobs
+        return array("l", (i for i in indices if self._accepts(jobs[i])))
+
+
+    def _key(self, job):
+        column = self.sort_column
+
+        if column == self.INPUT:
+            return os.path.basename(job.input_file).lower()
+        if column == self.FORMATS:
+            return self._text(job, column)
+        if column == self.STATUS:
+            return Job.STATUS_NAMES[job.status]
+        if column == self.PROGRESS:
+            progress = job.progress()
+            return -1.0 if progress is None else progress
+        if column == self.SPEED:
+            return job.speed or 0.0
+        if column == self.ETA:
+            eta = job.eta()
+            return float("inf") if eta is None else eta
+        if column == self.ATTEMPTS:
+            return job.attempts
+
+        return job.id
+
+
+    def _sorted(self, indices):
+        if self.sort_column is None:
+            return indices
+
+        jobs = self.jobs
+        return array("l", sorted(indices, key=lambda i: self._key(jobs[i]),
+            reverse=self.sort_order == Qt.DescendingOrder))
+
+
+    def _relayout(self, rows):
+        ''' Replace the rows, keeping the selection on the same jobs '''
+        self.layoutAboutToBeChanged.emit()
+
+        persistent = self.persistentIndexList()
+        held = [self.rows[index.row()] for index in persistent]
+
+        self.rows = rows
+        self.positions = array("l", [-1]) * len(self.jobs)
+        for row, i in enumerate(rows):
+            self.positions[i] = row
+
+        self.changePersistentIndexList(persistent,
+                [self.index(self.positions[i], index.column())
+                    if self.positions[i] >= 0 else QModelIndex()
+                    for i, index in zip(held, persistent)])
+
+        self.layoutChanged.emit()
+
+
+    ## Batched updates
+
+    @traced("JobTableModel.flush", "gui")
+    def flush(self):
+        ''' Apply what other threads reported since the last frame '''
+        with self.lock:
+            if not self.pending and not self.dirty:
+                return
+
+            added = self.pending[:self.MAX_INSERTS]
+            del self.pending[:self.MAX_INSERTS]
+
+            changed = [self.dirty.pop()
+                    for _ in range(min(self.MAX_UPDATES, len(self.dirty)))]
+
+        # Jobs that appear in or leave the view
+        shown, hidden = [], set()
+
+        first_added = len(self.jobs)
+        for job in added:
+            i = len(self.jobs)
+            self.jobs.append(job)
+            self.index_of[job.id] = i
+            self.positions.append(-1)
+            if self._accepts(job):
+                shown.append(i)
+
+        updated = []
+        for job_id in changed:
+            i = self.index_of.get(job_id)
+            if i is None or i >= first_added:
+                # Still pending or just added, it is shown as it is once
+                # added
+                continue
+
+            visible = self.positions[i] >= 0
+            accepted = self._accepts(self.jobs[i])
+            if visible and accepted:
+                updated.append(self.positions[i])
+            elif accepted:
+                shown.append(i)
+            elif visible:
+                hidden.add(i)
+
+        if hidden:
+            rows = array("l", (i for i in self.rows if i not in hidden))
+            rows.extend(shown)
+            self._relayout(rows)
+        elif shown:
+            first = len(self.rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(shown) - 1)
+            for row, i in enumerate(shown, first):
+                self.positions[i] = row
+            self.rows.extend(shown)
+            self.endInsertRows()
+
+        self._emit_changed(updated)
+
+
+    def _emit_changed(self, rows):
+        if not rows:
+            return
+
+        rows.sort()
+        ranges = []
+        for row in rows:
+            if ranges and row <= ranges[-1][1] + 1:
+                ranges[-1][1] = row
+            else:
+                ranges.append([row, row])
+
+        # The view only repaints the visible part of a range
+        if len(ranges) > self.MAX_RANGES:
+            ranges = [[rows[0], rows[-1]]]
+
+        for first, last in ranges:
+            self.dataChanged.emit(self.index(first, self.STATUS),
+                    self.index(last, self.ATTEMPTS))
+
+
+    ## Cell text
+
+    def _text(self, job, column):
+        if column == self.ID:
+            return str(job.id)
+
+        if column == self.INPUT:
+            return os.path.basename(job.input_file)
+
+        if column == self.FORMATS:
+            return ", ".join(codec.name for _, codec in job.outputs)
+
+        if column == self.STATUS:
+            status = Job.STATUS_NAMES[job.status].capitalize()
+            if job.status == Job.QUEUED and job.waiting_for_space:
+                status += " (disk full)"
+            return status
+
+        if column == self.PROGRESS:
+            progress = job.progress()
+            if job.status == Job.DONE:
+                progress = 1.0
+            return "" if progress is None else "%d%%" % (100 * progress)
+
+        if column == self.SPEED:
+            return "%.2fx" % job.speed if job.speed and \
+                    job.status == Job.RUNNING else ""
+
+        if column == self.ETA:
+            eta = job.eta() if job.status == Job.RUNNING else None
+            return "" if eta is None else str(FFTime(1000 * eta))
+
+        if column == self.ATTEMPTS:
+            if job.error:
+                return "%d (%s)" % (job.attempts + 1, job.error.kind)
+            return str(job.attempts + 1) if job.status != Job.QUEUED else ""
+
+        return None
@@ -0,0 +1,292 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shlex
+import shutil
+
+from threading import Lock, Thread
+
+from engine import Job, JobEngine
+from output_codecs import OutputCodec
+
+
+# Parameters that must be equal for streams to be joined without decoding
+VIDEO_KEYS = ("codec_name", "profile", "width", "height", "pix_fmt",
+        "r_frame_rate")
+AUDIO_KEYS = ("codec_name", "sample_rate", "channels")
+
+# ffprobe codec name -> encoder producing it
+VIDEO_ENCODERS = {
+        "h264": "libx264",
+        "hevc": "libx265",
+        "vp8": "libvpx",
+        "vp9": "libvpx-vp9",
+        "mpeg4": "mpeg4",
+        }
+
+AUDIO_ENCODERS = {
+        "aac": "aac",
+        "mp3": "libmp3lame",
+        "opus": "libopus",
+        "vorbis": "libvorbis",
+        "ac3": "ac3",
+        "flac": "flac",
+        }
+
+# libx264 profiles, by the name ffprobe reports
+X264_PROFILES = {
+        "Baseline": "baseline",
+        "Constrained Baseline": "baseline",
+        "Main": "main",
+        "High": "high",
+        }
+
+
+def signature(params):
+    ''' What must match between inputs for a lossless join '''
+    video, audio = params.get("video"), params.get("audio")
+
+    return (
+        tuple(video.get(k) for k in VIDEO_KEYS) if video else None,
+        tuple(audio.get(k) for k in AUDIO_KEYS) if audio else None,
+        )
+
+
+def encodable(params):
+    video, audio = params.get("video"), params.get("audio")
+
+    return (not video or video.get("codec_name") in VIDEO_ENCODERS) and \
+            (not audio or audio.get("codec_name") in AUDIO_ENCODERS)
+
+
+def default_reference(params):
+    ''' H.264/AAC at the resolution and frame rate of params '''
+    video, audio = params.get("video"), params.get("audio")
+
+    reference = {"video": None, "audio": None}
+    if video:
+        reference["video"] = {"codec_name": "h264", "profile": "High",
+                "width": video.get("width"), "height": video.get("height"),
+                "pix_fmt": "yuv420p", "sample_aspect_ratio": "1:1",
+                "r_frame_rate": video.get("r_frame_rate")}
+    if audio:
+        reference["audio"] = {"codec_name": "aac", "sample_rate": "48000",
+                "channels": 2}
+
+    return reference
+
+
+def conform_codec(reference, params):
+    '''
+    OutputCodec re-encoding an input with params into the format of
+    reference, so the result can be joined to it without decoding
+    '''
+    args = []
+    video, audio = reference.get("video"), reference.get("audio")
+
+    if video:
+        width, height = video["width"], video["height"]
+        sar = (video.get("sample_aspect_ratio") or "1:1").replace(":", "/")
+        if sar.startswith("0"):
+            sar = "1"
+
+        # Letterbox rather than distort
+        args += ["-map", "0:v:0", "-c:v", VIDEO_ENCODERS[video["codec_name"]],
+                "-vf", "scale=%d:%d:force_original_aspect_ratio=decrease,"
+                    "pad=%d:%d:-1:-1,setsar=%s" % (width, height, width, height, sar),
+                "-pix_fmt", video["pix_fmt"], "-r", video["r_frame_rate"]]
+
+        profile = X264_PROFILES.get(video.get("profile"))
+        if video["codec_name"] == "h264" and profile:
+            args += ["-profile:v", profile]
+
+    if audio:
+        args += ["-c:a", AUDIO_ENCODERS[audio["codec_name"]],
+                "-ar", str(audio["sample_rate"]), "-ac", str(audio["channels"])]
+
+        if params.get("audio"):
+            args += ["-map", "0:a:0"]
+        else:
+            # Silence for inputs without audio, the joined audio would
+            # otherwise be out of sync
+            args += ["-filter_complex", "anullsrc=r=%s[silence]"
+                    % audio["sample_rate"], "-map", "[silence]", "-shortest"]
+
+    return OutputCodec("Join", "mkv", " ".join(shlex.quote(a) for a in args))
+
+
+
+class JoinJob:
+    '''
+    Joins inputs end to end into output_file.
+
+    Inputs whose codec parameters match are joined losslessly with the
+    concat demuxer. The others are first re-encoded, in parallel on a
+    JobEngine, to the format of the inputs that make up most of the
+    result; if that format can't be encoded, everything is brought to
+    H.264/AAC.
+
+    Like FF.run, start() returns at once and reports through msg_signal
+    and finish_signal.
+    '''
+
+    def __init__(self, ff, inputs, output_file, engine=None):
+        if len(inputs) < 2:
+            raise ValueError("Nothing to join")
+
+        self.ff = ff
+        self.inputs = inputs
+        self.output_file = output_file
+
+        self.own_engine = engine is None
+        self.engine = engine or JobEngine(ff)
+
+        self.work_dir = None
+        self.jobs = []
+        self.lock = Lock()
+        self.cancelled = False
+        self.ok = False
+
+
+    def plan(self):
+        '''
+        [(input, OutputCodec or None)]: the codec each input must be
+        re-encoded with first, None if it can be joined as it is
+        '''
+        params = []
+        for input_file in self.inputs:
+            p = self.ff.get_stream_params(input_file)
+            if not p:
+                raise ValueError("Not a valid video file: %s" % input_file)
+            params.append(p)
+
+        # The format covering the longest duration is kept as it is
+        durations = {}
+        for input_file, p in zip(self.inputs, params):
+            if not encodable(p):
+                continue
+
+            code, duration = self.ff.get_duration(input_file)
+            secs = duration.to_ms() / 1000 if code == 0 else 0
+            durations[signature(p)] = durations.get(signature(p), 0) + secs
+
+        if durations:
+            best = max(durations, key=durations.get)
+            reference = next(p for p in params if signature(p) == best)
+        else:
+            reference = default_reference(params[0])
+
+        # Every input must have the streams of the reference
+        if reference.get("audio") is None and any(p.get("audio") for p in params):
+            reference = dict(reference, audio=default_reference(
+                next(p for p in params if p.get("audio")))["audio"])
+
+        target = signature(reference)
+
+        return [(input_file, None if signature(p) == target
+                    else conform_codec(reference, p))
+                for input_file, p in zip(self.inputs, params)]
+
+
+    def progress(self):
+        ''' Fraction of the re-encoding done, None before it starts '''
+        durations = [job.duration for job in self.jobs]
+        if not durations or None in durations:
+            return None
+
+        encoded = sum(min(job.encoded, job.duration) for job in self.jobs)
+        return encoded / max(1e-3, sum(durations))
+
+
+    def _run(self, msg_signal, finish_signal):
+        try:
+            plan = self.plan()
+        except ValueError as e:
+            msg_signal.emit("%s\n" % e)
+            finish_signal.emit()
+            return
+
+        self.work_dir = self.ff.scratch.mkdtemp("join-")
+
+        files = []
+        pending = []
+        for i, (input_file, codec) in enumerate(plan):
+            if codec is None:
+                files.append(input_file)
+                continue
+
+            conformed = os.path.join(self.work_dir, "input-%05d.%s" % (i, codec.ext))
+            files.append(conformed)
+            pending.append(Job(input_file, [(conformed, codec)]))
+
+        msg_signal.emit("Joining %d inputs, re-encoding %d\n"
+                % (len(plan), len(pending)))
+
+        if not pending:
+            self._concat(files, msg_signal, finish_signal)
+            return
+
+        self.jobs = pending
+        remaining = [len(pending)]
+
+        def on_finish(job):
+            if job.status != Job.DONE:
+                msg_signal.emit("Re-encoding %s failed\n" % job.input_file)
+                self.terminate()
+
+            with self.lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+
+            if last:
+                self._concat(files, msg_signal, finish_signal)
+
+        for job in pending:
+            job.msg_signal.connect(lambda job, line: msg_signal.emit(line))
+            job.finish_signal.connect(on_finish)
+
+        if self.own_engine:
+            self.engine.start()
+
+        for job in pending:
+            self.engine.submit(job)
+
+
+    def _concat(self, files, msg_signal, finish_signal):
+        if self.own_engine:
+            self.engine.stop()
+
+        if not self.cancelled and all(job.status == Job.DONE for job in self.jobs):
+            msg_signal.emit("\nJoining\n")
+            # Re-encoded inputs have parameter sets of their own
+            self.ok = self.ff.concat(files, self.output_file, msg_signal,
+                    annexb=bool(self.jobs)) == 0
+
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        finish_signal.emit()
+
+
+    def start(self, msg_signal, finish_signal):
+        ''' Probe, re-encode and join in the background '''
+        Thread(target=lambda: self._run(msg_signal, finish_signal)).start()
+
+
+    def terminate(self):
+        self.cancelled = True
+        for job in self.jobs:
+            if job.status in (Job.QUEUED, Job.RUNNING, Job.PAUSED):
+                self.engine.cancel(job)
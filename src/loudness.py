@@ -0,0 +1,97 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+
+from output_codecs import Loudness
+
+
+# Measures only, the filtered audio is thrown away. The targets don't
+# affect the measured values.
+MEASURE_FILTER = "loudnorm=print_format=json"
+
+
+def parse_measurement(lines):
+    '''
+    The measurement loudnorm printed among ffmpeg's log lines, as a dict
+    with the keys of Loudness.MEASURED, or None
+    '''
+    text = "".join(lines)
+    end = text.rfind("}")
+    start = text.rfind("{", 0, end)
+    if start < 0:
+        return None
+
+    try:
+        measured = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+
+    if not all(k in measured for k in Loudness.MEASURED):
+        return None
+
+    # Silence measures as -inf, loudnorm can't normalize it
+    if measured["input_i"] in ("-inf", "inf"):
+        return None
+
+    return {k: measured[k] for k in Loudness.MEASURED}
+
+
+
+class LoudnessMeter:
+    '''
+    Measures the loudness of (a slice of) the first audio stream of a file:
+    the first pass of two-pass loudnorm. ffmpeg decodes the audio only and
+    the measurement is read from its log.
+    '''
+
+    def __init__(self, ff, filename, slice_timestamps=(None, None)):
+        self.ff = ff
+        self.filename = filename
+        self.slice_timestamps = slice_timestamps
+
+        self.raw = None
+        self.cancelled = False
+
+
+    def run(self):
+        ''' The measurement, or None if cancelled or failed '''
+        slice_start, slice_time = self.slice_timestamps
+
+        input_args = ["-ss", str(slice_start)] if slice_start else []
+        output_args = ["-map", "0:a:0", "-vn", "-sn", "-dn", "-af", MEASURE_FILTER]
+        if slice_time:
+            output_args += ["-t", str(slice_time)]
+
+        self.raw = self.ff.open_raw(self.filename, [output_args + ["-f", "null"]],
+                input_args, log=True)
+        if self.cancelled:
+            self.raw.stop()
+
+        with self.raw:
+            # Nothing is written, this only waits for ffmpeg to finish
+            self.raw.streams[0].read()
+
+        if self.raw.returncode != 0 or self.cancelled:
+            return None
+
+        return parse_measurement(self.raw.log)
+
+
+    def cancel(self):
+        self.cancelled = True
+        if self.raw:
+            self.raw.stop()
@@ -14,21 +14,378 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import copy
+import os
 import shlex
+import stat
 import sys
 
+
+def stream_fd(path, default):
+    '''
+    File descriptor named by a stream path: "-", "pipe:" (default), "pipe:N"
+    or "fd:N". None if path is not a stream path.
+    '''
+    if path in ("-", "pipe:"):
+        return default
+
+    for prefix in ("pipe:", "fd:"):
+        if path.startswith(prefix) and path[len(prefix):].isdigit():
+            return int(path[len(prefix):])
+
+    return None
+
+
+def is_stream(path):
+    ''' True for stream paths and FIFOs, which can't be seeked or reread '''
+    if stream_fd(path, 0) is not None:
+        return True
+
+    try:
+        return stat.S_ISFIFO(os.stat(path).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+class Loudness:
+    '''
+    Loudness normalization target, EBU R128 by default: integrated
+    loudness (LUFS), maximum true peak (dBTP) and loudness range (LU)
+    '''
+
+    # Measured values loudnorm needs for a second pass
+    MEASURED = ("input_i", "input_tp", "input_lra", "input_thresh",
+            "target_offset")
+
+    def __init__(self, integrated=-23.0, true_peak=-1.0, lra=7.0):
+        self.integrated = integrated
+        self.true_peak = true_peak
+        self.lra = lra
+
+
+    def audio_filter(self, measured=None):
+        '''
+        loudnorm filter reaching the target. Given the measurement of the
+        input (FF.measure_loudness), the whole input gets the same gain;
+        without it loudnorm adjusts the gain dynamically as it goes.
+        '''
+        f = "loudnorm=I=%g:TP=%g:LRA=%g" % (self.integrated, self.true_peak,
+                self.lra)
+
+        if measured:
+            f += ":measured_I=%s:measured_TP=%s:measured_LRA=%s" \
+                    ":measured_thresh=%s:offset=%s:linear=true" \
+                    % tuple(measured[k] for k in Loudness.MEASURED)
+
+        return f
+
+
+    def to_dict(self):
+        return {"integrated": self.integrated, "true_peak": self.true_peak,
+                "lra": self.lra}
+
+
+
 class OutputCodec:
-    def __init__(self, name, ext, args):
+    def __init__(self, name, ext, args, muxer=None, pipe_args="",
+            loudness=None, alternatives=None):
         self.name = name
         self.ext = ext
         self.args = shlex.split(args)
 
+        # Codecs with other encoders for the same format, for ffmpeg builds
+        # without this one or where they are faster (Capabilities.choose)
+        self.alternatives = alternatives or []
+
+        # Needed when writing to a pipe, where there is no extension to
+        # guess the container from and the output can't be seeked
+        self.muxer = muxer or ext
+        self.pipe_args = shlex.split(pipe_args)
+
+        # Loudness target, or None to leave the audio level alone
+        self.loudness = loudness
+
+
+    def normalized(self, loudness=None):
+        ''' Copy of this codec normalizing loudness to loudness '''
+        codec = copy.copy(self)
+        codec.loudness = loudness or Loudness()
+        return codec
+
+
+    def _loudness_args(self, measured):
+        if not self.loudness:
+            return []
+
+        args = ["-af", self.loudness.audio_filter(measured)]
+
+        # loudnorm upsamples to 192 kHz
+        if "-ar" not in self.args:
+            args += ["-ar", "48000"]
+
+        return args
+
+
+    def output_args(self, output_file, measured=None):
+        '''
+        ffmpeg arguments for writing output_file with this codec. measured
+        is the loudness measurement of the input, if normalizing.
+        '''
+        args = self.args + self._loudness_args(measured)
+
+        if is_stream(output_file):
+            return args + self.pipe_args + ["-f", self.muxer, output_file]
+
+        return args + [output_file]
+
+
+    def is_stream_copy(self):
+        ''' True if nothing is re-encoded, so the job is IO-bound '''
+        codecs = [self.args[i + 1] for i, arg in enumerate(self.args[:-1])
+                if arg == "-c" or arg.startswith("-c:") or arg == "-codec"]
+
+        return len(codecs) > 0 and all(c == "copy" for c in codecs)
+
+
+
+class Rendition:
+    '''
+    One step of a bitrate ladder. The audio bitrate of the first rendition
+    is used for the shared audio stream.
+    '''
+
+    def __init__(self, height, video_bitrate, audio_bitrate="128k"):
+        self.height = height
+        self.video_bitrate = video_bitrate
+        self.audio_bitrate = audio_bitrate
+
+
+
+class SegmentedOutputCodec(OutputCodec):
+    '''
+    Segmented streaming output (HLS or DASH, fMP4 segments).
+
+    Every rendition of the ladder is produced from a single decode: the
+    video is split and scaled inside one filter graph and each branch is
+    fed to its own encoder in the same ffmpeg process. Keyframes are forced
+    on segment boundaries so the renditions stay switchable.
+
+    With progressive=True the playlist is updated as each segment completes
+    (HLS event playlist / DASH streaming mode), so downstream packaging can
+    pick up segments before the encode finishes.
+    '''
+
+    HLS = "hls"
+    DASH = "dash"
 
+    def __init__(self, name, renditions, fmt=HLS, segment_time=4,
+            progressive=False,
+            video_args="-c:v libx264 -preset veryfast -crf 22",
+            audio_args="-c:a aac", alternatives=None):
+
+        ext = "m3u8" if fmt == SegmentedOutputCodec.HLS else "mpd"
+        super().__init__(name, ext, "", alternatives=alternatives)
+
+        self.renditions = renditions
+        self.fmt = fmt
+        self.segment_time = segment_time
+        self.progressive = progressive
+        self.video_args = shlex.split(video_args)
+        self.audio_args = shlex.split(audio_args)
+        self.has_audio = True
+
+
+    def for_source(self, params):
+        '''
+        Copy of this codec fitted to an input with the stream parameters
+        params (FF.get_stream_params): renditions taller than the source are
+        dropped rather than upscaled, and a source without audio gets no
+        audio stream. Unknown parameters leave the codec as it is.
+        '''
+        codec = copy.copy(self)
+        if not params:
+            return codec
+
+        codec.has_audio = params.get("audio") is not None
+
+        height = (params.get("video") or {}).get("height")
+        if height:
+            renditions = [r for r in self.renditions if r.height <= height]
+            if not renditions:
+                # Smaller than the whole ladder, keep the lowest step at
+                # the source size
+                lowest = min(self.renditions, key=lambda r: r.height)
+                renditions = [Rendition(height, lowest.video_bitrate,
+                    lowest.audio_bitrate)]
+            codec.renditions = renditions
+
+        return codec
+
+
+    def _filter_graph(self):
+        n = len(self.renditions)
+
+        graph = "[0:v]split=%d%s" % (n, "".join("[v%d]" % i for i in range(n)))
+        for i, rendition in enumerate(self.renditions):
+            graph += ";[v%d]scale=-2:%d[v%dout]" % (i, rendition.height, i)
+
+        return graph
+
+
+    def _stream_args(self):
+        args = ["-filter_complex", self._filter_graph()]
+
+        for i, rendition in enumerate(self.renditions):
+            args += ["-map", "[v%dout]" % i]
+
+        # Audio is the same for every rendition, so only encode it once
+        if self.has_audio:
+            args += ["-map", "0:a:0?"]
+
+        args += self.video_args
+        for i, rendition in enumerate(self.renditions):
+            args += [
+                "-b:v:%d" % i, rendition.video_bitrate,
+                "-maxrate:v:%d" % i, rendition.video_bitrate,
+                "-bufsize:v:%d" % i, rendition.video_bitrate,
+                ]
+
+        if self.has_audio:
+            args += self.audio_args
+            args += ["-b:a", self.renditions[0].audio_bitrate]
+
+        # Align keyframes with segment boundaries
+        args += [
+            "-force_key_frames", "expr:gte(t,n_forced*%s)" % self.segment_time,
+            "-sc_threshold", "0",
+            ]
+
+        return args
+
+
+    def _hls_args(self, output_file):
+        base = output_file.rsplit(".", 1)[0]
+        name = os.path.basename(base)
+
+        if self.has_audio:
+            var_stream_map = " ".join(["a:0,agroup:audio"] +
+                    ["v:%d,agroup:audio" % i
+                        for i in range(len(self.renditions))])
+        else:
+            var_stream_map = " ".join("v:%d" % i
+                    for i in range(len(self.renditions)))
+
+        flags = "independent_segments"
+        if self.progressive:
+            # Segments are written to a temporary file and renamed, so
+            # whatever is listed in the playlist is always complete
+            flags += "+temp_file"
+
+        return [
+            "-f", "hls",
+            "-hls_time", str(self.segment_time),
+            "-hls_segment_type", "fmp4",
+            "-hls_playlist_type", "event" if self.progressive else "vod",
+            "-hls_flags", flags,
+            "-hls_fmp4_init_filename", name + "_%v_init.mp4",
+            "-hls_segment_filename", base + "_%v_%05d.m4s",
+            "-master_pl_name", os.path.basename(output_file),
+            "-var_stream_map", var_stream_map,
+            base + "_%v.m3u8",
+            ]
+
+
+    def _dash_args(self, output_file):
+        # Segments are named after the manifest, like the HLS ones, so
+        # several outputs can share a folder
+        name = os.path.basename(output_file.rsplit(".", 1)[0])
+
+        args = [
+            "-f", "dash",
+            "-seg_duration", str(self.segment_time),
+            "-use_template", "1",
+            "-use_timeline", "1",
+            "-init_seg_name", name + "_$RepresentationID$_init.$ext$",
+            "-media_seg_name",
+                name + "_$RepresentationID$_$Number%05d$.$ext$",
+            "-adaptation_sets", "id=0,streams=v id=1,streams=a"
+                if self.has_audio else "id=0,streams=v",
+            ]
+
+        if self.progressive:
+            args += ["-streaming", "1"]
+
+        return args + [output_file]
+
+
+    def output_args(self, output_file, measured=None):
+        if is_stream(output_file):
+            raise ValueError("Segmented outputs can't be written to a pipe")
+
+        args = self._stream_args()
+        if self.has_audio:
+            args += self._loudness_args(measured)
+
+        if self.fmt == SegmentedOutputCodec.HLS:
+            return args + self._hls_args(output_file)
+
+        return args + self._dash_args(output_file)
+
+
+
+# Fragmented, the moov atom can't be written at the end of a pipe
+MP4_PIPE_ARGS = "-movflags frag_keyframe+empty_moov+default_base_moof"
+
+# Renditions of the HLS and DASH outputs
+HLS_LADDER = [
+        Rendition(1080, "5000k", "160k"),
+        Rendition(720, "2800k"),
+        Rendition(480, "1200k"),
+        ]
 
 AVAILABLE_CODECS = [
         OutputCodec("MP4 (libx264)", "mp4",
-            "-c:v libx264 -crf 22 -c:a aac -b:a 160k"),
+            "-c:v libx264 -crf 22 -c:a aac -b:a 160k",
+            pipe_args=MP4_PIPE_ARGS,
+            alternatives=[
+                OutputCodec("MP4 (OpenH264)", "mp4",
+                    "-c:v libopenh264 -b:v 5M -c:a aac -b:a 160k",
+                    pipe_args=MP4_PIPE_ARGS),
+                ]),
 
         OutputCodec("MP3 (Audio-only)", "mp3",
-            "-vn -c:a libmp3lame -q:a 0")
+            "-vn -c:a libmp3lame -q:a 0",
+            alternatives=[
+                OutputCodec("MP3 (Audio-only, Shine)", "mp3",
+                    "-vn -c:a libshine -b:a 256k"),
+                ]),
+
+        SegmentedOutputCodec("HLS (1080p/720p/480p)", HLS_LADDER,
+            alternatives=[
+                SegmentedOutputCodec("HLS (1080p/720p/480p, OpenH264)",
+                    HLS_LADDER, video_args="-c:v libopenh264"),
+                ]),
+
+        SegmentedOutputCodec("DASH (1080p/720p/480p)", HLS_LADDER,
+            fmt=SegmentedOutputCodec.DASH,
+            alternatives=[
+                SegmentedOutputCodec("DASH (1080p/720p/480p, OpenH264)",
+                    HLS_LADDER, fmt=SegmentedOutputCodec.DASH,
+                    video_args="-c:v libopenh264"),
+                ]),
 ]
+
+
+def find_codec(name, codecs=None):
+    '''
+    Look up a codec by its extension or the start of its name, e.g. "mp3"
+    or "hls", among codecs (FF.codecs(), by default all of them). Returns
+    None if nothing matches.
+    '''
+    name = name.lower()
+
+    for codec in AVAILABLE_CODECS if codecs is None else codecs:
+        if codec.ext == name or codec.name.lower().startswith(name):
+            return codec
+
+    return None
@@ -12,10 +12,13 @@
 # Hazen 07/14
 #
 
+import bisect
 import decimal
 from PyQt5 import QtCore, QtGui
 import sys
 
+import tracing
+
 from PyQt5.QtWidgets import (
         QApplication,
         QDoubleSpinBox,
@@ -52,6 +55,11 @@ class QRangeSlider(QWidget):
         self.setMouseTracking(False)
         self.single_step = 0.0
 
+        # seanyeh: sorted points the bars snap to while Shift is held
+        self.snap_points = None
+        self.snap_factor = 1.0
+        self.snapping = False
+
         if slider_range:
             self.setRange(slider_range)
         else:
@@ -140,7 +148,9 @@ class QRangeSlider(QWidget):
     #
     # @param event A PyQt mouse motion event.
     #
+    @tracing.traced("QRangeSlider.mouseMoveEvent", "gui")
     def mouseMoveEvent(self, event):
+        self.snapping = bool(event.modifiers() & QtCore.Qt.ShiftModifier)
         size = self.rangeSliderSize()
         diff = self.start_pos - self.getPos(event)
         if self.moving == "min":
@@ -237,6 +247,40 @@ class QRangeSlider(QWidget):
         if (abs(steps - round(steps)) > 0.01 * self.single_step):
             raise Exception("Slider range is not a multiple of the step size!")
 
+    ## setSnapPoints
+    #
+    # @param points Sorted sequence of points to snap to, or None.
+    # @param factor Slider units per point unit.
+    #
+    def setSnapPoints(self, points, factor = 1.0):
+        self.snap_points = points
+        self.snap_factor = factor
+
+    ## snapValue
+    #
+    # @param value A slider value.
+    #
+    # @return The nearest snap point within SNAP_PIXELS of value, or value.
+    #
+    SNAP_PIXELS = 8
+
+    def snapValue(self, value):
+        points = self.snap_points
+        if not self.snapping or points is None or len(points) == 0:
+            return value
+
+        i = bisect.bisect_left(points, value / self.snap_factor)
+        nearest = [points[j] * self.snap_factor for j in (i - 1, i)
+                if 0 <= j < len(points)]
+        best = min(nearest, key = lambda p: abs(p - value))
+
+        size = float(self.rangeSliderSize() - 2 * self.bar_width - 1)
+        if abs(best - value) > self.SNAP_PIXELS * self.scale / size:
+            return value
+
+        best = float(round(best/self.single_step))*self.single_step
+        return min(max(best, self.start), self.start + self.scale)
+
     ## setValues
     #
     # @param values [position of minimum slider, position of maximum slider].
@@ -269,6 +313,10 @@ class QRangeSlider(QWidget):
         if (self.moving == "max") or (self.moving == "bar"):
             self.max_val = self.start + (self.display_max - self.bar_width)/float(size) * self.scale
             self.max_val = float(round(self.max_val/self.single_step))*self.single_step
+        if self.moving == "min":
+            self.min_val = self.snapValue(self.min_val)
+        if self.moving == "max":
+            self.max_val = self.snapValue(self.max_val)
         self.updateDisplayValues()
         self.update()
 
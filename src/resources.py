@@ -0,0 +1,135 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import subprocess
+import sys
+
+
+def available_cpus():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on Windows and OS X
+        return list(range(os.cpu_count() or 1))
+
+
+class ResourceProfile:
+    '''
+    How much of the machine an ffmpeg process may use: CPU niceness, IO
+    class (through ionice), CPU affinity and encoder/filter thread caps.
+
+    None leaves the corresponding setting to the OS or ffmpeg.
+    '''
+
+    # ionice classes
+    IO_REALTIME = 1
+    IO_BEST_EFFORT = 2
+    IO_IDLE = 3
+
+    def __init__(self, nice=None, io_class=None, io_level=None, cpus=None,
+            threads=None, filter_threads=None):
+        self.nice = nice
+        self.io_class = io_class
+        self.io_level = io_level
+        self.cpus = cpus
+        self.threads = threads
+        self.filter_threads = filter_threads
+
+
+    def background():
+        ''' Default for GUI jobs: lower priority, one core left free '''
+        cpus = available_cpus()
+
+        return ResourceProfile(nice=10,
+                io_class=ResourceProfile.IO_BEST_EFFORT, io_level=7,
+                threads=max(1, len(cpus) - 1))
+
+
+    def split(n, nice=10, io_class=IO_BEST_EFFORT, io_level=7, pin=True):
+        '''
+        Profiles for n parallel jobs, each with its own share of the
+        available CPUs so their total matches the machine. With pin=False
+        only the thread caps are set, without CPU affinity.
+        '''
+        cpus = available_cpus()
+        n = max(1, min(n, len(cpus)))
+
+        profiles = []
+        for i in range(n):
+            share = cpus[i::n]
+            profiles.append(ResourceProfile(nice=nice, io_class=io_class,
+                io_level=io_level, cpus=share if pin else None,
+                threads=len(share), filter_threads=len(share)))
+
+        return profiles
+
+
+    def global_args(self):
+        ''' Options that go before the input '''
+        if self.filter_threads:
+            return ["-filter_threads", str(self.filter_threads)]
+
+        return []
+
+
+    def output_args(self):
+        ''' Options that go before each output '''
+        if self.threads:
+            return ["-threads", str(self.threads)]
+
+        return []
+
+
+    def wrap(self, cmd):
+        '''
+        Prefix cmd with taskset, nice and ionice for the CPU affinity,
+        niceness and IO class. They exec the command, so it keeps their pid.
+        Setting these in the child with preexec_fn isn't safe while other
+        threads are spawning processes.
+        '''
+        if sys.platform == "win32":
+            return cmd
+
+        prefix = []
+
+        taskset = shutil.which("taskset") if self.cpus else None
+        if taskset:
+            prefix += [taskset, "-c", ",".join(str(cpu) for cpu in self.cpus)]
+
+        nice = shutil.which("nice") if self.nice else None
+        if nice:
+            prefix += [nice, "-n", str(self.nice)]
+
+        ionice = shutil.which("ionice") if self.io_class is not None else None
+        if ionice:
+            # -t: run at normal IO priority where setting it is denied
+            # (containers, seccomp) instead of failing
+            prefix += [ionice, "-t", "-c", str(self.io_class)]
+            if self.io_level is not None and \
+                    self.io_class != ResourceProfile.IO_IDLE:
+                prefix += ["-n", str(self.io_level)]
+
+        return prefix + cmd
+
+
+    def popen_kwargs(self):
+        ''' Extra Popen arguments applying the priority on Windows '''
+        if sys.platform == "win32" and self.nice and self.nice > 0:
+            return {"creationflags": subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+
+        return {}
@@ -0,0 +1,249 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import shutil
+
+from threading import Thread
+
+from ff import FFTime
+from output_codecs import SegmentedOutputCodec, is_stream
+from verify import JobFailure
+
+
+def plan_chunks(ff, input_file, slice_timestamps, chunk_secs):
+    '''
+    Split the slice of input_file into [start, end) chunks (in seconds) of
+    at least chunk_secs, starting on keyframes. Raises ValueError if the
+    length of input_file is unknown.
+    '''
+    slice_start, slice_time = slice_timestamps
+
+    start = slice_start.to_ms() / 1000 if slice_start else 0.0
+    if slice_time:
+        end = start + slice_time.to_ms() / 1000
+    else:
+        code, duration = ff.get_duration(input_file)
+        if code != 0 or duration is None:
+            raise ValueError("Can't read the duration of %s" % input_file)
+        end = duration.to_ms() / 1000
+
+    chunks = []
+    chunk_start = start
+    for keyframe in ff.get_keyframes(input_file):
+        if keyframe >= end:
+            break
+
+        if keyframe - chunk_start >= chunk_secs:
+            chunks.append([chunk_start, keyframe])
+            chunk_start = keyframe
+
+    chunks.append([chunk_start, end])
+
+    return chunks
+
+
+class ResumableJob:
+    '''
+    A conversion that is encoded in keyframe-aligned chunks.
+
+    Finished chunks are recorded in a journal inside a work directory next to
+    the (first) output file. Running the same job again, after a pause or a
+    crash, only encodes the chunks that are missing before the chunks are
+    losslessly concatenated into the final outputs.
+    '''
+
+    CHUNK_SECS = 60
+
+    def __init__(self, ff, input_file, outputs, slice_timestamps,
+            chunk_secs=CHUNK_SECS, resources=None):
+        for _, codec in outputs:
+            if isinstance(codec, SegmentedOutputCodec):
+                raise ValueError("Segmented outputs cannot be resumed")
+
+        if any(is_stream(f) for f in [input_file] + [o for o, _ in outputs]):
+            raise ValueError("Streams cannot be resumed")
+
+        self.ff = ff
+        self.input_file = input_file
+        self.outputs = outputs
+        self.slice_timestamps = slice_timestamps
+        self.chunk_secs = chunk_secs
+        self.resources = resources
+
+        self.work_dir = outputs[0][0] + ".parts"
+        self.journal_file = os.path.join(self.work_dir, "journal.json")
+
+        self.paused = False
+        self.thread = None
+        # JobFailure of the last run, None if it succeeded or was paused
+        self.error = None
+
+
+    def _signature(self):
+        ''' Identifies the job, so a stale journal is never reused '''
+        return {
+            "input": self.ff.fingerprint(self.input_file),
+            "outputs": [[f, codec.args] +
+                ([codec.loudness.to_dict()] if codec.loudness else [])
+                for f, codec in self.outputs],
+            "slice": [None if ts is None else ts.to_ms()
+                for ts in self.slice_timestamps],
+            }
+
+
+    def _plan(self):
+        return plan_chunks(self.ff, self.input_file, self.slice_timestamps,
+                self.chunk_secs)
+
+
+    def _load_journal(self):
+        signature = self._signature()
+
+        try:
+            with open(self.journal_file) as f:
+                journal = json.load(f)
+
+            if journal["signature"] == signature:
+                return journal
+        except (OSError, ValueError, KeyError):
+            pass
+
+        # No usable journal, start over
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(self.work_dir)
+
+        journal = {
+            "signature": signature,
+            "chunks": self._plan(),
+            "done": [],
+            }
+        self._save_journal(journal)
+
+        return journal
+
+
+    def _save_journal(self, journal):
+        # Write then rename, so a crash never leaves a half-written journal
+        temp = self.journal_file + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(journal, f)
+
+        os.replace(temp, self.journal_file)
+
+
+    def _chunk_file(self, chunk, output_index):
+        ext = self.outputs[output_index][1].ext
+        return os.path.join(self.work_dir,
+                "chunk-%05d-%d.%s" % (chunk, output_index, ext))
+
+
+    def _encode_chunk(self, journal, chunk, msg_signal):
+        start, end = journal["chunks"][chunk]
+
+        outputs = [(self._chunk_file(chunk, i), codec)
+                for i, (_, codec) in enumerate(self.outputs)]
+        slice_timestamps = (FFTime(1000 * start), FFTime(1000 * (end - start)))
+
+        # Chunks are normalized with the loudness of the whole slice, not
+        # their own
+        loudness = None
+        if any(codec.loudness for _, codec in outputs):
+            loudness = self.ff.measure_loudness(self.input_file,
+                    self.slice_timestamps) or {}
+
+        cmd = self.ff.build_cmd(self.input_file, outputs, slice_timestamps,
+                self.resources, loudness)
+
+        return self.ff.run_sync(cmd, msg_signal, self.resources)
+
+
+    def _concat(self, journal, msg_signal):
+        for i, (output_file, _) in enumerate(self.outputs):
+            files = [self._chunk_file(chunk, i)
+                    for chunk in range(len(journal["chunks"]))]
+
+            # Every chunk was encoded on its own, with its own parameter sets
+            if self.ff.concat(files, output_file, msg_signal, self.resources,
+                    annexb=True):
+                return False
+
+        return True
+
+
+    def _fail(self, failure, msg_signal, finish_signal):
+        self.error = failure
+        msg_signal.emit("\nFailed, %s\n" % failure)
+        finish_signal.emit()
+
+
+    def _run(self, msg_signal, finish_signal):
+        self.error = None
+
+        try:
+            journal = self._load_journal()
+        except ValueError as e:
+            self._fail(JobFailure(JobFailure.UNREADABLE, str(e)),
+                    msg_signal, finish_signal)
+            return
+
+        chunks = journal["chunks"]
+
+        for chunk in range(len(chunks)):
+            if chunk in journal["done"]:
+                continue
+
+            msg_signal.emit("\nEncoding chunk %d/%d\n" % (chunk + 1, len(chunks)))
+
+            code = self._encode_chunk(journal, chunk, msg_signal)
+
+            if code == 0:
+                journal["done"].append(chunk)
+                self._save_journal(journal)
+
+            if self.paused:
+                msg_signal.emit("\nPaused, %d/%d chunks done\n"
+                        % (len(journal["done"]), len(chunks)))
+                return
+
+            if code:
+                self._fail(JobFailure(JobFailure.ERROR, "chunk %d/%d, exit code %d"
+                    % (chunk + 1, len(chunks), code)), msg_signal, finish_signal)
+                return
+
+        if not self._concat(journal, msg_signal):
+            # The chunks are kept, so running the job again only joins them
+            self._fail(JobFailure(JobFailure.ERROR,
+                "could not join the chunks"), msg_signal, finish_signal)
+            return
+
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        finish_signal.emit()
+
+
+    def start(self, msg_signal, finish_signal):
+        ''' Encode the missing chunks in a background thread '''
+        self.paused = False
+
+        self.thread = Thread(target=lambda: self._run(msg_signal, finish_signal))
+        self.thread.start()
+
+
+    def pause(self):
+        ''' Stop the current chunk. Finished chunks are kept. '''
+        self.paused = True
+        self.ff.terminate()
@@ -0,0 +1,145 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class SceneIndexer:
+    '''
+    Finds the scene cuts of a file.
+
+    ffmpeg streams tiny gray frames at a fixed rate to a FrameReader. Each
+    block of frames is scored against its predecessors with one vectorized
+    difference, and a frame whose mean absolute difference exceeds
+    THRESHOLD starts a new scene. Cuts are appended to a sorted float32
+    array of seconds that can be read with cuts() while the rest of the
+    file is still being indexed.
+    '''
+
+    FPS = 25
+    WIDTH = 32
+    HEIGHT = 18
+
+    # Mean absolute difference (0-255) between consecutive frames of a cut
+    THRESHOLD = 30
+    # Seconds between cuts, against flashes and fast pans
+    MIN_SCENE = 0.5
+
+    # Seconds of input between progress callbacks
+    PROGRESS = 30
+
+    def __init__(self, ff, filename):
+        if np is None:
+            raise RuntimeError("Scene detection needs NumPy")
+
+        self.ff = ff
+        self.filename = filename
+
+        self.raw = None
+        self.cancelled = False
+
+        # Seconds of input analyzed so far
+        self.analyzed = 0.0
+
+        self._cuts = np.empty(64, dtype=np.float32)
+        self._count = 0
+
+
+    def cuts(self):
+        ''' The cuts found so far, a view that is never modified in place '''
+        return self._cuts[:self._count]
+
+
+    def _add_cut(self, secs):
+        if self._count and secs - self._cuts[self._count - 1] < self.MIN_SCENE:
+            return
+
+        if self._count == len(self._cuts):
+            # A new array, so views handed out earlier stay valid
+            grown = np.empty(2 * len(self._cuts), dtype=np.float32)
+            grown[:self._count] = self._cuts[:self._count]
+            self._cuts = grown
+
+        self._cuts[self._count] = secs
+        self._count += 1
+
+
+    def _scan(self, reader, on_progress):
+        frame_size = self.WIDTH * self.HEIGHT
+        diff = np.empty((reader.block, frame_size), dtype=np.int16)
+        scores = np.empty(reader.block, dtype=np.float32)
+
+        # Last frame of the previous block, still valid in the reader's ring
+        previous = None
+        last_progress = 0.0
+
+        for block in reader:
+            n = block.count
+            frames = block.array
+
+            np.subtract(frames[1:], frames[:-1], out=diff[1:n], dtype=np.int16)
+            if previous is None:
+                # The first frame is not a cut
+                diff[0] = 0
+            else:
+                np.subtract(frames[0], previous, out=diff[0], dtype=np.int16)
+
+            np.abs(diff[:n], out=diff[:n])
+            np.mean(diff[:n], axis=1, out=scores[:n])
+
+            for i in np.flatnonzero(scores[:n] > self.THRESHOLD):
+                self._add_cut(block.time(int(i)))
+
+            previous = frames[-1]
+            self.analyzed = block.time(n)
+
+            if on_progress and self.analyzed - last_progress >= self.PROGRESS:
+                last_progress = self.analyzed
+                on_progress(self)
+
+
+    def run(self, on_progress=None):
+        '''
+        Index the whole file, calling on_progress(self) every PROGRESS
+        seconds of input. Returns the cuts, or None if cancelled or failed.
+        '''
+        self.raw = self.ff.open_raw(self.filename, [["-map", "0:v:0", "-vf",
+            "fps=%d,scale=%d:%d:flags=fast_bilinear,format=gray"
+            % (self.FPS, self.WIDTH, self.HEIGHT), "-f", "rawvideo"]])
+        if self.cancelled:
+            self.raw.stop()
+
+        frame_size = self.WIDTH * self.HEIGHT
+        with self.raw:
+            self._scan(self.raw.reader(0, frame_size, self.FPS, (frame_size,),
+                np.uint8, block=128), on_progress)
+
+        if self.raw.returncode != 0 or self.cancelled:
+            return None
+
+        if on_progress:
+            on_progress(self)
+
+        return self.cuts()
+
+
+    def cancel(self):
+        self.cancelled = True
+        if self.raw:
+            self.raw.stop()
@@ -0,0 +1,243 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from threading import Lock
+
+from output_codecs import SegmentedOutputCodec, is_stream
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+
+def _user():
+    return str(os.getuid()) if hasattr(os, "getuid") else os.getenv("USERNAME", "")
+
+
+class Reservation:
+    ''' Disk space set aside for a job, until released '''
+
+    def __init__(self, scratch, device, nbytes):
+        self.scratch = scratch
+        self.device = device
+        self.nbytes = nbytes
+
+
+    def release(self):
+        if self.scratch:
+            self.scratch._release(self)
+            self.scratch = None
+
+
+
+class ScratchSpace:
+    '''
+    Temporary storage for intermediate files (segments, cut sources) and
+    unfinished outputs.
+
+    Intermediate files go to the first usable directory of $SIMPLEFF_SCRATCH
+    (a list like $PATH, meant for tmpfs or a fast local disk), otherwise to
+    the system temp directory. Outputs are written next to their final path
+    under a hidden temporary name and renamed into place once complete, so
+    a failed or interrupted job never leaves a truncated output behind.
+
+    Each process works in its own locked run directory, which also lists
+    the temporary outputs it created. Run directories whose lock is no
+    longer held belong to crashed processes and are removed, together with
+    their leftover outputs, at startup.
+    '''
+
+    # Free space to always leave on a filesystem
+    MARGIN = 256 * (1 << 20)
+    # Without file locks, runs older than this are considered crashed
+    MAX_AGE = 24 * 3600
+
+    def __init__(self, roots=None):
+        if roots is None:
+            roots = [r for r in os.getenv("SIMPLEFF_SCRATCH", "").split(os.pathsep)
+                    if r]
+        roots = list(roots) + [tempfile.gettempdir()]
+
+        self.root = None
+        for root in roots:
+            root = os.path.join(root, "simpleff-" + _user())
+            try:
+                os.makedirs(root, mode=0o700, exist_ok=True)
+            except OSError:
+                continue
+            if os.access(root, os.W_OK | os.X_OK):
+                self.root = root
+                break
+
+        if self.root is None:
+            raise OSError("No usable scratch directory")
+
+        self.lock = Lock()
+        # st_dev -> bytes reserved by running jobs
+        self.reserved = {}
+
+        self.collect()
+
+        self.run_dir = tempfile.mkdtemp(prefix="run-", dir=self.root)
+        self._lock_file = open(os.path.join(self.run_dir, ".lock"), "w")
+        if fcntl:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._lock_file.write(str(os.getpid()))
+        self._lock_file.flush()
+
+        self._manifest = open(os.path.join(self.run_dir, "outputs"), "a")
+
+
+    def _orphaned(self, run_dir):
+        try:
+            f = open(os.path.join(run_dir, ".lock"))
+        except OSError:
+            # Crashed before taking the lock
+            return True
+
+        with f:
+            if fcntl is None:
+                # No way to tell if the process is alive, go by age
+                return time.time() - os.fstat(f.fileno()).st_mtime > self.MAX_AGE
+
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+
+            # Closing the file drops the lock again
+            return True
+
+
+    def collect(self):
+        ''' Remove what crashed runs left behind '''
+        for entry in os.scandir(self.root):
+            if not entry.name.startswith("run-") or not self._orphaned(entry.path):
+                continue
+
+            try:
+                with open(os.path.join(entry.path, "outputs")) as f:
+                    for path in f.read().splitlines():
+                        _try_rm(path)
+            except OSError:
+                pass
+
+            print("Removing orphaned scratch", entry.path, file=sys.stderr)
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+    def mkdtemp(self, prefix="tmp-"):
+        ''' A new directory for intermediate files, removed by close() '''
+        return tempfile.mkdtemp(prefix=prefix, dir=self.run_dir)
+
+
+    def reserve(self, path, nbytes):
+        '''
+        Set aside nbytes on the filesystem of path. Returns a Reservation,
+        or None if there isn't enough room.
+        '''
+        if not os.path.isdir(path):
+            path = os.path.dirname(os.path.abspath(path))
+
+        try:
+            device = os.stat(path).st_dev
+            free = shutil.disk_usage(path).free
+        except OSError:
+            # Can't tell, let the job find out
+            return Reservation(None, None, 0)
+
+        with self.lock:
+            reserved = self.reserved.get(device, 0)
+            if free - reserved - self.MARGIN < nbytes:
+                return None
+
+            self.reserved[device] = reserved + nbytes
+
+        return Reservation(self, device, nbytes)
+
+
+    def _release(self, reservation):
+        with self.lock:
+            self.reserved[reservation.device] -= reservation.nbytes
+
+
+    def temp_output(self, output_file):
+        '''
+        Hidden temporary name for output_file in the same directory, so
+        the final rename is atomic. The extension is kept for ffmpeg.
+        '''
+        directory, name = os.path.split(os.path.abspath(output_file))
+        ext = os.path.splitext(name)[1]
+        temp = os.path.join(directory, ".%s.%s.part%s"
+                % (name, uuid.uuid4().hex[:8], ext))
+
+        with self.lock:
+            self._manifest.write(temp + "\n")
+            self._manifest.flush()
+
+        return temp
+
+
+    def temp_outputs(self, outputs):
+        '''
+        Temporary outputs to write instead of outputs. Streams and segmented
+        outputs (a playlist plus many files) are written in place.
+        '''
+        temps = []
+        for output_file, codec in outputs:
+            if not is_stream(output_file) and \
+                    not isinstance(codec, SegmentedOutputCodec):
+                output_file = self.temp_output(output_file)
+
+            temps.append((output_file, codec))
+
+        return temps
+
+
+    def commit(self, temps, outputs):
+        ''' Move finished temporary outputs into place '''
+        for (temp, _), (output_file, _) in zip(temps, outputs):
+            if temp != output_file:
+                os.replace(temp, output_file)
+
+
+    def discard(self, temps, outputs):
+        for (temp, _), (output_file, _) in zip(temps, outputs):
+            if temp != output_file:
+                _try_rm(temp)
+
+
+    def close(self):
+        self._manifest.close()
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self._lock_file.close()
+
+
+
+def _try_rm(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,434 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hmac
+import json
+import os
+import queue
+import secrets
+import socketserver
+import sys
+import time
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+
+from engine import Job
+from ff import FFTime
+from output_codecs import find_codec
+
+
+FINISHED_NAMES = ("done", "failed", "cancelled")
+
+# Host headers accepted, so a web page can't reach the service through DNS
+# rebinding
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+def job_to_dict(job):
+    return {
+        "id": job.id,
+        "input": job.input_file,
+        "outputs": [output_file for output_file, _ in job.outputs],
+        "formats": [codec.name for _, codec in job.outputs],
+        "status": Job.STATUS_NAMES[job.status],
+        "priority": job.priority,
+        "progress": job.progress(),
+        "encoded": job.encoded,
+        "speed": job.speed,
+        "eta": job.eta(),
+        "metrics": job.metrics.summary() if job.metrics else None,
+        "attempts": job.attempts,
+        "error": {"kind": job.error.kind, "message": str(job.error)}
+            if job.error else None,
+        }
+
+
+class JobService:
+    '''
+    Accepts jobs from other processes and runs them on a shared JobEngine,
+    so every client goes through the same scheduler and worker pools.
+
+    The API is JSON over HTTP, on localhost or a Unix socket. Over TCP
+    every request needs "Authorization: Bearer TOKEN", with the token from
+    $SIMPLEFF_TOKEN or one generated and printed at startup; the Unix
+    socket is only accessible to its owner. Requests must name localhost
+    as their Host and submissions must be application/json, which keeps
+    web pages from forging them.
+
+        POST   /jobs              submit, see parse_jobs() for the body
+        GET    /jobs              state of every known job
+        GET    /jobs/<id>         state of one job
+        DELETE /jobs/<id>         cancel
+        GET    /events            progress events of all jobs (JSON lines)
+        GET    /jobs/<id>/events  progress events of one job until it ends
+        GET    /stats             throughput per format and resolution
+                                  (JobHistory.stats)
+
+    Finished jobs are forgotten RETENTION seconds after they end.
+    '''
+
+    RETENTION = 3600
+
+    def __init__(self, engine, token=None):
+        self.engine = engine
+        self.jobs = {}
+        # Job id -> when it finished, oldest first
+        self.finished = OrderedDict()
+        self.subscribers = []
+        self.lock = Lock()
+
+        # Set for TCP by serve(), None means no token is needed
+        self.token = token
+        self.hosts = LOCAL_HOSTS
+
+
+    def parse_jobs(self, body):
+        '''
+        Jobs for a submission: {"input": path, "formats": ["mp4", "mp3"],
+        "output": path, "slices": [[start, end], ...], "priority": n,
+        "fps": n, "loudnorm": true}
+
+        Times are in seconds or timecodes (FFTime.parse), SMPTE timecodes
+        need fps. Without slices the whole input is converted. Without an
+        output, outputs go to converted/ next to the input; an output can't
+        be the input itself.
+        Each slice becomes its own job; outputs of later slices get a
+        numbered suffix. With loudnorm the audio is normalized to EBU R128.
+        '''
+        input_file = body["input"]
+        if not os.path.isfile(input_file):
+            raise ValueError("No such input file: %s" % input_file)
+
+        formats = body.get("formats") or [body.get("format", "mp4")]
+        codecs = []
+        for name in formats:
+            codec = find_codec(name, self.engine.ff.codecs())
+            if codec is None:
+                raise ValueError("Unknown format: %s" % name)
+            if body.get("loudnorm"):
+                codec = codec.normalized()
+            codecs.append(codec)
+
+        output = body.get("output")
+        if not output:
+            # Like watch folders, never next to the input under the same name
+            output = os.path.join(os.path.dirname(os.path.abspath(input_file)),
+                    "converted", os.path.basename(input_file))
+        base = output.rsplit(".", 1)[0]
+
+        slices = body.get("slices") or [None]
+        jobs = []
+        for i, slice_secs in enumerate(slices):
+            suffix = "" if i == 0 else "-%d" % i
+            outputs = [(base + suffix + "." + codec.ext, codec)
+                    for codec in codecs]
+            for output_file, _ in outputs:
+                if os.path.realpath(output_file) == os.path.realpath(input_file):
+                    raise ValueError("Output would overwrite the input: %s"
+                            % output_file)
+
+            slice_timestamps = (None, None)
+            if slice_secs:
+                start = FFTime.parse(str(slice_secs[0]), body.get("fps"))
+                end = FFTime.parse(str(slice_secs[1]), body.get("fps"))
+                if end.to_ms() <= start.to_ms():
+                    raise ValueError("Slice %d ends before it starts: %s-%s"
+                            % (i + 1, start, end))
+                slice_timestamps = (start, end - start)
+
+            jobs.append(Job(input_file, outputs, slice_timestamps,
+                int(body.get("priority", Job.NORMAL))))
+
+        if not body.get("output"):
+            try:
+                os.makedirs(os.path.dirname(base), exist_ok=True)
+            except OSError as e:
+                raise ValueError("Can't create the output folder: %s" % e)
+
+        return jobs
+
+
+    def submit(self, body):
+        jobs = self.parse_jobs(body)
+
+        self.prune()
+
+        for job in jobs:
+            job.progress_signal.connect(self._publish)
+            job.finish_signal.connect(self._publish)
+            job.finish_signal.connect(self._finished)
+
+            with self.lock:
+                self.jobs[job.id] = job
+
+            self.engine.submit(job)
+
+        return jobs
+
+
+    def _finished(self, job):
+        with self.lock:
+            self.finished[job.id] = time.monotonic()
+
+
+    def prune(self):
+        ''' Forget jobs that finished more than RETENTION seconds ago '''
+        expired = time.monotonic() - self.RETENTION
+
+        with self.lock:
+            while self.finished:
+                job_id, finished = next(iter(self.finished.items()))
+                if finished > expired:
+                    break
+
+                del self.finished[job_id]
+                self.jobs.pop(job_id, None)
+
+
+    def _publish(self, job):
+        event = job_to_dict(job)
+
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for job_id, q in subscribers:
+            if job_id is None or job_id == job.id:
+                q.put(event)
+
+
+    def subscribe(self, job_id=None):
+        q = queue.Queue()
+        with self.lock:
+            self.subscribers.append((job_id, q))
+
+        return q
+
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers = [(j, s) for j, s in self.subscribers if s is not q]
+
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job:
+            self.engine.cancel(job)
+
+        return job
+
+
+    def handler(self):
+        return type("Handler", (ServiceRequestHandler,), {"service": self})
+
+
+    def serve(self, address):
+        '''
+        Serve on "host:port" or "unix:/path/to/socket" until interrupted
+        '''
+        if address.startswith("unix:"):
+            path = address[len("unix:"):]
+            if os.path.exists(path):
+                os.remove(path)
+
+            # Created private, not just chmodded once it exists
+            umask = os.umask(0o177)
+            try:
+                server = UnixHTTPServer(path, self.handler())
+            finally:
+                os.umask(umask)
+        else:
+            host, _, port = address.rpartition(":")
+            host = host.strip("[]") or "127.0.0.1"
+
+            if self.token is None:
+                self.token = os.getenv("SIMPLEFF_TOKEN")
+            if not self.token:
+                self.token = secrets.token_urlsafe(24)
+                print("Token:", self.token, file=sys.stderr)
+
+            # Clients may also name the address the service listens on
+            if host not in ("0.0.0.0", "::"):
+                self.hosts = LOCAL_HOSTS + (host,)
+
+            server = ThreadingHTTPServer((host, int(port)), self.handler())
+
+        print("Serving on", address)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+
+    service = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+    def _send_json(self, obj, code=200):
+        data = json.dumps(obj).encode("utf-8")
+
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def _host(self):
+        host = self.headers.get("Host", "")
+        if host.startswith("["):
+            # [::1]:port
+            return host[1:].partition("]")[0]
+
+        return host.rpartition(":")[0] if host.count(":") == 1 else host
+
+
+    def _allowed(self):
+        ''' Checks Host and the token. Sends the error if not allowed. '''
+        if self._host().lower() not in self.service.hosts:
+            self._send_json({"error": "Host not allowed"}, 403)
+            return False
+
+        token = self.service.token
+        if token:
+            given = self.headers.get("Authorization", "")
+            if not hmac.compare_digest(given.encode("utf-8"),
+                    ("Bearer " + token).encode("utf-8")):
+                self._send_json({"error": "Unauthorized"}, 401)
+                return False
+
+        return True
+
+
+    def _job_id(self, parts):
+        try:
+            return int(parts[1])
+        except (IndexError, ValueError):
+            return None
+
+
+    def do_GET(self):
+        if not self._allowed():
+            return
+
+        parts = self.path.strip("/").split("/")
+
+        if parts == ["jobs"]:
+            self.service.prune()
+            with self.service.lock:
+                jobs = list(self.service.jobs.values())
+            return self._send_json([job_to_dict(job) for job in jobs])
+
+        if parts == ["events"]:
+            return self._stream_events(None)
+
+        if parts == ["stats"]:
+            history = self.service.engine.ff.history
+            return self._send_json(history.stats() if history else [])
+
+        if parts[0] == "jobs" and len(parts) in (2, 3):
+            job = self.service.jobs.get(self._job_id(parts))
+            if not job:
+                return self._send_json({"error": "No such job"}, 404)
+
+            if len(parts) == 3 and parts[2] == "events":
+                return self._stream_events(job)
+
+            return self._send_json(job_to_dict(job))
+
+        self._send_json({"error": "Not found"}, 404)
+
+
+    def do_POST(self):
+        if not self._allowed():
+            return
+
+        if self.path.strip("/") != "jobs":
+            return self._send_json({"error": "Not found"}, 404)
+
+        # Forms can't send JSON, so cross-site posts are rejected here
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.split(";")[0].strip().lower() != "application/json":
+            return self._send_json(
+                    {"error": "Content-Type must be application/json"}, 415)
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length).decode("utf-8"))
+            jobs = self.service.submit(body)
+        except (KeyError, TypeError, ValueError) as e:
+            return self._send_json({"error": str(e)}, 400)
+
+        self._send_json([job_to_dict(job) for job in jobs], 201)
+
+
+    def do_DELETE(self):
+        if not self._allowed():
+            return
+
+        parts = self.path.strip("/").split("/")
+        job = None
+        if parts[0] == "jobs" and len(parts) == 2:
+            job = self.service.cancel(self._job_id(parts))
+
+        if not job:
+            return self._send_json({"error": "No such job"}, 404)
+
+        self._send_json(job_to_dict(job))
+
+
+    def _stream_events(self, job):
+        ''' One JSON object per line, until the job ends or the client leaves '''
+        q = self.service.subscribe(job.id if job else None)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        try:
+            if job:
+                q.put(job_to_dict(job))
+
+            while True:
+                try:
+                    event = q.get(timeout=15)
+                except queue.Empty:
+                    # Keepalive, also notices clients that went away
+                    event = {}
+
+                self.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+                if job and event.get("status") in FINISHED_NAMES:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.service.unsubscribe(q)
+            self.close_connection = True
@@ -14,24 +14,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import argparse
 import atexit
 import functools
 import os
 import signal
 import sys
+import threading
 
 from PyQt5.QtWidgets import (
+        QAbstractItemView,
         QApplication,
+        QCheckBox,
         QComboBox,
         QDesktopWidget,
         QFileDialog,
         QFormLayout,
         QHBoxLayout,
+        QHeaderView,
         QLabel,
         QLineEdit,
         QMainWindow,
         QMessageBox,
         QPushButton,
+        QTableView,
         QTabWidget,
         QTextEdit,
         QVBoxLayout,
@@ -42,9 +48,19 @@ from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 from PyQt5.QtGui import QIcon
 
 # Local imports
+import cutlist
+import distributed
+import engine
 import ff
-from output_codecs import AVAILABLE_CODECS
+import jobtable
+import join
+from output_codecs import find_codec
 import qtRangeSlider
+import resumable
+import service
+import tracing
+import verify
+import watch
 
 
 # Globals
@@ -72,6 +88,7 @@ class App(QMainWindow):
     def closeEvent(self, event):
         # First terminate running processes
         FF.terminate()
+        self.table_widget.queue_widget.stop()
 
         event.accept()
 
@@ -143,6 +160,8 @@ class FilePickerWidget(QWidget):
             if error_code == 0:
                 # Reset slider to match new input video length
                 self.parent.slice_widget.set_hslider(length)
+                self.parent.slice_widget.index_scenes(filename)
+                self.parent.show_estimate(filename)
                 return True
             else:
                 if filename != "":
@@ -195,40 +214,123 @@ class FilePickerWidget(QWidget):
 
 class CodecsWidget(QWidget):
 
+    # Emitted from the thread benchmarking encoders if the choice changed
+    benchmarked_signal = pyqtSignal()
+
     def __init__(self, parent):
         super(QWidget, self).__init__(parent)
         self.parent = parent
         self.layout = QHBoxLayout(self)
         self.layout.setContentsMargins(10, 0, 10, 10)
 
-        self.combo = QComboBox()
-        for codec_obj in AVAILABLE_CODECS:
-            self.combo.addItem(codec_obj.name, codec_obj)
+        # Several formats can be selected at once. They are all written by
+        # the same ffmpeg process, so the input is only decoded once. Only
+        # the formats the ffmpeg binary supports are offered.
+        self.checkboxes = []
+        for codec_obj in FF.codecs():
+            checkbox = QCheckBox(codec_obj.name)
+            checkbox.codec = codec_obj
+            checkbox.toggled.connect(
+                    functools.partial(self.on_change, checkbox=checkbox))
+
+            self.checkboxes.append(checkbox)
+            self.layout.addWidget(checkbox)
 
-        self.combo.currentIndexChanged.connect(self.on_change)
+        self.checkboxes[0].setChecked(True)
 
-        self.layout.addWidget(self.combo)
         self.setLayout(self.layout)
 
+        self.benchmarked_signal.connect(self.update_codecs)
+        threading.Thread(target=self.benchmark, daemon=True).start()
+
+
+    def benchmark(self):
+        if FF.benchmark_codecs():
+            self.benchmarked_signal.emit()
+
+
+    def update_codecs(self):
+        ''' Switch to the encoders picked by benchmark_codecs() '''
+        for checkbox, codec_obj in zip(self.checkboxes, FF.codecs()):
+            checkbox.codec = codec_obj
+            checkbox.setText(codec_obj.name)
+
+
+    def on_change(self, checked, checkbox):
+        # At least one format must always be selected
+        if not checked and not self.get_codecs():
+            checkbox.setChecked(True)
+            return
 
-    def on_change(self):
         # Update output filename extension
         output_widget = self.parent.output_widget
 
         if output_widget.get_filename() != "":
             output_widget.set_default_output()
 
+        input_file = self.parent.input_widget.get_filename()
+        if input_file:
+            self.parent.show_estimate(input_file)
+
 
     def get_codec(self):
-        return self.combo.currentData()
+        ''' The primary codec, which determines the output filename '''
+        return self.get_codecs()[0]
+
+
+    def get_codecs(self):
+        return [checkbox.codec for checkbox in self.checkboxes
+                if checkbox.isChecked()]
+
+
+    def get_outputs(self, output_file):
+        '''
+        Pair each selected codec with an output filename. The first codec
+        uses output_file as-is, the rest share its base name.
+        '''
+        codecs = self.get_codecs()
+        if self.parent.loudness_checkbox.isChecked():
+            codecs = [codec_obj.normalized() for codec_obj in codecs]
+
+        return pair_outputs(output_file, codecs)
+
+
+
+def pair_outputs(output_file, codecs):
+    base = output_file.rsplit(".", 1)[0]
+
+    outputs = [(output_file, codecs[0])]
+    used = set([output_file])
+    for codec_obj in codecs[1:]:
+        filename = base + "." + codec_obj.ext
+        if filename in used:
+            filename = "%s-%d.%s" % (base, len(used), codec_obj.ext)
+
+        used.add(filename)
+        outputs.append((filename, codec_obj))
+
+    return outputs
 
 
 class SliceWidget(QWidget):
 
+    # Suggested (start, end) seconds, or None
+    trim_signal = pyqtSignal(object)
+    # Generation and scene cuts (seconds) found so far
+    scenes_signal = pyqtSignal(int, object)
+
     def __init__(self, parent):
         super(QWidget, self).__init__(parent)
+        self.parent = parent
 
         self.is_reversed = False
+        self.trimming = False
+        self.trim_detector = None
+
+        # Bumped for every input, so late results of an earlier input are
+        # ignored
+        self.scene_generation = 0
+        self.scene_indexer = None
 
         # Setup GUI
         self.layout = QVBoxLayout(self)
@@ -242,7 +344,16 @@ class SliceWidget(QWidget):
         self.max_ts = QLabel("00:00:00.000")
         self.max_ts.setAlignment(Qt.AlignRight)
 
+        # Suggests start and end points without black and silent lead-in
+        # and lead-out
+        self.trim_button = QPushButton("Auto trim")
+        self.trim_button.setEnabled(False)
+        self.trim_button.clicked.connect(self.on_trim)
+        self.trim_signal.connect(self.on_trim_done)
+        self.scenes_signal.connect(self.on_scenes)
+
         status.addWidget(self.min_ts)
+        status.addWidget(self.trim_button)
         status.addWidget(self.max_ts)
 
         self.hlayout.setLayout(status)
@@ -251,6 +362,7 @@ class SliceWidget(QWidget):
         self.set_hslider(ff.FFTime(2000))
         self.hslider.setEnabled(False)
 
+        @tracing.traced("SliceWidget.on_change", "gui")
         def on_change(min_val, max_val):
             if self.is_reversed:
                 # Swap min,max if reversed
@@ -268,6 +380,7 @@ class SliceWidget(QWidget):
             print("on_change: %s,%s" % (str(min_val), str(max_val)))
 
         self.hslider.rangeChanged.connect(on_change)
+        self.hslider.setToolTip("Hold Shift while dragging to snap to scene cuts")
 
         self.layout.addWidget(self.hlayout)
         self.layout.addWidget(self.hslider)
@@ -275,6 +388,93 @@ class SliceWidget(QWidget):
         self.setLayout(self.layout)
 
 
+    def index_scenes(self, input_file):
+        '''
+        Index the scene cuts of input_file in the background, for the
+        slider handles to snap to. Cuts become usable as they are found.
+        '''
+        if self.scene_indexer:
+            self.scene_indexer.cancel()
+            self.scene_indexer = None
+
+        self.scene_generation += 1
+        generation = self.scene_generation
+        self.hslider.setSnapPoints(None)
+
+        def on_start(indexer):
+            if generation == self.scene_generation:
+                self.scene_indexer = indexer
+            else:
+                indexer.cancel()
+
+        def on_progress(indexer):
+            self.scenes_signal.emit(generation, indexer.cuts())
+
+        def index():
+            try:
+                cuts = FF.index_scenes(input_file, on_start, on_progress)
+            except Exception as e:
+                print("Scene detection failed:", e, file=sys.stderr)
+                return
+
+            if cuts is not None:
+                self.scenes_signal.emit(generation, cuts)
+
+        threading.Thread(target=index, daemon=True).start()
+
+
+    @tracing.traced("SliceWidget.on_scenes", "gui")
+    def on_scenes(self, generation, cuts):
+        if generation != self.scene_generation:
+            return
+
+        # Cuts are in seconds, the slider in ms
+        self.hslider.setSnapPoints(cuts, 1000)
+
+
+    def on_trim(self):
+        if self.trimming:
+            if self.trim_detector:
+                self.trim_detector.cancel()
+            return
+
+        input_file = self.parent.input_widget.get_filename()
+        if not input_file:
+            return
+
+        def on_start(detector):
+            self.trim_detector = detector
+
+        def detect():
+            try:
+                result = FF.detect_trim(input_file, on_start)
+            except Exception as e:
+                self.parent.msg_text.msg_signal.emit("Auto trim failed: %s\n" % e)
+                result = None
+
+            self.trim_signal.emit(result)
+
+        self.trimming = True
+        self.trim_button.setText("Cancel")
+        threading.Thread(target=detect, daemon=True).start()
+
+
+    @tracing.traced("SliceWidget.on_trim_done", "gui")
+    def on_trim_done(self, result):
+        self.trimming = False
+        self.trim_detector = None
+        self.trim_button.setText("Auto trim")
+
+        if result is None:
+            return
+
+        start, end = result
+        self.is_reversed = False
+        self.hslider.setValues([max(0, int(start * 1000)),
+            min(self.hslider.end, int(end * 1000))])
+
+
+    @tracing.traced("SliceWidget.set_hslider", "gui")
     def set_hslider(self, length):
         ms = length.to_ms()
 
@@ -282,6 +482,7 @@ class SliceWidget(QWidget):
             self.hslider.setEnabled(True)
             self.hslider.setRange([0, ms, 1])
             self.hslider.setValues([0, ms])
+            self.trim_button.setEnabled(True)
 
             self.min_ts.setText("00:00:00.000")
             self.max_ts.setText(str(length))
@@ -327,6 +528,7 @@ class ConsoleArea(QTextEdit):
         self.msg_signal.connect(self.append)
 
 
+    @tracing.traced("ConsoleArea.append", "gui")
     def append(self, s):
         self.insertPlainText(s)
         self.ensureCursorVisible()
@@ -338,6 +540,7 @@ class RunButton(QPushButton):
     # Enums
     IDLE = 0
     RUNNING = 1
+    PAUSED = 2
 
     def __init__(self, parent):
         super(QPushButton, self).__init__("Run", parent)
@@ -346,6 +549,7 @@ class RunButton(QPushButton):
         self.clicked.connect(self.on_click)
 
         self.status = RunButton.IDLE;
+        self.job = None
 
         self.finish_signal.connect(self.on_finish)
 
@@ -359,13 +563,15 @@ class RunButton(QPushButton):
         if status == RunButton.IDLE:
             self.setText("Run")
 
+        if status == RunButton.PAUSED:
+            self.setText("Resume")
+
     def on_click(self):
 
-        if self.status == RunButton.IDLE:
+        if self.status in (RunButton.IDLE, RunButton.PAUSED):
 
             input_file = self.parent.input_widget.get_filename()
             output_file = self.parent.output_widget.get_filename()
-            codec = self.parent.codecs_widget.get_codec()
             slice_timestamps = self.parent.slice_widget.get_slice_timestamps()
 
             # Exit if input/output file not chosen
@@ -374,11 +580,17 @@ class RunButton(QPushButton):
                         "You must select an input and output file")
                 return
 
+            outputs = self.parent.codecs_widget.get_outputs(output_file)
 
-            # Warn if will overwrite existing file
-            if os.path.exists(output_file):
-                msg = "File \"%s\" already exists. Do you want to replace it?" \
-                        % output_file
+            # Warn if will overwrite existing files
+            existing = [f for f, _ in outputs if os.path.exists(f)]
+            if existing:
+                if len(existing) == 1:
+                    msg = "File \"%s\" already exists. Do you want to replace it?" \
+                            % existing[0]
+                else:
+                    msg = "Files \"%s\" already exist. Do you want to replace them?" \
+                            % "\", \"".join(existing)
 
                 reply = QMessageBox.warning(self, "Warning", msg,
                         QMessageBox.Yes, QMessageBox.No)
@@ -387,20 +599,257 @@ class RunButton(QPushButton):
 
 
             # Run process
-            self.set_status(RunButton.RUNNING)
-            FF.run(input_file, output_file, codec,
-                    slice_timestamps,
-                    self.parent.msg_text.msg_signal, self.finish_signal)
+            msg_signal = self.parent.msg_text.msg_signal
+
+            if self.parent.resumable_checkbox.isChecked():
+                # Picks up where a paused or crashed run of the same job
+                # left off
+                try:
+                    self.job = resumable.ResumableJob(FF, input_file, outputs,
+                            slice_timestamps)
+                except ValueError as e:
+                    QMessageBox.critical(self, "Error", str(e))
+                    return
+
+                self.set_status(RunButton.RUNNING)
+                self.job.start(msg_signal, self.finish_signal)
+            else:
+                self.job = None
+
+                self.set_status(RunButton.RUNNING)
+                FF.run(input_file, outputs,
+                        slice_timestamps,
+                        msg_signal, self.finish_signal)
 
         elif self.status == RunButton.RUNNING:
-            # Terminate process
-            self.set_status(RunButton.IDLE)
-            FF.terminate()
+            self.parent.pause_button.reset()
+
+            if self.job:
+                # Keep the finished chunks
+                self.set_status(RunButton.PAUSED)
+                self.job.pause()
+            else:
+                # Terminate process
+                self.set_status(RunButton.IDLE)
+                FF.terminate()
 
 
     def on_finish(self):
+        failed = (self.job.error if self.job else FF.error) is not None
+
+        self.job = None
         self.set_status(RunButton.IDLE)
-        self.parent.msg_text.append("\nDone\n")
+        self.parent.pause_button.reset()
+        self.parent.msg_text.append("\nFailed\n" if failed else "\nDone\n")
+
+
+class PauseButton(QPushButton):
+    ''' Suspends the running ffmpeg process without losing its work '''
+
+    def __init__(self, parent):
+        super(QPushButton, self).__init__("Pause", parent)
+        self.parent = parent
+        self.paused = False
+
+        self.clicked.connect(self.on_click)
+
+
+    def on_click(self):
+        if self.paused:
+            FF.resume()
+            self.paused = False
+            self.setText("Pause")
+            self.parent.msg_text.append("\nResumed\n")
+        elif FF.suspend():
+            self.paused = True
+            self.setText("Resume")
+            self.parent.msg_text.append("\nPaused\n")
+
+
+    def reset(self):
+        self.paused = False
+        self.setText("Pause")
+
+
+class QueueWidget(QWidget):
+    '''
+    Batch conversions of many files on a JobEngine, with the formats chosen
+    in the Convert tab. Outputs go to a "converted" folder next to each
+    input.
+    '''
+
+    # Status filter choices
+    FILTERS = [
+        ("All", None),
+        ("Active", (engine.Job.QUEUED, engine.Job.RUNNING, engine.Job.PAUSED)),
+        ("Done", (engine.Job.DONE,)),
+        ("Failed", (engine.Job.FAILED, engine.Job.CANCELLED)),
+        ]
+
+    def __init__(self, parent):
+        super(QWidget, self).__init__(parent)
+        self.parent = parent
+        self.job_engine = None
+
+        self.layout = QVBoxLayout(self)
+
+        # Toolbar
+        toolbar = QWidget()
+        toolbar.layout = QHBoxLayout(toolbar)
+        toolbar.layout.setContentsMargins(0, 0, 0, 0)
+
+        self.files_button = QPushButton("Add files")
+        self.files_button.clicked.connect(self.on_add_files)
+        self.folder_button = QPushButton("Add folder")
+        self.folder_button.clicked.connect(self.on_add_folder)
+        self.cancel_button = QPushButton("Cancel selected")
+        self.cancel_button.clicked.connect(self.on_cancel)
+
+        self.filter_line = QLineEdit()
+        self.filter_line.setPlaceholderText("Filter")
+        self.status_combo = QComboBox()
+        for label, _ in self.FILTERS:
+            self.status_combo.addItem(label)
+
+        # Refilter once typing pauses, not on every key
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.timeout.connect(self.apply_filter)
+        self.filter_line.textChanged.connect(
+                lambda text: self.filter_timer.start(200))
+        self.status_combo.currentIndexChanged.connect(self.apply_filter)
+
+        toolbar.layout.addWidget(self.files_button)
+        toolbar.layout.addWidget(self.folder_button)
+        toolbar.layout.addWidget(self.filter_line)
+        toolbar.layout.addWidget(self.status_combo)
+        toolbar.layout.addWidget(self.cancel_button)
+        toolbar.setLayout(toolbar.layout)
+
+        # Table. Fixed row heights and column widths, so the view never
+        # measures rows it doesn't show.
+        self.model = jobtable.JobTableModel(self)
+
+        self.view = QTableView()
+        self.view.setModel(self.model)
+        self.view.setWordWrap(False)
+        self.view.setSelectionBehavior(QAbstractItemView.SelectRows)
+
+        rows = self.view.verticalHeader()
+        rows.hide()
+        rows.setSectionResizeMode(QHeaderView.Fixed)
+        rows.setDefaultSectionSize(self.view.fontMetrics().height() + 6)
+
+        columns = self.view.horizontalHeader()
+        columns.setSectionResizeMode(QHeaderView.Interactive)
+        columns.setSectionResizeMode(jobtable.JobTableModel.INPUT,
+                QHeaderView.Stretch)
+
+        self.view.setSortingEnabled(True)
+        self.view.sortByColumn(jobtable.JobTableModel.ID, Qt.AscendingOrder)
+
+        self.count_label = QLabel("")
+        self.model.rowsInserted.connect(self.update_count)
+        self.model.layoutChanged.connect(self.update_count)
+
+        self.layout.addWidget(toolbar)
+        self.layout.addWidget(self.view)
+        self.layout.addWidget(self.count_label)
+        self.setLayout(self.layout)
+
+
+    def update_count(self, *args):
+        shown, total = self.model.rowCount(), self.model.total()
+        if shown == total:
+            self.count_label.setText("%d jobs" % total)
+        else:
+            self.count_label.setText("%d of %d jobs" % (shown, total))
+
+
+    def apply_filter(self):
+        _, statuses = self.FILTERS[self.status_combo.currentIndex()]
+        self.model.set_filter(self.filter_line.text(), statuses)
+
+
+    def on_add_files(self):
+        filenames, _ = QFileDialog.getOpenFileNames(self, "Add files",
+                os.getenv("Home"))
+        if filenames:
+            self.add(filenames)
+
+
+    def on_add_folder(self):
+        directory = QFileDialog.getExistingDirectory(self, "Add folder",
+                os.getenv("Home"))
+        if directory:
+            self.add([directory])
+
+
+    def add(self, paths):
+        '''
+        Queue the files in paths, and every file under the directories in
+        paths. Files are found and probed in a thread.
+        '''
+        codecs = self.parent.codecs_widget.get_codecs()
+        if self.parent.loudness_checkbox.isChecked():
+            codecs = [codec_obj.normalized() for codec_obj in codecs]
+
+        if self.job_engine is None:
+            self.job_engine = engine.JobEngine(FF)
+            self.job_engine.start()
+
+        threading.Thread(target=lambda: self._submit(paths, codecs),
+                daemon=True).start()
+
+
+    def _input_files(self, paths):
+        for path in paths:
+            if not os.path.isdir(path):
+                yield path
+                continue
+
+            for root, dirs, files in os.walk(path):
+                # Skip earlier outputs and hidden directories
+                dirs[:] = [d for d in dirs
+                        if d != "converted" and not d.startswith(".")]
+                for name in sorted(files):
+                    if not name.startswith("."):
+                        yield os.path.join(root, name)
+
+
+    def _submit(self, paths, codecs):
+        for input_file in self._input_files(paths):
+            output_dir = os.path.join(os.path.dirname(input_file), "converted")
+            base = os.path.basename(input_file).rsplit(".", 1)[0]
+            outputs = pair_outputs(
+                    os.path.join(output_dir, base + "." + codecs[0].ext), codecs)
+
+            try:
+                os.makedirs(output_dir, exist_ok=True)
+            except OSError as e:
+                print("Can't queue %s: %s" % (input_file, e), file=sys.stderr)
+                continue
+
+            job = engine.Job(input_file, outputs)
+            self.model.add_job(job)
+            self.job_engine.submit(job)
+
+
+    def on_cancel(self):
+        if self.job_engine is None:
+            return
+
+        for index in self.view.selectionModel().selectedRows():
+            job = self.model.job_at(index.row())
+            if job.status in (engine.Job.QUEUED, engine.Job.RUNNING,
+                    engine.Job.PAUSED):
+                self.job_engine.cancel(job)
+
+
+    def stop(self):
+        if self.job_engine:
+            self.job_engine.stop()
+
 
 
 class TabWidget(QWidget):
@@ -420,6 +869,9 @@ class TabWidget(QWidget):
         self.tabs.addTab(tab1, "Convert")
         # self.tabs.addTab(self.tab2, "Custom")
 
+        self.queue_widget = QueueWidget(self)
+        self.tabs.addTab(self.queue_widget, "Queue")
+
         # Create first tab
         tab1.layout = QVBoxLayout(self)
 
@@ -433,18 +885,62 @@ class TabWidget(QWidget):
 
         # Codecs
         self.codecs_widget = CodecsWidget(self)
-        form.layout.addRow("Output Format:", self.codecs_widget)
+        form.layout.addRow("Output Formats:", self.codecs_widget)
 
 
         # Slice
         self.slice_widget = SliceWidget(self)
         form.layout.addRow("Slice:", self.slice_widget)
 
+        # Options
+        options = QWidget()
+        options.layout = QHBoxLayout(options)
+        options.layout.setContentsMargins(10, 0, 10, 10)
+
+        self.resumable_checkbox = QCheckBox("Resumable (Stop pauses the job)")
+
+        self.cache_checkbox = QCheckBox("Reuse cached results")
+        self.cache_checkbox.setChecked(FF.cache.enabled)
+        self.cache_checkbox.toggled.connect(
+                lambda checked: setattr(FF.cache, "enabled", checked))
+
+        # Header probe of every output before it replaces anything
+        self.verify_checkbox = QCheckBox("Verify outputs")
+        self.verify_checkbox.setChecked(FF.verifier is not None)
+        self.verify_checkbox.toggled.connect(lambda checked: setattr(FF,
+            "verifier", verify.Verifier(FF) if checked else None))
+
+        # Measured once per input and slice, then reused by every format
+        self.loudness_checkbox = QCheckBox("Normalize loudness (EBU R128)")
+
+        options.layout.addWidget(self.resumable_checkbox)
+        options.layout.addWidget(self.cache_checkbox)
+        options.layout.addWidget(self.loudness_checkbox)
+        options.layout.addWidget(self.verify_checkbox)
+        options.setLayout(options.layout)
+        form.layout.addRow("Options:", options)
+
         form.setLayout(form.layout)
         ## End Form
 
-        # button
+        # buttons
+        buttons = QWidget()
+        buttons.layout = QHBoxLayout(buttons)
+        buttons.layout.setContentsMargins(0, 0, 0, 0)
+
         self.go_button = RunButton(self)
+        self.pause_button = PauseButton(self)
+
+        buttons.layout.addWidget(self.go_button)
+        buttons.layout.addWidget(self.pause_button)
+        buttons.setLayout(buttons.layout)
+
+        # Live resource usage of the running job
+        self.metrics_label = QLabel("")
+
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.update_metrics)
+        self.metrics_timer.start(1000)
 
         # Message area
         self.msg_text = ConsoleArea(self)
@@ -452,7 +948,8 @@ class TabWidget(QWidget):
 
 
         tab1.layout.addWidget(form)
-        tab1.layout.addWidget(self.go_button)
+        tab1.layout.addWidget(buttons)
+        tab1.layout.addWidget(self.metrics_label)
         tab1.layout.addWidget(self.msg_text)
 
         tab1.setLayout(tab1.layout)
@@ -462,14 +959,346 @@ class TabWidget(QWidget):
         self.setLayout(self.layout)
 
 
+    def show_estimate(self, input_file):
+        ''' Predicted conversion time, from the history of similar jobs '''
+        outputs = [(None, codec) for codec in self.codecs_widget.get_codecs()]
+        slice_timestamps = self.slice_widget.get_slice_timestamps()
+
+        eta = FF.estimate(input_file, outputs, slice_timestamps).eta()
+        if eta is None:
+            self.metrics_label.setText("")
+        else:
+            self.metrics_label.setText("Estimated time: %s" % ff.FFTime(1000 * eta))
+
+
+    def update_metrics(self):
+        if FF.metrics and self.go_button.status == RunButton.RUNNING:
+            text = str(FF.metrics)
+
+            if FF.estimator:
+                eta = FF.estimator.eta(FF.metrics.encoded, FF.metrics.speed,
+                        FF.metrics.wall_secs())
+                if eta is not None:
+                    text += "  ETA %s" % ff.FFTime(1000 * eta)
+
+            self.metrics_label.setText(text)
+
+
 
 def on_sigint(*args):
     FF.cleanup()
     QApplication.quit()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="SimpleFF")
+    parser.add_argument("--watch", nargs=2, action="append",
+            metavar=("DIR", "FORMAT"),
+            help="Run without the GUI, converting files dropped into DIR to "
+                 "FORMAT (e.g. mp4, mp3) in DIR/converted. Can be repeated.")
+    parser.add_argument("--poll", action="store_true",
+            help="Poll watch folders instead of using inotify")
+    parser.add_argument("--serve", metavar="ADDRESS",
+            help="Run without the GUI, accepting jobs over HTTP on "
+                 "HOST:PORT or unix:PATH")
+
+    parser.add_argument("--worker", metavar="ADDRESS",
+            help="Run without the GUI, encoding segments for distributed "
+                 "jobs on HOST:PORT")
+    parser.add_argument("--distribute", nargs=3,
+            metavar=("INPUT", "FORMAT", "OUTPUT"),
+            help="Encode INPUT to OUTPUT across the --workers and exit")
+    parser.add_argument("--workers", default="",
+            help="Comma separated HOST:PORT of the workers for --distribute")
+    parser.add_argument("--shared", action="store_true",
+            help="With --distribute, workers see the input and output paths "
+                 "through shared storage instead of streaming segments")
+    parser.add_argument("--shared-root", metavar="DIR",
+            help="With --worker, accept --shared paths under DIR")
+
+    parser.add_argument("--convert", nargs=3,
+            metavar=("INPUT", "FORMAT", "OUTPUT"),
+            help="Convert INPUT to OUTPUT and exit. Either can be - for "
+                 "stdin/stdout, fd:N or a named pipe.")
+
+    parser.add_argument("--loudnorm", action="store_true",
+            help="With --convert, --distribute or --cutlist --format, "
+                 "normalize loudness to EBU R128")
+
+    parser.add_argument("--join", nargs="+", metavar="FILE",
+            help="Join the inputs end to end into OUTPUT (the first FILE) "
+                 "and exit, losslessly where their formats match")
+
+    parser.add_argument("--cutlist", metavar="FILE",
+            help="Extract the cuts of a CSV (input,start,end[,output]) or "
+                 "EDL cut list and exit")
+    parser.add_argument("--format",
+            help="With --cutlist, re-encode the cuts to FORMAT instead of "
+                 "keeping the format of their sources")
+    parser.add_argument("--output-dir", default=".",
+            help="With --cutlist, where to write the cuts")
+    parser.add_argument("--fps", type=float,
+            help="Frame rate of the timecodes in the cut list")
+
+    parser.add_argument("--stats", action="store_true",
+            help="Print the throughput of earlier jobs per format and "
+                 "resolution and exit")
+
+    parser.add_argument("--verify", nargs="?", const="headers",
+            choices=["headers", "decode"],
+            help="Check outputs before moving them into place, by their "
+                 "headers or also by decoding samples. Jobs of --watch and "
+                 "--serve are retried when this fails.")
+    parser.add_argument("--trace", metavar="FILE",
+            help="Write a Chrome trace (chrome://tracing, Perfetto) of "
+                 "probes, ffmpeg runs, signals and GUI handlers to FILE on "
+                 "exit. Also $SIMPLEFF_TRACE.")
+    parser.add_argument("--trace-profile", metavar="SPANS", default=None,
+            help="Comma separated span names (e.g. FF.get_duration) to also "
+                 "run under cProfile, dumped to FILE.SPAN.N.prof")
+
+    # Leave the rest to Qt
+    return parser.parse_known_args()
+
+
+class PrintSignal:
+    def __init__(self, file=None):
+        self.file = file
+
+    def emit(self, msg):
+        print(msg, end="", file=self.file or sys.stdout)
+
+
+
+class MetricsPrinter:
+    '''
+    While in use, prints the position and resource usage of every running
+    ffmpeg process to stderr every INTERVAL seconds: the command line
+    counterpart of the metrics label of the GUI.
+    '''
+
+    INTERVAL = 5.0
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.stop = threading.Event()
+
+
+    def _loop(self):
+        while not self.stop.wait(self.interval):
+            for metrics in FF.telemetry.running():
+                print("%s at %s: %s" % (os.path.basename(metrics.name),
+                    ff.FFTime(1000 * metrics.encoded), metrics),
+                    file=sys.stderr)
+
+
+    def __enter__(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+        return self
+
+
+    def __exit__(self, *args):
+        self.stop.set()
+        return False
+
+
+def run_convert(args):
+    input_file, name, output_file = args.convert
+    codec = find_codec(name, FF.codecs())
+    if codec is None:
+        print("Unknown format:", name, file=sys.stderr)
+        return 1
+    if args.loudnorm:
+        codec = codec.normalized()
+
+    outputs = [(output_file, codec)]
+    # Files are written under a temporary name and renamed once verified,
+    # as in FF.run
+    temps = FF.scratch.temp_outputs(outputs)
+    cmd = FF.build_cmd(input_file, temps, (None, None))
+
+    # stdout may be the output, keep messages off it
+    with MetricsPrinter():
+        code = FF.run_sync(cmd, PrintSignal(sys.stderr),
+                stdio=FF.stdio(input_file, outputs))
+
+    try:
+        if code == 0 and FF.verifier:
+            FF.verifier.verify_outputs(input_file, temps, outputs, (None, None))
+        if code == 0:
+            FF.scratch.commit(temps, outputs)
+    except verify.JobFailure as e:
+        print("Failed,", e, file=sys.stderr)
+        code = 1
+    except OSError as e:
+        print("Could not move output into place:", e, file=sys.stderr)
+        code = 1
+
+    if code:
+        FF.scratch.discard(temps, outputs)
+
+    return code
+
+
+def run_join(args):
+    output_file, inputs = args.join[0], args.join[1:]
+
+    try:
+        job = join.JoinJob(FF, inputs, output_file)
+    except ValueError as e:
+        print(e)
+        return 1
+
+    finished = threading.Event()
+    finish_signal = engine.Signal()
+    finish_signal.connect(finished.set)
+
+    with MetricsPrinter():
+        job.start(PrintSignal(), finish_signal)
+        finished.wait()
+
+    return 0 if job.ok else 1
+
+
+def run_cutlist(args):
+    codec = None
+    if args.format:
+        codec = find_codec(args.format, FF.codecs())
+        if codec is None:
+            print("Unknown format:", args.format)
+            return 1
+        if args.loudnorm:
+            codec = codec.normalized()
+
+    try:
+        job = cutlist.CutListJob(FF, cutlist.read_cutlist(args.cutlist, args.fps),
+                args.output_dir, codec)
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+
+    finished = threading.Event()
+    finish_signal = engine.Signal()
+    finish_signal.connect(finished.set)
+
+    with MetricsPrinter():
+        job.start(PrintSignal(), finish_signal)
+        finished.wait()
+
+    return 1 if job.failed else 0
+
+
+def run_stats(args):
+    if not FF.history:
+        print("Job history is disabled", file=sys.stderr)
+        return 1
+
+    print("%-32s %8s %6s %8s %8s %12s" % ("Format", "Height", "Jobs",
+        "Speed", "FPS", "Encoded"))
+    for row in FF.history.stats():
+        print("%-32s %8s %6d %8s %8s %12s" % (row["codec"],
+            row["height"] or "-", row["jobs"],
+            "%.2fx" % row["speed"] if row["speed"] else "-",
+            "%.1f" % row["fps"] if row["fps"] else "-",
+            ff.FFTime(1000 * (row["encoded_secs"] or 0))))
+
+    return 0
+
+
+def run_distributed(args):
+    if args.worker:
+        distributed.Worker(FF, args.worker, root=args.shared_root).serve()
+        return 0
+
+    input_file, name, output_file = args.distribute
+    codec = find_codec(name, FF.codecs())
+    workers = [w for w in args.workers.split(",") if w]
+    if codec is None or not workers:
+        print("--distribute needs a known format and --workers")
+        return 1
+    if not distributed.get_secret():
+        print("--distribute needs the workers' secret in $SIMPLEFF_SECRET")
+        return 1
+    if args.loudnorm:
+        codec = codec.normalized()
+
+    try:
+        coordinator = distributed.Coordinator(FF, input_file, output_file,
+                codec, workers, shared=args.shared)
+    except ValueError as e:
+        print(e)
+        return 1
+
+    return 0 if coordinator.run(PrintSignal()) else 1
+
+
+def run_headless(args):
+    folders = []
+    for path, name in args.watch or []:
+        codec = find_codec(name, FF.codecs())
+        if codec is None:
+            print("Unknown format:", name)
+            return 1
+
+        folders.append(watch.WatchFolder(path, codec))
+
+    # Watch folders and service clients share one scheduler
+    job_engine = engine.JobEngine(FF)
+    job_engine.start()
+
+    watcher = None
+    if folders:
+        watcher = watch.Watcher(FF, job_engine, folders, poll=args.poll)
+
+    try:
+        if args.serve:
+            if watcher:
+                threading.Thread(target=watcher.run, daemon=True).start()
+
+            service.JobService(job_engine).serve(args.serve)
+        else:
+            signal.signal(signal.SIGINT, lambda *_: watcher.stop())
+            watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher:
+            watcher.stop()
+        job_engine.stop()
+
+    return 0
+
+
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    # Cleanup temp files on exit
+    atexit.register(FF.cleanup)
+
+    args, qt_args = parse_args()
+    if args.trace or args.trace_profile is not None:
+        profile = [name for name in (args.trace_profile or "").split(",")
+                if name]
+        tracing.TRACER.enable(args.trace or tracing.TRACER.trace_file
+                or "simpleff-trace.json", profile)
+    if args.verify:
+        FF.verifier = verify.Verifier(FF, decode=args.verify == "decode")
+    if args.convert or args.join or args.cutlist or args.watch or \
+            args.serve or args.worker or args.distribute:
+        # Without the GUI there is nothing to keep responsive
+        FF.benchmark_codecs()
+    if args.stats:
+        sys.exit(run_stats(args))
+    if args.convert:
+        sys.exit(run_convert(args))
+    if args.join:
+        sys.exit(run_join(args))
+    if args.cutlist:
+        sys.exit(run_cutlist(args))
+    if args.watch or args.serve:
+        sys.exit(run_headless(args))
+    if args.worker or args.distribute:
+        sys.exit(run_distributed(args))
+
+    app = QApplication(sys.argv[:1] + qt_args)
 
     # Interpreter thread every half second
     timer = QTimer()
@@ -479,9 +1308,6 @@ if __name__ == "__main__":
     # Allow Ctrl-C to exit
     signal.signal(signal.SIGINT, on_sigint)
 
-    # Cleanup temp files on exit
-    atexit.register(FF.cleanup)
-
     # Run
     main_app = App()
     sys.exit(app.exec_())
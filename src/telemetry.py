@@ -0,0 +1,246 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import sys
+import time
+
+from threading import Lock, Thread
+
+
+try:
+    CLK_TCK = os.sysconf("SC_CLK_TCK")
+except (AttributeError, ValueError, OSError):
+    CLK_TCK = 100
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class ProcessMetrics:
+    '''
+    Resource usage of one ffmpeg process, sampled from /proc.
+
+    Values keep the last successful sample, so they are still meaningful
+    after the process has exited.
+    '''
+
+    def __init__(self, pid, name=""):
+        self.pid = pid
+        self.name = name
+        self.start = time.time()
+        self.end = None
+
+        self.cpu_secs = 0.0
+        self.rss = 0
+        self.peak_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.speed = None
+        self.encoded = 0.0
+
+
+    def sample(self):
+        ''' Returns False once the process is gone '''
+        proc = "/proc/%d/" % self.pid
+
+        stat = _read(proc + "stat")
+        if stat is None:
+            return False
+
+        # The command name may contain spaces, fields start after it
+        fields = stat[stat.rindex(")") + 2:].split()
+        utime, stime = int(fields[11]), int(fields[12])
+        self.cpu_secs = (utime + stime) / CLK_TCK
+
+        status = _read(proc + "status") or ""
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                self.rss = int(line.split()[1]) * 1024
+            elif line.startswith("VmHWM:"):
+                self.peak_rss = int(line.split()[1]) * 1024
+
+        self.peak_rss = max(self.peak_rss, self.rss)
+
+        # Only readable by the owner of the process
+        io = _read(proc + "io") or ""
+        for line in io.splitlines():
+            key, _, value = line.partition(":")
+            if key == "read_bytes":
+                self.read_bytes = int(value)
+            elif key == "write_bytes":
+                self.write_bytes = int(value)
+
+        return True
+
+
+    def update_progress(self, encoded, speed):
+        self.encoded = encoded
+        if speed is not None:
+            self.speed = speed
+
+
+    def wall_secs(self):
+        return (self.end or time.time()) - self.start
+
+
+    def summary(self):
+        return {
+            "name": self.name,
+            "start": self.start,
+            "wall_secs": round(self.wall_secs(), 3),
+            "cpu_secs": round(self.cpu_secs, 3),
+            "peak_rss_bytes": self.peak_rss,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+            "encoded_secs": round(self.encoded, 3),
+            "speed": self.speed,
+            }
+
+
+    def __str__(self):
+        mb = 1 << 20
+        speed = "%.2fx" % self.speed if self.speed is not None else "-"
+
+        return "CPU %.1fs  RSS %d MB (peak %d MB)  read %d MB  write %d MB  speed %s" % (
+                self.cpu_secs, self.rss / mb, self.peak_rss / mb,
+                self.read_bytes / mb, self.write_bytes / mb, speed)
+
+
+
+class Telemetry:
+    '''
+    Samples the registered processes every interval in a background thread
+    and writes a summary per finished process to the metrics file.
+
+    A metrics file ending in .prom is rewritten in Prometheus text format
+    (for the node exporter textfile collector), anything else gets one JSON
+    line appended per job. Only Linux has /proc, elsewhere only wall time,
+    progress and speed are recorded.
+    '''
+
+    INTERVAL = 1.0
+
+    def __init__(self, metrics_file=None, interval=INTERVAL):
+        self.metrics_file = metrics_file or os.getenv("SIMPLEFF_METRICS")
+        self.interval = interval
+
+        self.active = {}
+        self.lock = Lock()
+        self.thread = None
+
+        # Totals over all finished jobs, for the Prometheus counters
+        self.totals = {
+            "jobs": 0,
+            "wall_secs": 0.0,
+            "cpu_secs": 0.0,
+            "read_bytes": 0,
+            "write_bytes": 0,
+            "encoded_secs": 0.0,
+            }
+        self.last = None
+
+
+    def register(self, pid, name=""):
+        metrics = ProcessMetrics(pid, name)
+        metrics.sample()
+
+        with self.lock:
+            self.active[pid] = metrics
+
+            if not self.thread:
+                self.thread = Thread(target=self._loop, daemon=True)
+                self.thread.start()
+
+        return metrics
+
+
+    def running(self):
+        ''' Metrics of the processes still registered '''
+        with self.lock:
+            return list(self.active.values())
+
+
+    def unregister(self, metrics):
+        with self.lock:
+            self.active.pop(metrics.pid, None)
+
+        metrics.end = time.time()
+        self._record(metrics)
+
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+
+            with self.lock:
+                active = list(self.active.values())
+
+            for metrics in active:
+                metrics.sample()
+
+
+    def _record(self, metrics):
+        summary = metrics.summary()
+
+        with self.lock:
+            self.totals["jobs"] += 1
+            for key in self.totals:
+                if key in summary:
+                    self.totals[key] += summary[key]
+            self.last = summary
+
+            if not self.metrics_file:
+                return
+
+            try:
+                if self.metrics_file.endswith(".prom"):
+                    self._write_prometheus()
+                else:
+                    with open(self.metrics_file, "a") as f:
+                        f.write(json.dumps(summary) + "\n")
+            except OSError as e:
+                print("Could not write metrics:", e, file=sys.stderr)
+
+
+    def _write_prometheus(self):
+        lines = []
+
+        for key, value in sorted(self.totals.items()):
+            name = "simpleff_%s_total" % key
+            lines += ["# TYPE %s counter" % name, "%s %s" % (name, value)]
+
+        for key in ("wall_secs", "cpu_secs", "peak_rss_bytes", "read_bytes",
+                "write_bytes", "encoded_secs", "speed"):
+            value = self.last.get(key)
+            if value is None:
+                continue
+
+            name = "simpleff_last_job_%s" % key
+            lines += ["# TYPE %s gauge" % name, "%s %s" % (name, value)]
+
+        # Replace atomically, the collector may read at any time
+        temp = self.metrics_file + ".tmp"
+        with open(temp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+        os.replace(temp, self.metrics_file)
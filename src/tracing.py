@@ -0,0 +1,205 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import atexit
+import cProfile
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from threading import Lock
+
+
+class _NullSpan:
+    ''' What span() returns while tracing is off '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+
+class Span:
+    ''' A timed region of one thread, recorded when it ends '''
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.profiler = None
+
+    def __enter__(self):
+        if self.name in self.tracer.profile:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Another span of this thread is already being profiled
+                self.profiler = None
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+
+        if self.profiler:
+            self.profiler.disable()
+            self.tracer.dump_profile(self.name, self.profiler)
+
+        self.tracer.record(self.name, self.category, self.start, end, self.args)
+        return False
+
+
+
+class Tracer:
+    '''
+    Records spans (probing, process spawns, stderr parsing, signal
+    dispatch, GUI handlers) as Chrome trace events, written to trace_file
+    at exit. The file opens in chrome://tracing or Perfetto.
+
+    Off unless a trace file is given or $SIMPLEFF_TRACE is set. While off,
+    span() returns a shared no-op context and traced functions only check
+    self.enabled.
+
+    Spans named in profile (or $SIMPLEFF_TRACE_PROFILE, comma separated)
+    also run under cProfile; each is dumped next to the trace file as
+    TRACE.NAME.N.prof, for pstats or snakeviz.
+    '''
+
+    def __init__(self, trace_file=None, profile=None):
+        self.enabled = False
+        self.trace_file = None
+        self.profile = frozenset()
+
+        self.events = []
+        self.threads = {}
+        self.profiles = {}
+        self.lock = Lock()
+        self.pid = os.getpid()
+        self.epoch = time.perf_counter()
+
+        trace_file = trace_file or os.getenv("SIMPLEFF_TRACE")
+        if profile is None:
+            profile = [name for name in
+                    os.getenv("SIMPLEFF_TRACE_PROFILE", "").split(",") if name]
+
+        if trace_file:
+            self.enable(trace_file, profile)
+
+
+    def enable(self, trace_file, profile=()):
+        with self.lock:
+            first = self.trace_file is None
+            self.trace_file = trace_file
+            self.profile = frozenset(profile)
+            self.enabled = True
+
+        if first:
+            atexit.register(self.write)
+
+
+    def record(self, name, category, start, end, args=None):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - self.epoch) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": thread.ident,
+            }
+        if args:
+            event["args"] = {k: str(v) for k, v in args.items()}
+
+        with self.lock:
+            self.events.append(event)
+            if thread.ident not in self.threads:
+                self.threads[thread.ident] = thread.name
+
+
+    def dump_profile(self, name, profiler):
+        with self.lock:
+            n = self.profiles[name] = self.profiles.get(name, 0) + 1
+
+        path = "%s.%s.%d.prof" % (self.trace_file,
+                re.sub(r"[^\w.-]+", "_", name), n)
+        try:
+            profiler.dump_stats(path)
+        except OSError as e:
+            print("Could not write profile:", e, file=sys.stderr)
+
+
+    def write(self):
+        ''' Write the events so far to the trace file '''
+        with self.lock:
+            if not self.trace_file:
+                return
+
+            events = list(self.events)
+            events += [{"name": "thread_name", "ph": "M", "pid": self.pid,
+                "tid": tid, "args": {"name": name}}
+                for tid, name in self.threads.items()]
+
+        try:
+            temp = self.trace_file + ".tmp"
+            with open(temp, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+            os.replace(temp, self.trace_file)
+        except OSError as e:
+            print("Could not write trace:", e, file=sys.stderr)
+
+
+
+TRACER = Tracer()
+
+
+def span(name, category="simpleff", **args):
+    ''' Context manager timing a region, with TRACER '''
+    if not TRACER.enabled:
+        return NULL_SPAN
+
+    return Span(TRACER, name, category, args)
+
+
+def traced(name=None, category="simpleff"):
+    ''' Decorator timing every call of a function, with TRACER '''
+
+    def decorate(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return function(*args, **kwargs)
+
+            with Span(TRACER, label, category, None):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
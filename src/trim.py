@@ -0,0 +1,203 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from threading import Thread
+
+from loudness import MEASURE_FILTER, parse_measurement
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+
+class TrimDetector:
+    '''
+    Finds the black and silent lead-in and lead-out of a file.
+
+    ffmpeg decodes the input once and streams small gray frames and low
+    rate mono PCM through two pipes. Both are read with FrameReaders and
+    consumed a block at a time with NumPy, so memory use doesn't depend on
+    the length of the input, and only the first and last frame/window with
+    content are remembered.
+    '''
+
+    FPS = 10
+    WIDTH = 64
+    HEIGHT = 36
+
+    RATE = 8000
+    # Seconds of audio per RMS window
+    WINDOW = 0.1
+
+    # A frame is black if nearly all its pixels are darker than BLACK_LUMA
+    BLACK_LUMA = 32
+    BLACK_RATIO = 0.98
+
+    SILENCE_DB = -50.0
+
+    def __init__(self, ff, filename, video=True, audio=True, loudness=False):
+        if np is None:
+            raise RuntimeError("Auto trim needs NumPy")
+        if not video and not audio:
+            raise ValueError("Nothing to analyze")
+
+        self.ff = ff
+        self.filename = filename
+        self.video = video
+        self.audio = audio
+        self.loudness = loudness and audio
+
+        self.raw = None
+        self.cancelled = False
+
+        # (first, last) seconds with content, per stream
+        self.video_content = None
+        self.audio_content = None
+
+        # loudnorm measurement of the whole input
+        self.measured_loudness = None
+
+
+    def _outputs(self):
+        outputs = []
+
+        if self.video:
+            outputs.append(["-map", "0:v:0", "-vf",
+                "fps=%d,scale=%d:%d:flags=fast_bilinear,format=gray"
+                % (self.FPS, self.WIDTH, self.HEIGHT), "-f", "rawvideo"])
+
+        if self.audio:
+            source = "[trim]" if self.loudness else "0:a:0"
+            outputs.append(["-map", source, "-ac", "1", "-ar", str(self.RATE),
+                "-f", "s16le"])
+
+        return outputs
+
+
+    def _input_args(self):
+        # Skipping non-reference frames roughly halves decoding, and the
+        # frames are resampled to FPS anyway
+        args = ["-skip_frame", "nonref"]
+
+        if self.loudness:
+            # The measuring branch ends in a sink, only its log is kept
+            args += ["-filter_complex", "[0:a:0]asplit[trim][measure];"
+                    "[measure]%s,anullsink" % MEASURE_FILTER]
+
+        return args
+
+
+    def _scan_video(self, reader):
+        frame_size = self.WIDTH * self.HEIGHT
+        dark = np.empty((reader.block, frame_size), dtype=bool)
+        counts = np.empty(reader.block, dtype=np.intp)
+
+        limit = self.BLACK_RATIO * frame_size
+        first = last = None
+
+        for block in reader:
+            n = block.count
+            np.less(block.array, self.BLACK_LUMA, out=dark[:n])
+            np.sum(dark[:n], axis=1, out=counts[:n])
+
+            content = np.flatnonzero(counts[:n] < limit)
+            if content.size:
+                if first is None:
+                    first = block.time(int(content[0]))
+                last = block.time(int(content[-1]) + 1)
+
+        if first is not None:
+            self.video_content = (first, last)
+
+
+    def _scan_audio(self, reader):
+        samples = int(self.RATE * self.WINDOW)
+        squares = np.empty((reader.block, samples), dtype=np.float32)
+        energy = np.empty(reader.block, dtype=np.float32)
+
+        # Mean square of a window at SILENCE_DB below full scale
+        limit = (32768.0 * 10 ** (self.SILENCE_DB / 20)) ** 2
+        first = last = None
+
+        for block in reader:
+            n = block.count
+            np.multiply(block.array, block.array, out=squares[:n],
+                    dtype=np.float32)
+            np.mean(squares[:n], axis=1, out=energy[:n])
+
+            content = np.flatnonzero(energy[:n] > limit)
+            if content.size:
+                if first is None:
+                    first = block.time(int(content[0]))
+                last = block.time(int(content[-1]) + 1)
+
+        if first is not None:
+            self.audio_content = (first, last)
+
+
+    def run(self):
+        '''
+        Suggested (start, end) in seconds: everything outside is black and
+        silent. None if the whole input is, or the detection was cancelled
+        or failed.
+        '''
+        self.raw = self.ff.open_raw(self.filename, self._outputs(),
+                self._input_args(), log=self.loudness)
+        if self.cancelled:
+            self.raw.stop()
+
+        with self.raw:
+            readers = []
+            if self.video:
+                frame_size = self.WIDTH * self.HEIGHT
+                readers.append((self._scan_video, self.raw.reader(len(readers),
+                    frame_size, self.FPS, (frame_size,), np.uint8)))
+            if self.audio:
+                samples = int(self.RATE * self.WINDOW)
+                readers.append((self._scan_audio, self.raw.reader(len(readers),
+                    2 * samples, 1 / self.WINDOW, (samples,), "<i2")))
+
+            # Every pipe must be drained at once or ffmpeg blocks
+            threads = [Thread(target=scan, args=(reader,))
+                    for scan, reader in readers[1:]]
+            for thread in threads:
+                thread.start()
+
+            scan, reader = readers[0]
+            scan(reader)
+
+            for thread in threads:
+                thread.join()
+
+        if self.raw.returncode != 0 or self.cancelled:
+            return None
+
+        if self.loudness:
+            self.measured_loudness = parse_measurement(self.raw.log)
+
+        spans = [s for s in (self.video_content, self.audio_content) if s]
+        if not spans:
+            return None
+
+        return (min(s[0] for s in spans), max(s[1] for s in spans))
+
+
+    def cancel(self):
+        self.cancelled = True
+        if self.raw:
+            self.raw.stop()
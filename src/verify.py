@@ -0,0 +1,173 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+from subprocess import Popen, PIPE, DEVNULL
+
+from output_codecs import SegmentedOutputCodec, is_stream
+
+
+class JobFailure(Exception):
+    ''' Why a job failed: an ffmpeg error or an output failing verification '''
+
+    # Kinds
+    KILLED = "killed"
+    NO_SPACE = "out of space"
+    ERROR = "ffmpeg error"
+    UNREADABLE = "unreadable"
+    TRUNCATED = "truncated"
+    STREAMS = "missing streams"
+    CORRUPT = "corrupt"
+
+    # Failures that may well not happen again. An ffmpeg error or missing
+    # streams usually come from the input or the arguments.
+    RETRYABLE = (KILLED, NO_SPACE, UNREADABLE, TRUNCATED, CORRUPT)
+
+    def __init__(self, kind, message):
+        super().__init__("%s: %s" % (kind, message))
+        self.kind = kind
+
+
+    def retryable(self):
+        return self.kind in JobFailure.RETRYABLE
+
+
+    def from_exit(returncode, log):
+        ''' Classify a failed ffmpeg run by its exit code and last log lines '''
+        text = "".join(log)
+        last = log[-1].strip() if log else ""
+
+        # ffmpeg exits with 255 after handling SIGTERM/SIGINT itself
+        if returncode < 0 or returncode == 255 or "received signal" in text:
+            return JobFailure(JobFailure.KILLED,
+                    "ffmpeg was stopped (exit code %d)" % returncode)
+
+        if "No space left on device" in text:
+            return JobFailure(JobFailure.NO_SPACE, last)
+
+        return JobFailure(JobFailure.ERROR,
+                "exit code %d%s" % (returncode, ", " + last if last else ""))
+
+
+
+def expected_types(ff, input_file, codec):
+    ''' Stream types an output of input_file with codec should have '''
+    types = set(ff.get_stream_types(input_file)) & {"video", "audio"}
+
+    if "-vn" in codec.args:
+        types.discard("video")
+    if "-an" in codec.args:
+        types.discard("audio")
+
+    return types
+
+
+
+class Verifier:
+    '''
+    Checks finished outputs before they are moved into place.
+
+    The container header is probed for the duration and streams, which
+    are compared with what the job should have produced; a killed ffmpeg or
+    a full disk leave outputs that are short or unreadable. With
+    decode=True, a few seconds at SAMPLES evenly spaced points (the end
+    included) are also decoded, which catches corruption without the cost
+    of decoding everything.
+
+    Streams and segmented outputs are not verified.
+    '''
+
+    # Seconds an output may be shorter than expected (encoder delay,
+    # rounding to whole frames)
+    TOLERANCE = 0.5
+
+    SAMPLES = 3
+    SAMPLE_SECS = 2.0
+
+    def __init__(self, ff, decode=False):
+        self.ff = ff
+        self.decode = decode
+
+
+    def _expected_secs(self, input_file, slice_timestamps):
+        secs = self.ff.slice_secs(input_file, slice_timestamps)
+
+        # A slice may run past the end of the input
+        rest = self.ff.slice_secs(input_file, (slice_timestamps[0], None))
+        if secs is None or rest is None:
+            return secs or rest
+
+        return min(secs, rest)
+
+
+    def _sample_decode(self, output_file, secs):
+        if secs <= self.SAMPLE_SECS * self.SAMPLES:
+            starts = [0.0]
+        else:
+            step = (secs - self.SAMPLE_SECS) / (self.SAMPLES - 1)
+            starts = [i * step for i in range(self.SAMPLES)]
+
+        for start in starts:
+            p = Popen([self.ff.ffmpeg.name, "-nostdin", "-v", "error",
+                "-ss", "%.3f" % start, "-i", output_file,
+                "-t", str(self.SAMPLE_SECS), "-f", "null", "-"],
+                stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE,
+                universal_newlines=True)
+            _, errors = p.communicate()
+
+            if p.returncode or errors.strip():
+                raise JobFailure(JobFailure.CORRUPT, "%s at %.1fs: %s"
+                        % (output_file, start, errors.strip().split("\n")[0]))
+
+
+    def verify(self, input_file, output_file, codec, slice_timestamps):
+        ''' Raises JobFailure if output_file is not a complete output '''
+        if is_stream(output_file) or is_stream(input_file) or \
+                isinstance(codec, SegmentedOutputCodec):
+            return
+
+        if not os.path.isfile(output_file) or os.path.getsize(output_file) == 0:
+            raise JobFailure(JobFailure.UNREADABLE, "%s is empty" % output_file)
+
+        code, duration = self.ff.get_duration(output_file)
+        if code != 0:
+            raise JobFailure(JobFailure.UNREADABLE,
+                    "%s can't be probed" % output_file)
+        secs = duration.to_ms() / 1000
+
+        expected = self._expected_secs(input_file, slice_timestamps)
+        if expected is not None and secs < expected - self.TOLERANCE:
+            raise JobFailure(JobFailure.TRUNCATED, "%s is %.1fs, expected %.1fs"
+                    % (output_file, secs, expected))
+
+        missing = expected_types(self.ff, input_file, codec) - \
+                set(self.ff.get_stream_types(output_file))
+        if missing:
+            raise JobFailure(JobFailure.STREAMS, "%s has no %s"
+                    % (output_file, " or ".join(sorted(missing))))
+
+        if self.decode:
+            self._sample_decode(output_file, secs)
+
+
+    def verify_outputs(self, input_file, temps, outputs, slice_timestamps):
+        '''
+        Verify the temporary outputs of a job (ScratchSpace.temp_outputs)
+        before they are committed
+        '''
+        for (temp, _), (_, codec) in zip(temps, outputs):
+            self.verify(input_file, temp, codec, slice_timestamps)
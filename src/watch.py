@@ -0,0 +1,304 @@
+# Copyright (C) 2016 Sean Yeh
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import ctypes
+import ctypes.util
+import os
+import select
+import sqlite3
+import struct
+import sys
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+from engine import Job
+
+
+# From sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    ''' Minimal inotify binding through ctypes. Linux only. '''
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                use_errno=True)
+        self.libc = libc
+
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.paths = {}
+
+
+    def add_watch(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", path)
+
+        self.paths[wd] = path
+
+
+    def read(self, timeout):
+        '''
+        Paths of the files written or moved in within timeout seconds.
+        None means events were lost and the directories must be rescanned.
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 1 << 16)
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_ISDIR or wd not in self.paths:
+                continue
+
+            paths.append(os.path.join(self.paths[wd], os.fsdecode(name)))
+
+        return paths
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+class WatchFolder:
+    ''' A watched directory and the codec its files are converted with '''
+
+    def __init__(self, path, codec, output_dir=None):
+        self.path = os.path.abspath(path)
+        self.codec = codec
+        self.output_dir = output_dir or os.path.join(self.path, "converted")
+
+
+    def output_file(self, input_file):
+        base = os.path.basename(input_file).rsplit(".", 1)[0]
+        return os.path.join(self.output_dir, base + "." + self.codec.ext)
+
+
+
+class Watcher:
+    '''
+    Converts files dropped into watch folders.
+
+    New files are picked up through inotify (or by polling where inotify is
+    not available), considered complete once their size and mtime have not
+    changed for SETTLE seconds and submitted to the JobEngine. Files whose
+    fingerprint was already converted for a folder are skipped, so copies
+    and re-uploads don't cause duplicate work.
+    '''
+
+    SETTLE = 5.0
+    POLL = 2.0
+    # Files remembered as handled. Forgotten ones are fingerprinted again
+    # when they change, and still skipped if they were converted.
+    KNOWN = 10000
+
+    def __init__(self, ff, engine, folders, state_file=None, poll=False):
+        self.ff = ff
+        self.engine = engine
+        self.folders = folders
+
+        if state_file is None:
+            base = os.getenv("XDG_DATA_HOME",
+                    os.path.join(os.path.expanduser("~"), ".local", "share"))
+            state_file = os.path.join(base, "simpleff", "watch.sqlite")
+
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+
+        self.lock = Lock()
+        self.db = sqlite3.connect(state_file, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS processed (
+                fingerprint TEXT, folder TEXT, input TEXT, finished REAL,
+                PRIMARY KEY (fingerprint, folder))''')
+
+        # path -> (folder, size, mtime_ns, unchanged since)
+        self.pending = {}
+        self.inflight = set()
+        # path -> (size, mtime_ns) of files already submitted or skipped,
+        # least recently seen first
+        self.known = OrderedDict()
+
+        self.inotify = None
+        if not poll and sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify()
+                for folder in folders:
+                    self.inotify.add_watch(folder.path)
+            except OSError as e:
+                print("inotify not available, polling instead:", e)
+                self.inotify = None
+
+        self.stopped = False
+
+
+    def _folder(self, path):
+        directory = os.path.dirname(path)
+        for folder in self.folders:
+            if folder.path == directory:
+                return folder
+
+        return None
+
+
+    def _candidate(self, path):
+        ''' Start waiting for path to settle '''
+        name = os.path.basename(path)
+
+        # Hidden and partial uploads
+        if name.startswith(".") or name.endswith((".part", ".tmp", ".crdownload")):
+            return
+
+        folder = self._folder(path)
+        if folder is None or path in self.pending:
+            return
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+
+        # Already handled in this version, don't fingerprint again
+        if self.known.get(path) == (st.st_size, st.st_mtime_ns):
+            return
+
+        self.pending[path] = (folder, st.st_size, st.st_mtime_ns, time.monotonic())
+
+
+    def scan(self):
+        ''' Pick up every file currently in the watch folders '''
+        for folder in self.folders:
+            for entry in os.scandir(folder.path):
+                if entry.is_file():
+                    self._candidate(entry.path)
+
+
+    def _check_pending(self):
+        now = time.monotonic()
+
+        for path, (folder, size, mtime_ns, since) in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Deleted or moved away before it settled
+                del self.pending[path]
+                continue
+
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                # Still growing
+                self.pending[path] = (folder, st.st_size, st.st_mtime_ns, now)
+            elif now - since >= self.SETTLE:
+                del self.pending[path]
+                self.known[path] = (size, mtime_ns)
+                self.known.move_to_end(path)
+                if len(self.known) > self.KNOWN:
+                    self.known.popitem(last=False)
+                self._submit(path, folder)
+
+
+    def _processed(self, fingerprint, folder):
+        with self.lock:
+            row = self.db.execute('''SELECT 1 FROM processed
+                    WHERE fingerprint = ? AND folder = ?''',
+                    (fingerprint, folder.path)).fetchone()
+
+        return row is not None
+
+
+    def _submit(self, path, folder):
+        try:
+            fingerprint = self.ff.fingerprint(path)
+        except OSError:
+            return
+
+        key = (fingerprint, folder.path)
+        if key in self.inflight or self._processed(fingerprint, folder):
+            print("Skipping already converted", path)
+            return
+
+        os.makedirs(folder.output_dir, exist_ok=True)
+
+        job = Job(path, [(folder.output_file(path), folder.codec)])
+        job.finish_signal.connect(lambda job: self._on_finish(job, key))
+
+        self.inflight.add(key)
+        self.engine.submit(job)
+        print("Queued", path)
+
+
+    def _on_finish(self, job, key):
+        self.inflight.discard(key)
+
+        if job.status != Job.DONE:
+            print("Failed", job.input_file)
+            return
+
+        with self.lock, self.db:
+            self.db.execute('''INSERT OR REPLACE INTO processed
+                    VALUES (?, ?, ?, ?)''',
+                    key + (job.input_file, time.time()))
+
+        print("Done", job.input_file, "->", job.outputs[0][0])
+        if job.metrics:
+            print("   ", job.metrics)
+
+
+    def run(self):
+        self.scan()
+
+        last_poll = time.monotonic()
+        while not self.stopped:
+            timeout = 1.0 if self.pending else self.POLL
+
+            if self.inotify:
+                paths = self.inotify.read(timeout)
+                if paths is None:
+                    # Event queue overflowed
+                    self.scan()
+                else:
+                    for path in paths:
+                        self._candidate(path)
+            else:
+                time.sleep(timeout)
+                if time.monotonic() - last_poll >= self.POLL:
+                    self.scan()
+                    last_poll = time.monotonic()
+
+            self._check_pending()
+
+
+    def stop(self):
+        self.stopped = True
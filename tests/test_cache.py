@@ -0,0 +1,94 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from cache import ResultCache
+from ff import FFTime
+
+
+class Codec:
+    ext = "mp4"
+
+    def __init__(self, args):
+        self.args = args
+
+    def output_args(self, output_file):
+        return self.args + [output_file]
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(str(tmp_path / "cache"), max_bytes=100)
+
+
+## key
+
+def test_key(cache, tmp_path):
+    a = write(tmp_path, "a.mov", b"a" * 1000)
+    b = write(tmp_path, "b.mov", b"b" * 1000)
+    h264 = Codec(["-c:v", "libx264"])
+    no_slice = (None, None)
+
+    key = cache.key(a, h264, no_slice)
+
+    assert key == cache.key(a, Codec(["-c:v", "libx264"]), no_slice)
+    assert key != cache.key(b, h264, no_slice)
+    assert key != cache.key(a, Codec(["-c:v", "libx265"]), no_slice)
+    assert key != cache.key(a, h264, (FFTime(1000), None))
+
+
+def test_key_ignores_input_path(cache, tmp_path):
+    h264 = Codec(["-c:v", "libx264"])
+    a = write(tmp_path, "a.mov", b"same" * 100)
+    b = write(tmp_path, "b.mov", b"same" * 100)
+
+    assert cache.key(a, h264, (None, None)) == cache.key(b, h264, (None, None))
+
+
+## store, fetch and evict
+
+def test_store_fetch(cache, tmp_path):
+    codec = Codec([])
+    output = write(tmp_path, "out.mp4", b"result")
+    fetched = str(tmp_path / "fetched.mp4")
+
+    assert not cache.fetch("k", codec, fetched)
+
+    cache.store("k", codec, output)
+    assert cache.fetch("k", codec, fetched)
+    with open(fetched, "rb") as f:
+        assert f.read() == b"result"
+
+
+def test_evict_least_recently_used(cache, tmp_path):
+    codec = Codec([])
+    for i, key in enumerate(["old", "used", "new"]):
+        path = os.path.join(cache.cache_dir, key + ".mp4")
+        os.makedirs(cache.cache_dir, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * 40)
+        os.utime(path, (1000 + i, 1000 + i))
+
+    # Fetching marks as recently used
+    assert cache.fetch("used", codec, str(tmp_path / "out.mp4"))
+    cache.evict()
+
+    assert sorted(os.listdir(cache.cache_dir)) == ["new.mp4", "used.mp4"]
+
+
+def test_store_evicts(cache, tmp_path):
+    codec = Codec([])
+    cache.store("a", codec, write(tmp_path, "a.mp4", b"a" * 60))
+    os.utime(cache._path("a", codec), (1000, 1000))
+    cache.store("b", codec, write(tmp_path, "b.mp4", b"b" * 60))
+
+    assert os.listdir(cache.cache_dir) == ["b.mp4"]
@@ -0,0 +1,162 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from cutlist import read_csv, read_edl
+from ff import FFTime
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+## FFTime.parse
+
+@pytest.mark.parametrize("text, ms", [
+    ("83.5", 83500),
+    ("01:23.5", 83500),
+    ("00:01:23.5", 83500),
+    ("00:00:01:12", 1500),
+    ])
+def test_parse(text, ms):
+    assert FFTime.parse(text, 24).to_ms() == pytest.approx(ms)
+
+
+@pytest.mark.parametrize("text", ["", "abc", "-1", "inf", "1:2:3:4:5",
+    "00:60:00", "00:00:60", "00:00:00:24", "00:00:00:-1"])
+def test_parse_rejects(text):
+    with pytest.raises(ValueError):
+        FFTime.parse(text, 24)
+
+
+def test_timecode_needs_fps():
+    with pytest.raises(ValueError):
+        FFTime.parse("00:00:01:00")
+
+
+@pytest.mark.parametrize("text, frames", [
+    ("00:00:00;00", 0),
+    ("00:00:59;29", 1799),
+    # Frames 0 and 1 of the minute are skipped
+    ("00:01:00;02", 1800),
+    # but not every tenth minute
+    ("00:10:00;00", 17982),
+    ("01:00:00;00", 107892),
+    ])
+def test_parse_drop_frame(text, frames):
+    assert FFTime.parse(text).to_ms() == pytest.approx(frames * 1001 / 30)
+
+
+@pytest.mark.parametrize("text", ["00:00:00;45", "00:00:00;30",
+    "00:01:00;00", "00:01:00;01", "00:09:00;01"])
+def test_parse_drop_frame_rejects(text):
+    with pytest.raises(ValueError):
+        FFTime.parse(text)
+
+
+## read_csv
+
+def test_read_csv(tmp_path):
+    path = write(tmp_path, "cuts.csv",
+            "input,start,end,name\n"
+            "# a comment\n"
+            "a.mp4,10,20.5,intro\n"
+            "\n"
+            "b.mp4,00:01:00,00:01:30:12\n")
+
+    cuts = read_csv(path, fps=24)
+
+    assert [os.path.basename(c.input_file) for c in cuts] == ["a.mp4", "b.mp4"]
+    assert os.path.dirname(cuts[0].input_file) == str(tmp_path)
+    assert cuts[0].start.to_ms() == 10000
+    assert cuts[0].end.to_ms() == 20500
+    assert cuts[0].name == "intro"
+    assert cuts[1].end.to_ms() == pytest.approx(90500)
+    assert cuts[1].name is None
+
+
+def test_read_csv_errors(tmp_path):
+    with pytest.raises(ValueError, match="Line 1"):
+        read_csv(write(tmp_path, "short.csv", "a.mp4,10\n"))
+
+    with pytest.raises(ValueError, match="Line 2"):
+        read_csv(write(tmp_path, "time.csv", "a.mp4,1,2\na.mp4,x,3\n"))
+
+    with pytest.raises(ValueError):
+        read_csv(write(tmp_path, "order.csv", "a.mp4,20,10\n"))
+
+
+## read_edl
+
+EDL = """TITLE: Test
+FCM: NON-DROP FRAME
+
+001  TAPE1    V     C        00:00:10:00 00:00:12:00 01:00:00:00 01:00:02:00
+001  TAPE1    A     C        00:00:10:00 00:00:12:00 01:00:00:00 01:00:02:00
+* FROM CLIP NAME: clip one.mov
+
+002  BL       V     C        00:00:00:00 00:00:01:00 01:00:02:00 01:00:03:00
+
+003  AX       V     C        00:00:05:00 00:00:06:00 01:00:03:00 01:00:04:00
+* FROM CLIP NAME: two.mp4
+003  AX       A     C        00:00:05:00 00:00:06:00 01:00:03:00 01:00:04:00
+
+004  AX       V     C        00:00:05:00 00:00:06:00 01:00:04:00 01:00:05:00
+
+005  TAPE2    V     C        00:00:20:00 00:00:20:00 01:00:05:00 01:00:05:00
+005  TAPE3    V     D    025 00:00:30:00 00:00:32:00 01:00:05:00 01:00:07:00
+* FROM CLIP NAME: out.mov
+* TO CLIP NAME: in.mov
+
+006  TAPE1    V     C        00:00:10:00 00:00:12:00 01:00:07:00 01:00:09:00
+"""
+
+
+def test_read_edl(tmp_path):
+    cuts = read_edl(write(tmp_path, "list.edl", EDL), fps=25)
+
+    assert [(os.path.basename(c.input_file), c.start.to_ms(), c.end.to_ms(),
+        c.name) for c in cuts] == [
+            ("clip one.mov", 10000, 12000, "clip one-001"),
+            ("two.mp4", 5000, 6000, "two-003"),
+            ("in.mov", 30000, 32000, "in-005"),
+            # The same clip again is another cut
+            ("TAPE1", 10000, 12000, "TAPE1-006"),
+            ]
+    assert os.path.dirname(cuts[0].input_file) == str(tmp_path)
+
+
+def test_read_edl_source_file(tmp_path):
+    path = write(tmp_path, "list.edl",
+            "001  R1 V C 00:00:01:00 00:00:02:00 00:00:00:00 00:00:01:00\n"
+            "* SOURCE FILE: media/a.mxf\n"
+            "* FROM CLIP NAME: a\n")
+
+    cuts = read_edl(path)
+
+    assert cuts[0].input_file == os.path.join(str(tmp_path), "media/a.mxf")
+
+
+def test_read_edl_drop_frame(tmp_path):
+    path = write(tmp_path, "df.edl",
+            "FCM: DROP FRAME\n"
+            "001  R1 V C 00:01:00:02 00:10:00:00 00:00:00;00 00:09:00;00\n")
+
+    cut = read_edl(path)[0]
+
+    assert cut.start.to_ms() == pytest.approx(1800 * 1001 / 30)
+    assert cut.end.to_ms() == pytest.approx(17982 * 1001 / 30)
+
+
+def test_read_edl_invalid_drop_frame(tmp_path):
+    path = write(tmp_path, "df.edl",
+            "FCM: DROP FRAME\n"
+            "001  R1 V C 00:01:00;00 00:02:00;02 00:00:00;00 00:01:00;02\n")
+
+    with pytest.raises(ValueError):
+        read_edl(path)
@@ -0,0 +1,191 @@
+import os
+import signal
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from engine import ConcurrencyController, Job, JobEngine, Pool
+
+
+class Codec:
+    name = "H.264"
+
+    def is_stream_copy(self):
+        return False
+
+
+class Reservation:
+    def release(self):
+        pass
+
+
+class Scratch:
+    def reserve(self, path, size):
+        return Reservation()
+
+
+class FakeFF:
+    scratch = Scratch()
+
+    def estimate_size(self, input_file, outputs, slice_timestamps):
+        return 0
+
+
+class Process:
+    def __init__(self):
+        self.signals = []
+
+    def send_signal(self, sig):
+        self.signals.append(sig)
+
+
+def job(priority=Job.NORMAL):
+    return Job("/in/a.mov", [("/out/a.mp4", Codec())], priority=priority)
+
+
+@pytest.fixture
+def engine():
+    engine = JobEngine(FakeFF())
+    engine.launched = []
+
+    def launch(job, pool):
+        job.status = Job.RUNNING
+        job.process = Process()
+        pool.running.append(job)
+        engine.launched.append(job)
+
+    engine._launch = launch
+    return engine
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    monkeypatch.setattr(ConcurrencyController, "_overloaded", lambda self: False)
+    return ConcurrencyController(limit=2, min_limit=1, max_limit=4)
+
+
+## ConcurrencyController
+
+def test_controller_climbs_while_better(controller):
+    assert controller.update(1.0) == 3
+    assert controller.update(1.5) == 4
+    # Capped at max_limit
+    assert controller.update(2.0) == 4
+
+
+def test_controller_reverses_when_worse(controller):
+    controller.update(2.0)
+    assert controller.update(1.0) == 2
+    # Keeps going down while that helps
+    assert controller.update(1.5) == 1
+    # Never below min_limit
+    assert controller.update(2.0) == 1
+
+
+def test_controller_prefers_fewer_on_noise(controller):
+    controller.update(2.0)
+    assert controller.update(2.0 * (1 + controller.TOLERANCE / 2)) == 2
+    assert controller.update(2.0) == 1
+
+
+def test_controller_steps_down_overloaded(controller, monkeypatch):
+    controller.update(1.0)
+    monkeypatch.setattr(ConcurrencyController, "_overloaded", lambda self: True)
+
+    assert controller.update(10.0) == 2
+    assert controller.update(10.0) == 1
+
+
+## Pool
+
+def test_pool_priority_then_order():
+    pool = Pool(Job.CPU)
+    low, first, second, high = job(Job.LOW), job(), job(), job(Job.HIGH)
+    for j in (low, first, second, high):
+        pool.push(j)
+
+    assert [pool.pop() for _ in range(4)] == [high, first, second, low]
+    assert pool.peek() is None
+
+
+def test_pool_remove():
+    pool = Pool(Job.CPU)
+    a, b = job(Job.HIGH), job()
+    pool.push(a)
+    pool.push(b)
+
+    assert pool.remove(a)
+    assert not pool.remove(a)
+    assert pool.queued() == [b]
+    assert pool.pop() is b
+    assert not pool.queue and not pool.entries
+
+
+## JobEngine scheduling
+
+def test_cancel_queued(engine):
+    a = engine.submit(job())
+    finished = []
+    a.finish_signal.connect(finished.append)
+
+    engine.cancel(a)
+
+    assert a.status == Job.CANCELLED
+    assert finished == [a]
+    assert engine._pool(a).peek() is None
+
+
+def test_set_priority_reorders(engine):
+    a, b = engine.submit(job()), engine.submit(job())
+    engine.set_priority(b, Job.HIGH)
+
+    pool = engine._pool(a)
+    assert pool.peek() is b
+    assert pool.queued() == [a, b]
+
+
+def test_schedule_up_to_limit(engine):
+    jobs = [engine.submit(job()) for _ in range(3)]
+    pool = engine._pool(jobs[0])
+    pool.controller.limit = 2
+
+    engine._schedule()
+
+    assert engine.launched == jobs[:2]
+    assert pool.queued() == [jobs[2]]
+
+
+def test_schedule_preempts_lower_priority(engine):
+    low = engine.submit(job(Job.LOW))
+    pool = engine._pool(low)
+    pool.controller.limit = 1
+    engine._schedule()
+
+    high = engine.submit(job(Job.HIGH))
+    engine._schedule()
+
+    assert engine.launched == [low, high]
+    assert low.status == Job.PAUSED
+    assert low.process.signals == [signal.SIGSTOP]
+    assert pool.paused == [low] and pool.running == [high]
+
+    # Continued once there is room again
+    pool.running.remove(high)
+    engine._schedule()
+    assert low.status == Job.RUNNING
+    assert low.process.signals == [signal.SIGSTOP, signal.SIGCONT]
+    assert pool.running == [low] and not pool.paused
+
+
+def test_schedule_same_priority_waits(engine):
+    a = engine.submit(job())
+    engine._pool(a).controller.limit = 1
+    engine._schedule()
+
+    b = engine.submit(job())
+    engine._schedule()
+
+    assert engine.launched == [a]
+    assert a.status == Job.RUNNING and b.status == Job.QUEUED
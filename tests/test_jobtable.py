@@ -0,0 +1,139 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QApplication
+
+from engine import Job
+from jobtable import JobTableModel
+
+
+class Codec:
+    name = "H.264"
+
+    def is_stream_copy(self):
+        return False
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture
+def model(app):
+    model = JobTableModel()
+    model.timer.stop()
+    return model
+
+
+def add(model, *names):
+    jobs = [Job("/in/%s" % name, [("/out/%s" % name, Codec())])
+            for name in names]
+    for job in jobs:
+        model.add_job(job)
+    return jobs
+
+
+def shown(model):
+    return [os.path.basename(model.job_at(row).input_file)
+            for row in range(model.rowCount())]
+
+
+## flush
+
+def test_flush_adds_jobs(model):
+    add(model, "a.mov", "b.mov")
+    model.flush()
+
+    assert shown(model) == ["a.mov", "b.mov"]
+    assert model.total() == 2
+
+
+def test_flush_added_and_changed(model):
+    jobs = add(model, "a.mov", "b.mov", "c.mov")
+    # Progress before the job is first shown
+    jobs[1].finish_signal.emit(jobs[1])
+    model.flush()
+
+    assert model.rowCount() == model.total() == 3
+    assert shown(model) == ["a.mov", "b.mov", "c.mov"]
+
+
+def test_flush_changed_to_filtered(model):
+    jobs = add(model, "a.mov", "b.mov")
+    model.flush()
+    model.set_filter(statuses=[Job.QUEUED])
+
+    jobs[0].status = Job.DONE
+    jobs[0].finish_signal.emit(jobs[0])
+    model.flush()
+    assert shown(model) == ["b.mov"]
+
+    jobs[1].status = Job.DONE
+    jobs[0].status = Job.QUEUED
+    jobs[0].progress_signal.emit(jobs[0])
+    jobs[1].finish_signal.emit(jobs[1])
+    model.flush()
+    assert shown(model) == ["a.mov"]
+
+
+def test_flush_limits_inserts(model, monkeypatch):
+    monkeypatch.setattr(JobTableModel, "MAX_INSERTS", 2)
+    add(model, "a.mov", "b.mov", "c.mov")
+
+    model.flush()
+    assert model.rowCount() == 2
+
+    model.flush()
+    assert shown(model) == ["a.mov", "b.mov", "c.mov"]
+
+
+## sort and filter
+
+def test_sort(model):
+    jobs = add(model, "b.mov", "C.mov", "a.mov")
+    model.flush()
+
+    model.sort(JobTableModel.INPUT)
+    assert shown(model) == ["a.mov", "b.mov", "C.mov"]
+
+    model.sort(JobTableModel.INPUT, Qt.DescendingOrder)
+    assert shown(model) == ["C.mov", "b.mov", "a.mov"]
+
+    jobs[2].attempts = 2
+    model.sort(JobTableModel.ATTEMPTS, Qt.DescendingOrder)
+    assert shown(model)[0] == "a.mov"
+
+
+def test_filter(model):
+    jobs = add(model, "one.mov", "two.mov", "three.mov")
+    jobs[1].status = Job.FAILED
+    model.flush()
+
+    model.set_filter("T")
+    assert shown(model) == ["two.mov", "three.mov"]
+
+    model.set_filter("t", [Job.FAILED])
+    assert shown(model) == ["two.mov"]
+
+    model.set_filter()
+    assert shown(model) == ["one.mov", "two.mov", "three.mov"]
+
+
+def test_filter_keeps_sort(model):
+    add(model, "b.mov", "c.mov", "a.mov")
+    model.flush()
+    model.sort(JobTableModel.INPUT)
+
+    model.set_filter(".mov")
+    add(model, "0.mov")
+    model.flush()
+
+    # Jobs added later go to the end
+    assert shown(model) == ["a.mov", "b.mov", "c.mov", "0.mov"]
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from ff import FFTime
+from resumable import plan_chunks
+
+
+class FakeFF:
+    def __init__(self, duration, keyframes):
+        self.duration = duration
+        self.keyframes = keyframes
+
+    def get_duration(self, input_file):
+        if self.duration is None:
+            return 1, None
+        return 0, FFTime(1000 * self.duration)
+
+    def get_keyframes(self, input_file):
+        return iter(self.keyframes)
+
+
+KEYFRAMES = [0.0, 4.0, 8.0, 12.0, 16.0, 20.0]
+
+
+## plan_chunks
+
+def test_plan_chunks():
+    chunks = plan_chunks(FakeFF(22.0, KEYFRAMES), "a.mov", (None, None), 5)
+
+    # At least chunk_secs, split on keyframes, the last one to the end
+    assert chunks == [[0.0, 8.0], [8.0, 16.0], [16.0, 22.0]]
+
+
+def test_plan_chunks_slice():
+    chunks = plan_chunks(FakeFF(22.0, KEYFRAMES), "a.mov",
+            (FFTime(2000), FFTime(15000)), 5)
+
+    assert chunks == [[2.0, 8.0], [8.0, 16.0], [16.0, 17.0]]
+
+
+def test_plan_chunks_short():
+    assert plan_chunks(FakeFF(22.0, KEYFRAMES), "a.mov", (None, None), 60) \
+            == [[0.0, 22.0]]
+    assert plan_chunks(FakeFF(3.0, []), "a.mov", (None, None), 1) \
+            == [[0.0, 3.0]]
+
+
+def test_plan_chunks_unknown_duration():
+    with pytest.raises(ValueError):
+        plan_chunks(FakeFF(None, KEYFRAMES), "a.mov", (None, None), 5)
@@ -0,0 +1,167 @@
+import http.client
+import json
+import os
+import sys
+import threading
+
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from engine import Job
+from service import JobService
+
+
+class FakeFF:
+    history = None
+
+    def codecs(self):
+        # All of them
+        return None
+
+
+class FakeEngine:
+    def __init__(self):
+        self.ff = FakeFF()
+        self.submitted = []
+        self.cancelled = []
+
+    def submit(self, job):
+        self.submitted.append(job)
+        return job
+
+    def cancel(self, job):
+        job.status = Job.CANCELLED
+        self.cancelled.append(job)
+
+
+@pytest.fixture
+def service():
+    return JobService(FakeEngine(), token="secret")
+
+
+@pytest.fixture
+def server(service):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), service.handler())
+    threading.Thread(target=server.serve_forever, args=(0.01,),
+            daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, method, path, body=None, host=None, token="secret",
+        content_type="application/json"):
+    port = server.server_address[1]
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+
+    headers = {"Host": host or "127.0.0.1:%d" % port}
+    if token:
+        headers["Authorization"] = "Bearer " + token
+    if body is not None:
+        body = json.dumps(body)
+        headers["Content-Type"] = content_type
+
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    data = json.loads(response.read().decode("utf-8"))
+    conn.close()
+
+    return response.status, data
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    path = tmp_path / "a.mov"
+    path.write_bytes(b"data")
+    return str(path)
+
+
+## Host and token checks
+
+@pytest.mark.parametrize("host", ["localhost", "localhost:8080",
+    "127.0.0.1", "[::1]:8080", "LOCALHOST"])
+def test_local_hosts(server, host):
+    assert request(server, "GET", "/jobs", host=host) == (200, [])
+
+
+@pytest.mark.parametrize("host", ["evil.example", "evil.example:8080",
+    "localhost.evil.example", "127.0.0.1.evil.example:80", ""])
+def test_other_hosts(server, host):
+    status, data = request(server, "GET", "/jobs", host=host or " ")
+
+    assert status == 403
+    assert data["error"] == "Host not allowed"
+
+
+@pytest.mark.parametrize("token", [None, "wrong", "secret2", "secre"])
+def test_token(server, token):
+    assert request(server, "GET", "/jobs", token=token)[0] == 401
+    assert request(server, "DELETE", "/jobs/1", token=token)[0] == 401
+
+
+def test_no_token(server, service):
+    service.token = None
+    assert request(server, "GET", "/jobs", token=None) == (200, [])
+
+
+## Submissions
+
+def test_submit(server, service, input_file):
+    status, data = request(server, "POST", "/jobs",
+            {"input": input_file, "formats": ["mp4"]})
+
+    assert status == 201
+    assert [job.id for job in service.engine.submitted] == [data[0]["id"]]
+    output = os.path.join(os.path.dirname(input_file), "converted", "a.mp4")
+    assert data[0]["outputs"] == [output]
+
+    status, data = request(server, "GET", "/jobs/%d" % data[0]["id"])
+    assert status == 200
+    assert data["status"] == "queued"
+
+
+def test_submit_needs_json(server, service, input_file):
+    status, _ = request(server, "POST", "/jobs", {"input": input_file},
+            content_type="text/plain")
+
+    assert status == 415
+    assert not service.engine.submitted
+
+
+@pytest.mark.parametrize("body", [
+    {},
+    {"input": "/no/such/file.mov"},
+    {"formats": ["nope"]},
+    {"slices": [[10, 5]]},
+    ])
+def test_submit_invalid(server, service, input_file, body):
+    body = dict({"input": input_file}, **body) if body else body
+    status, data = request(server, "POST", "/jobs", body)
+
+    assert status == 400
+    assert "error" in data
+    assert not service.engine.submitted
+
+
+def test_submit_overwrite(server, service, tmp_path):
+    path = tmp_path / "a.mp4"
+    path.write_bytes(b"data")
+
+    status, data = request(server, "POST", "/jobs",
+            {"input": str(path), "formats": ["mp4"], "output": str(path)})
+
+    assert status == 400
+    assert "overwrite" in data["error"]
+
+
+def test_cancel(server, service, input_file):
+    _, data = request(server, "POST", "/jobs", {"input": input_file})
+
+    status, data = request(server, "DELETE", "/jobs/%d" % data[0]["id"])
+    assert status == 200
+    assert data["status"] == "cancelled"
+
+    assert request(server, "DELETE", "/jobs/0")[0] == 404
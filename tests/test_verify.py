@@ -0,0 +1,114 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from ff import FFTime
+from verify import JobFailure, Verifier
+
+
+class Codec:
+    def __init__(self, args=()):
+        self.args = list(args)
+
+
+class FakeFF:
+    def __init__(self, input_secs, output_secs, output_types=("video", "audio")):
+        self.input_secs = input_secs
+        self.output_secs = output_secs
+        self.output_types = output_types
+
+    def slice_secs(self, input_file, slice_timestamps):
+        start, end = [None if ts is None else ts.to_ms() / 1000
+                for ts in slice_timestamps]
+        end = self.input_secs if end is None else end
+        return end - (start or 0.0)
+
+    def get_duration(self, filename):
+        if self.output_secs is None:
+            return 1, None
+        return 0, FFTime(1000 * self.output_secs)
+
+    def get_stream_types(self, filename):
+        if filename.endswith(".mov"):
+            return ["video", "audio", "data"]
+        return list(self.output_types)
+
+
+def output(tmp_path, data=b"data"):
+    path = tmp_path / "out.mp4"
+    path.write_bytes(data)
+    return str(path)
+
+
+## JobFailure.from_exit
+
+@pytest.mark.parametrize("code, log, kind", [
+    (-9, [], JobFailure.KILLED),
+    (255, ["Exiting normally, received signal 15.\n"], JobFailure.KILLED),
+    (1, ["Exiting normally, received signal 2.\n"], JobFailure.KILLED),
+    (1, ["av_interleaved_write_frame(): No space left on device\n",
+        "Conversion failed!\n"], JobFailure.NO_SPACE),
+    (1, ["Unknown encoder 'libfoo'\n"], JobFailure.ERROR),
+    (1, [], JobFailure.ERROR),
+    ])
+def test_from_exit(code, log, kind):
+    assert JobFailure.from_exit(code, log).kind == kind
+
+
+def test_from_exit_message():
+    failure = JobFailure.from_exit(1, ["first\n", "Conversion failed!\n"])
+
+    assert str(failure) == "ffmpeg error: exit code 1, Conversion failed!"
+    assert not failure.retryable()
+
+
+@pytest.mark.parametrize("kind, retryable", [
+    (JobFailure.KILLED, True),
+    (JobFailure.NO_SPACE, True),
+    (JobFailure.TRUNCATED, True),
+    (JobFailure.CORRUPT, True),
+    (JobFailure.ERROR, False),
+    (JobFailure.STREAMS, False),
+    ])
+def test_retryable(kind, retryable):
+    assert JobFailure(kind, "").retryable() == retryable
+
+
+## Verifier
+
+def verify(ff, output_file, codec=Codec(), slice_timestamps=(None, None)):
+    Verifier(ff).verify("/in/a.mov", output_file, codec, slice_timestamps)
+
+
+def test_verify_complete(tmp_path):
+    # Shorter within the tolerance
+    verify(FakeFF(10.0, 9.8), output(tmp_path))
+
+
+@pytest.mark.parametrize("ff, data, kind", [
+    (FakeFF(10.0, 10.0), b"", JobFailure.UNREADABLE),
+    (FakeFF(10.0, None), b"data", JobFailure.UNREADABLE),
+    (FakeFF(10.0, 5.0), b"data", JobFailure.TRUNCATED),
+    (FakeFF(10.0, 10.0, ["video"]), b"data", JobFailure.STREAMS),
+    ])
+def test_verify_fails(tmp_path, ff, data, kind):
+    with pytest.raises(JobFailure) as e:
+        verify(ff, output(tmp_path, data))
+
+    assert e.value.kind == kind
+
+
+def test_verify_slice(tmp_path):
+    slice_timestamps = (FFTime(2000), FFTime(6000))
+    verify(FakeFF(10.0, 4.0), output(tmp_path), slice_timestamps=slice_timestamps)
+
+    # A slice running past the end of the input
+    slice_timestamps = (FFTime(8000), FFTime(20000))
+    verify(FakeFF(10.0, 2.0), output(tmp_path), slice_timestamps=slice_timestamps)
+
+
+def test_verify_dropped_streams(tmp_path):
+    verify(FakeFF(10.0, 10.0, ["video"]), output(tmp_path), Codec(["-an"]))